@@ -8,35 +8,57 @@ StarsForQuestion - ULTIMATE MONOLITH v10.0 (ПОЛНАЯ ВЕРСИЯ, РУСС
 """
 
 import asyncio
+import contextvars
+import copy
+import functools
+import inspect
+import hashlib
+import itertools
 import logging
+import math
 import os
 import random
 import json
+import string
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, suppress
 from datetime import datetime, timedelta
-from typing import Optional, Any, Dict, List, Tuple
+from typing import Optional, Any, Dict, List, NamedTuple, Tuple, Union
 
 # База данных: поддержка SQLite и PostgreSQL
 import sqlite3
 try:
     import psycopg2
     import psycopg2.extras
+    import psycopg2.pool
     PSYCOPG2_AVAILABLE = True
 except ImportError:
     PSYCOPG2_AVAILABLE = False
 
 from aiohttp import web
 
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
-    Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup
+    Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, User
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.client.default import DefaultBotProperties
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+try:
+    from aiogram.fsm.storage.redis import RedisStorage
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
 
 
 # ========== КОНФИГУРАЦИЯ ИЗ ОКРУЖЕНИЯ ==========
@@ -50,472 +72,1306 @@ ADMIN_IDS = [int(id.strip()) for id in raw_admins.split(",") if id.strip()]
 WITHDRAWAL_CHANNEL_ID = os.getenv("WITHDRAWAL_CHANNEL", "-1003891414947")
 SUPPORT_USERNAME = os.getenv("SUPPORT_USERNAME", "@Nft_top3")
 PORT = int(os.environ.get("PORT", 10000))
+# Вебхук вместо long polling: задан WEBHOOK_URL (внешний адрес сервиса, например https://bot.onrender.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram присылает в заголовке; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32]
+# Сколько апдейтов обрабатывается одновременно
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", 100))
 
 # Выбор базы данных: PostgreSQL если задан DATABASE_URL, иначе SQLite
 DATABASE_URL = os.getenv("DATABASE_URL")  # для Render PostgreSQL
+# Пул соединений PostgreSQL
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))  # сколько ждать свободное соединение (сек)
+DB_HEALTHCHECK_IDLE = float(os.getenv("DB_HEALTHCHECK_IDLE", 30))  # после скольких секунд простоя пинговать соединение
+# Кэш настроек: сбрасывается при set_config, TTL — на случай нескольких процессов бота
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", 60))
+# LRU-кэш строк users: размер и срок жизни записи (защита от правок в обход бота)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", 10000))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", 300))
+# Топ: как часто сверять топ в памяти с БД и сколько секунд держать готовый текст
+LEADERBOARD_RECONCILE = float(os.getenv("LEADERBOARD_RECONCILE", 300))
+TOP_RENDER_TTL = float(os.getenv("TOP_RENDER_TTL", 15))
+# Очередь исходящих: сообщений в секунду на весь бот (лимит Telegram ~30) и число отправителей
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", 25))
+OUTBOUND_WORKERS = int(os.getenv("OUTBOUND_WORKERS", 8))
+# Рассылки: одновременных отправок, размер страницы получателей
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 20))
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", 200))
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))  # как часто обновлять прогресс (сек)
+# Outbox (заявки в канал выплат): записей за проход диспетчера и опрос на случай пропущенного пробуждения (сек)
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", 20))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 30))
+# last_seen пишется не чаще раза в столько секунд на пользователя
+LAST_SEEN_RESOLUTION = float(os.getenv("LAST_SEEN_RESOLUTION", 600))
+# Повтор того же нажатия (юзер, кнопка, сообщение) в течение стольких секунд отбрасывается
+CALLBACK_DEDUP_WINDOW = float(os.getenv("CALLBACK_DEDUP_WINDOW", 1.0))
+# FSM: брошенные сценарии живут FSM_TTL секунд; кеш чтения и период отложенной записи в БД
+FSM_TTL = float(os.getenv("FSM_TTL", 86400))
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", 60))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", 0.5))
+# Если задан и установлен пакет redis — FSM хранится в Redis (или совместимом сервере)
+REDIS_URL = os.getenv("REDIS_URL")
 
 
 # ========== БАЗА ДАННЫХ (УНИВЕРСАЛЬНЫЙ КЛАСС) ==========
 
+class PostgresPool:
+    """Ограниченный пул соединений PostgreSQL.
+
+    Держит от min_size до max_size соединений. Перед выдачей соединение
+    проверяется: закрытое или долго простаивавшее пингуется SELECT 1 и при
+    обрыве (например, SSL на Render) пересоздаётся. Если все соединения заняты,
+    поток ждёт освобождения не дольше timeout секунд.
+    """
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, timeout: float, healthcheck_idle: float):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._cond = threading.Condition()
+        self._idle: List[Tuple[Any, float]] = []  # (соединение, когда вернули в пул)
+        self._size = 0  # открыто соединений: свободные + выданные
+        # Статистика для мониторинга
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.reconnects = 0
+        for _ in range(min(min_size, self.max_size)):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, sslmode='require')
+        conn.autocommit = False
+        return conn
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _is_alive(self, conn, returned_at: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        deadline = started + self.timeout
+        with self._cond:
+            self.waiting += 1
+            try:
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise psycopg2.pool.PoolError("Нет свободных соединений с БД")
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, 0.0
+                self._size += 1  # резервируем место под новое соединение
+            waited = time.monotonic() - started
+            self.in_use += 1
+            self.acquired += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+
+        # Подключение и пинг — вне блокировки, чтобы не задерживать другие потоки
+        try:
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_alive(conn, returned_at):
+                logging.warning("Соединение с PostgreSQL оборвано, переподключаемся")
+                self._close_quietly(conn)
+                with self._cond:
+                    self.reconnects += 1
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self.in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn, broken: bool = False):
+        if not broken and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        if broken or conn.closed:
+            self._close_quietly(conn)
+        with self._cond:
+            self.in_use -= 1
+            if broken or conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._size -= len(self._idle)
+            self._idle.clear()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'size': self._size,
+                'max_size': self.max_size,
+                'idle': len(self._idle),
+                'in_use': self.in_use,
+                'waiting': self.waiting,
+                'acquired': self.acquired,
+                'wait_avg_ms': round(self.wait_total / self.acquired * 1000, 2) if self.acquired else 0.0,
+                'wait_max_ms': round(self.wait_max * 1000, 2),
+                'timeouts': self.timeouts,
+                'reconnects': self.reconnects,
+            }
+
+
+class Transaction:
+    """Открытая транзакция: соединение и действия, отложенные до коммита/отката"""
+    __slots__ = ('conn', 'after_commit', 'after_rollback')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.after_commit: List = []
+        self.after_rollback: List = []
+
+
+class ConfigSnapshot:
+    """Значения таблицы config на момент загрузки и разобранные из них
+    типизированные значения (числа, JSON подарков и эксклюзивов, суммы вывода).
+    Разбор делается один раз на снимок. Возвращаемые dict/list — общие,
+    менять их нельзя: перед правкой копировать."""
+    __slots__ = ('values', 'loaded_at', '_parsed')
+
+    def __init__(self, values: Dict[str, Any]):
+        self.values = values
+        self.loaded_at = time.monotonic()
+        self._parsed: Dict[Any, Any] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self.values[key] if key in self.values else default
+
+    def _memo(self, name, build):
+        if name not in self._parsed:
+            self._parsed[name] = build()
+        return self._parsed[name]
+
+    def get_float(self, key: str, default: float) -> float:
+        def build():
+            try:
+                return float(self.get(key, default))
+            except (TypeError, ValueError):
+                logging.warning(f"Некорректное значение настройки {key}, используем {default}")
+                return float(default)
+        return self._memo(('float', key), build)
+
+    def gifts_prices(self) -> dict:
+        def build():
+            try:
+                return json.loads(self.get('gifts_prices', '{}'))
+            except:
+                return {}
+        return self._memo('gifts_prices', build)
+
+    def special_items(self) -> dict:
+        def build():
+            try:
+                return json.loads(self.get('special_items', '{}'))
+            except:
+                return {}
+        return self._memo('special_items', build)
+
+    def withdrawal_options(self) -> list:
+        def build():
+            opt = self.get('withdrawal_options', '15,25,50,100')
+            return [int(x.strip()) for x in opt.split(',') if x.strip()]
+        return self._memo('withdrawal_options', build)
+
+
+class ConfigCache:
+    """Кэш настроек в памяти процесса (read-through).
+    Таблица config маленькая и читается целиком одним SELECT. Снимок
+    сбрасывается при set_config и живёт не дольше ttl секунд — на случай,
+    если настройки поменял другой процесс бота."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._snapshot: Optional[ConfigSnapshot] = None
+        self._lock = threading.Lock()
+        # Номер поколения: снимок, загруженный до сброса, не должен попасть в кэш
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def current(self) -> Optional[ConfigSnapshot]:
+        snap = self._snapshot
+        if snap is not None and time.monotonic() - snap.loaded_at < self.ttl:
+            self.hits += 1
+            return snap
+        self.misses += 1
+        return None
+
+    def store(self, snapshot: ConfigSnapshot, generation: int):
+        with self._lock:
+            if generation == self.generation:
+                self._snapshot = snapshot
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+            self._snapshot = None
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0}
+
+
+class LRUCache:
+    """Потокобезопасный LRU-кэш с ограничением размера и сроком жизни записей.
+
+    Чтение из БД в кэш оборачивается в begin_load/end_load: если ключ изменили
+    (changed или pop), пока чтение шло, прочитанное значение в кэш не кладётся —
+    иначе строка, прочитанная до чужой записи, прожила бы в кэше весь ttl.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()  # ключ -> (значение, когда положили)
+        self._lock = threading.Lock()
+        # Идущие чтения: ключ -> [поколение, сколько чтений]; живёт, пока чтение не закончилось
+        self._loading: Dict[Any, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and time.monotonic() - item[1] < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """Значение без учёта в статистике и без продления LRU"""
+        item = self._data.get(key)
+        return item[0] if item is not None else None
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            self._bump(key)
+        return item[0] if item is not None else None
+
+    def begin_load(self, key) -> int:
+        """Перед чтением значения из БД. Результат передаётся в end_load"""
+        with self._lock:
+            entry = self._loading.setdefault(key, [0, 0])
+            entry[1] += 1
+            return entry[0]
+
+    def end_load(self, key, ticket: int, value=None):
+        """После чтения: кладёт value, только если ключ не менялся с begin_load"""
+        with self._lock:
+            entry = self._loading[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._loading[key]
+            if value is None or entry[0] != ticket:
+                return
+        self.put(key, value)
+
+    def changed(self, key):
+        """Ключ изменён в БД: идущие чтения устарели и в кэш не попадут"""
+        with self._lock:
+            self._bump(key)
+
+    def _bump(self, key):
+        entry = self._loading.get(key)
+        if entry is not None:
+            entry[0] += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_ratio': round(self.hits / total, 4) if total else 0.0}
+
+
+class UserRecord:
+    """Строка таблицы users в кэше. При добавлении колонки в users — добавить её в FIELDS"""
+    FIELDS = ('user_id', 'username', 'first_name', 'stars', 'referrals', 'last_daily', 'last_luck',
+              'ref_code', 'ref_boost', 'is_active', 'total_earned', 'premium_mode', 'referred_by', 'reachable',
+              'last_seen')
+    __slots__ = FIELDS
+
+    def __init__(self, row):
+        data = dict(row)
+        for field in self.FIELDS:
+            setattr(self, field, data.get(field))
+
+    def as_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class GlobalBoostManager:
+    """Глобальные бусты (ref / game) в памяти процесса.
+
+    Значения берутся из config при загрузке снимка настроек, истечение
+    отрабатывает таймер asyncio. Чтение — просто словарь: без запросов и без
+    записи в БД. В config бусты пишутся только когда админ их включает или
+    выключает.
+    """
+    TYPES = ('ref', 'game')
+
+    def __init__(self):
+        self._mult: Dict[str, float] = {t: 1.0 for t in self.TYPES}
+        self._until: Dict[str, Optional[datetime]] = {t: None for t in self.TYPES}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def get(self, boost_type: str) -> float:
+        return self._mult.get(boost_type, 1.0)
+
+    def load(self, config: ConfigSnapshot):
+        for boost_type in self.TYPES:
+            until = None
+            until_str = config.get(f'global_{boost_type}_until', '')
+            if until_str:
+                try:
+                    until = datetime.fromisoformat(until_str)
+                except ValueError:
+                    logging.warning(f"Некорректное время окончания буста {boost_type}: {until_str}")
+            self.apply(boost_type, config.get_float(f'global_{boost_type}_mult', 1.0), until)
+
+    def apply(self, boost_type: str, multiplier: float, until: Optional[datetime]):
+        """Обновляет буст в памяти; можно вызывать из потока БД"""
+        if until is not None and until <= datetime.utcnow():
+            multiplier, until = 1.0, None
+        if self._mult.get(boost_type) == multiplier and self._until.get(boost_type) == until:
+            return
+        self._mult[boost_type] = multiplier
+        self._until[boost_type] = until
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule, boost_type)
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Подключает event loop для таймеров (вызывается при старте бота)"""
+        self._loop = loop
+        for boost_type in self.TYPES:
+            self._schedule(boost_type)
+
+    def _schedule(self, boost_type: str):
+        timer = self._timers.pop(boost_type, None)
+        if timer is not None:
+            timer.cancel()
+        until = self._until.get(boost_type)
+        if until is not None:
+            delay = max((until - datetime.utcnow()).total_seconds(), 0)
+            self._timers[boost_type] = self._loop.call_later(delay, self._expire, boost_type)
+
+    def _expire(self, boost_type: str):
+        self._timers.pop(boost_type, None)
+        until = self._until.get(boost_type)
+        if until is not None and until <= datetime.utcnow():
+            self._mult[boost_type] = 1.0
+            self._until[boost_type] = None
+            logging.info(f"Глобальный буст {boost_type} закончился")
+        else:
+            self._schedule(boost_type)
+
+    def stats(self) -> dict:
+        return {t: {'mult': self._mult[t], 'until': self._until[t].isoformat() if self._until[t] else None}
+                for t in self.TYPES}
+
+
+def stat_buckets(now: Optional[datetime] = None) -> Dict[str, str]:
+    """Ключи текущих корзин статистики (UTC). Смена дня/недели — просто новый ключ"""
+    now = now or datetime.utcnow()
+    year, week, _ = now.isocalendar()
+    return {'day': now.strftime('%Y-%m-%d'), 'week': f"{year}-W{week:02d}"}
+
+
+class Segment:
+    """Сегмент получателей рассылки: фильтры по колонкам users.
+
+    Текстовый вид — условия через пробел, например "active=1 stars>=10 days<=7":
+      active=0|1, premium=0|1, ref=0|1 (есть пригласивший),
+      stars>=N, stars<=N, earned>=N, earned<=N,
+      days<=N — заходил в бота за последние N дней.
+    Условия собираются в WHERE с параметрами, имена колонок — только из FIELDS.
+    """
+    # ключ -> (колонка, допустимые операторы)
+    FIELDS = {
+        'active': ('is_active', ('=',)),
+        'premium': ('premium_mode', ('=',)),
+        'ref': ('referred_by', ('=',)),
+        'stars': ('stars', ('>=', '<=')),
+        'earned': ('total_earned', ('>=', '<=')),
+        'days': ('last_seen', ('<=',)),
+    }
+
+    def __init__(self, conditions: List[Tuple[str, str, float]] = ()):
+        self.conditions = list(conditions)
+
+    @classmethod
+    def parse(cls, text: str) -> 'Segment':
+        """Разбор текста админа; ValueError с понятным сообщением при ошибке"""
+        conditions = []
+        text = (text or '').strip()
+        if text.lower() in ('', 'все', 'all'):
+            return cls()
+        for token in text.split():
+            for op in ('>=', '<=', '='):
+                if op in token:
+                    key, value = token.split(op, 1)
+                    break
+            else:
+                raise ValueError(f"Не понял условие «{token}»")
+            key = key.lower()
+            if key not in cls.FIELDS:
+                raise ValueError(f"Неизвестный фильтр «{key}». Доступны: {', '.join(cls.FIELDS)}")
+            if op not in cls.FIELDS[key][1]:
+                raise ValueError(f"Для «{key}» можно только: {' '.join(cls.FIELDS[key][1])}")
+            try:
+                number = float(value)
+                if not math.isfinite(number):
+                    raise ValueError
+            except ValueError:
+                raise ValueError(f"В условии «{token}» нужно число")
+            if op == '=' and number not in (0, 1):
+                raise ValueError(f"Для «{key}» можно только 0 или 1")
+            if key == 'days' and number <= 0:
+                raise ValueError("Число дней должно быть больше 0")
+            if number < 0:
+                raise ValueError(f"В условии «{token}» число не может быть отрицательным")
+            conditions.append((key, op, number))
+        return cls(conditions)
+
+    def to_sql(self) -> Tuple[str, tuple]:
+        """Условия для WHERE (начинаются с AND) и параметры к ним"""
+        clauses, params = [], []
+        for key, op, value in self.conditions:
+            column = self.FIELDS[key][0]
+            if key == 'ref':
+                clauses.append(f"{column} IS NOT NULL" if value else f"{column} IS NULL")
+            elif key == 'days':
+                since = datetime.utcnow() - timedelta(days=value)
+                clauses.append(f"{column} >= ?")
+                params.append(since.strftime('%Y-%m-%d %H:%M:%S'))
+            else:
+                clauses.append(f"{column} {op} ?")
+                params.append(value)
+        return ''.join(f" AND {clause}" for clause in clauses), tuple(params)
+
+    def dumps(self) -> str:
+        return ' '.join(f"{key}{op}{value:g}" for key, op, value in self.conditions)
+
+    def describe(self) -> str:
+        return self.dumps() or "все пользователи"
+
+
+class Leaderboard:
+    """Топ по балансу в памяти процесса.
+
+    Держит capacity лучших пользователей (с запасом над размером топа).
+    Каждое изменение баланса после коммита передаётся в observe(), так что
+    экран топа не ходит в БД. Пользователь, который опустился ниже запаса,
+    может задержаться в списке до ближайшей сверки с БД (reconcile).
+    """
+    # Верхняя граница размера топа, который можно выставить в админке
+    MAX_SIZE = 50
+
+    def __init__(self, capacity: int = MAX_SIZE * 2):
+        self.capacity = capacity
+        self._entries: Dict[int, Tuple[float, Optional[str]]] = {}  # user_id -> (звёзды, имя)
+        self._lock = threading.Lock()
+        self.loaded = False
+        self.version = 0
+        self.reconciled_at: Optional[datetime] = None
+
+    def load(self, rows):
+        """Полная замена из БД: rows — лучшие пользователи по stars"""
+        entries = {row['user_id']: (float(row['stars'] or 0), row['username'] or row['first_name'])
+                   for row in rows}
+        with self._lock:
+            self._entries = entries
+            self.loaded = True
+            self.version += 1
+            self.reconciled_at = datetime.utcnow()
+
+    def observe(self, user_id: int, stars: float, name: Optional[str] = None):
+        """Новый баланс пользователя; вызывается после коммита"""
+        stars = float(stars)
+        with self._lock:
+            if not self.loaded:
+                return
+            entry = self._entries.get(user_id)
+            if entry is None:
+                if len(self._entries) >= self.capacity:
+                    lowest = min(self._entries, key=lambda uid: self._entries[uid][0])
+                    if stars <= self._entries[lowest][0]:
+                        return
+                    del self._entries[lowest]
+            elif entry[0] == stars:
+                return
+            self._entries[user_id] = (stars, name or (entry[1] if entry else None))
+            self.version += 1
+
+    def set_name(self, user_id: int, name: Optional[str]):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None:
+                self._entries[user_id] = (entry[0], name)
+
+    def top(self, size: int) -> List[Tuple[int, float, Optional[str]]]:
+        with self._lock:
+            items = sorted(self._entries.items(), key=lambda item: item[1][0], reverse=True)[:size]
+        return [(user_id, stars, name) for user_id, (stars, name) in items]
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'version': self.version,
+                'reconciled_at': self.reconciled_at.isoformat() if self.reconciled_at else None}
+
+
+# ========== МИГРАЦИИ СХЕМЫ ==========
+
+# Типы, которые отличаются между диалектами: подставляются в SQL миграций через {bigint} и {serial}
+DIALECT_TYPES = {
+    'sqlite': {'bigint': 'INTEGER', 'serial': 'INTEGER PRIMARY KEY AUTOINCREMENT'},
+    'postgres': {'bigint': 'BIGINT', 'serial': 'SERIAL PRIMARY KEY'},
+}
+
+
+class AddColumn:
+    """Шаг миграции: добавить колонку, если её ещё нет (в SQLite нет ADD COLUMN IF NOT EXISTS)"""
+
+    def __init__(self, table: str, column: str, decl: str):
+        self.table = table
+        self.column = column
+        self.decl = decl
+
+    def __call__(self, cur, dialect: str):
+        decl = self.decl.format(**DIALECT_TYPES[dialect])
+        if dialect == 'postgres':
+            cur.execute(f"ALTER TABLE {self.table} ADD COLUMN IF NOT EXISTS {self.column} {decl}")
+            return
+        cur.execute(f"PRAGMA table_info({self.table})")
+        if self.column not in {row[1] for row in cur.fetchall()}:
+            cur.execute(f"ALTER TABLE {self.table} ADD COLUMN {self.column} {decl}")
+
+
+class Migration:
+    """Версия схемы: список шагов. Шаг — SQL-строка (общая для обоих диалектов,
+    с подстановкой DIALECT_TYPES), словарь {'sqlite': sql, 'postgres': sql}
+    или функция (cursor, dialect). Применённые версии пишутся в schema_version."""
+
+    def __init__(self, version: int, description: str, steps: list):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def apply(self, cur, dialect: str):
+        for step in self.steps:
+            if callable(step):
+                step(cur, dialect)
+                continue
+            if isinstance(step, dict):
+                step = step.get(dialect)
+                if step is None:
+                    continue
+            cur.execute(step.format(**DIALECT_TYPES[dialect]))
+
+
+class Index:
+    """Объявленный индекс. Создаётся шагом миграции, наличие сверяется при старте"""
+
+    def __init__(self, name: str, table: str, columns: str):
+        self.name = name
+        self.table = table
+        self.columns = columns
+
+    def __call__(self, cur, dialect: str):
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {self.name} ON {self.table} ({self.columns})")
+
+
+# Индексы под горячие запросы. Новый индекс — сюда и шагом в новую миграцию
+INDEXES = {index.name: index for index in [
+    # SUM(quantity) по эксклюзиву в магазине — покрывающий индекс
+    Index('idx_inventory_item', 'inventory', 'item_name, quantity'),
+    # Топ по балансу
+    Index('idx_users_stars', 'users', 'stars DESC'),
+    # Рефералы пользователя
+    Index('idx_users_referred_by', 'users', 'referred_by'),
+    # Лоты P2P по товару и цене
+    Index('idx_marketplace_item_price', 'marketplace', 'item_name, price'),
+    # История лотереи игрока
+    Index('idx_lottery_history_user', 'lottery_history', 'user_id'),
+    # Проверка задания start_bot на каждом /start
+    Index('idx_user_quests_task', 'user_quests', 'user_id, task_id'),
+    # Топы за день/неделю
+    Index('idx_stat_buckets_top', 'stat_buckets', 'metric, period, bucket, value DESC'),
+    # Страницы получателей рассылки: только доступные, по user_id
+    Index('idx_users_reachable', 'users', 'reachable, user_id'),
+    # Сегмент «заходил за последние N дней»
+    Index('idx_users_last_seen', 'users', 'last_seen'),
+    # Выборка готовых к отправке записей outbox
+    Index('idx_outbox_pending', 'outbox', 'status, next_attempt_at'),
+    # Удаление брошенных состояний FSM
+    Index('idx_fsm_states_updated', 'fsm_states', 'updated_at'),
+]}
+
+
+def _seed_default_config(cur, dialect: str):
+    default_config = {
+        'ref_reward': ('5.0', 'Награда за активного реферала (звезд)'),
+        'view_reward': ('0.3', 'Награда за просмотр поста'),
+        'daily_min': ('1', 'Минимум ежедневного бонуса'),
+        'daily_max': ('3', 'Максимум ежедневного бонуса'),
+        'luck_min': ('0', 'Минимум удачи'),
+        'luck_max': ('5', 'Максимум удачи'),
+        'luck_cooldown': ('21600', 'Кулдаун удачи (секунд)'),
+        'withdrawal_options': ('15,25,50,100', 'Доступные суммы вывода через запятую'),
+        'gifts_prices': ('{"🧸 Мишка":45,"❤️ Сердце":45,"🎁 Подарок":75,"🌹 Роза":75,"🍰 Тортик":150,"💐 Букет":150,"🚀 Ракета":150,"🍾 Шампанское":150,"🏆 Кубок":300,"💍 Колечко":300,"💎 Алмаз":300}', 'Цены на подарки (JSON)'),
+        'special_items': ('{"Ramen":{"price":250,"limit":25,"full_name":"🍜 Ramen"},"Candle":{"price":199,"limit":30,"full_name":"🕯 B-Day Candle"},"Calendar":{"price":320,"limit":18,"full_name":"🗓 Desk Calendar"}}', 'Эксклюзивные товары (JSON)'),
+        # Глобальные бусты
+        'global_ref_mult': ('1.0', 'Глобальный множитель рефералов'),
+        'global_ref_until': ('', 'Время окончания глобального буста рефералов (ISO)'),
+        'global_game_mult': ('1.0', 'Глобальный множитель выигрышей в играх'),
+        'global_game_until': ('', 'Время окончания глобального буста игр'),
+    }
+    placeholder = '%s' if dialect == 'postgres' else '?'
+    for key, (value, desc) in default_config.items():
+        cur.execute(
+            f"INSERT INTO config (key, value, description) VALUES ({placeholder}, {placeholder}, {placeholder}) "
+            "ON CONFLICT (key) DO NOTHING",
+            (key, value, desc)
+        )
+
+
+def _seed_special_stock(cur, dialect: str):
+    """Начальные счётчики эксклюзивов: лимит из config, продано — сколько сейчас в инвентарях"""
+    placeholder = '%s' if dialect == 'postgres' else '?'
+    cur.execute(f"SELECT value FROM config WHERE key = {placeholder}", ('special_items',))
+    row = cur.fetchone()
+    try:
+        specials = json.loads(row[0]) if row and row[0] else {}
+    except json.JSONDecodeError:
+        specials = {}
+    for key, info in specials.items():
+        cur.execute(f"SELECT COALESCE(SUM(quantity), 0) FROM inventory WHERE item_name = {placeholder}",
+                    (info.get('full_name', key),))
+        sold = int(cur.fetchone()[0])
+        cur.execute(
+            f"INSERT INTO special_stock (item_key, item_limit, sold) VALUES ({placeholder}, {placeholder}, {placeholder}) "
+            "ON CONFLICT (item_key) DO NOTHING",
+            (key, int(info.get('limit', 0)), sold)
+        )
+
+
+def _migrate_lottery_participants(cur, dialect: str):
+    """Переносит строку lottery.participants ("uid,uid,...") в lottery_tickets текущего раунда"""
+    placeholder = '%s' if dialect == 'postgres' else '?'
+    cur.execute("SELECT round_id, participants FROM lottery WHERE id = 1")
+    row = cur.fetchone()
+    if not row or not row[1]:
+        return
+    counts: Dict[int, int] = {}
+    for part in row[1].split(','):
+        if part.strip().isdigit():
+            counts[int(part)] = counts.get(int(part), 0) + 1
+    for user_id, tickets in counts.items():
+        cur.execute(
+            f"INSERT INTO lottery_tickets (round_id, user_id, tickets) VALUES ({placeholder}, {placeholder}, {placeholder})",
+            (row[0], user_id, tickets)
+        )
+    cur.execute(
+        f"UPDATE lottery SET tickets = {placeholder}, players = {placeholder}, participants = '' WHERE id = 1",
+        (sum(counts.values()), len(counts))
+    )
+
+
+# Новые изменения схемы — только новой версией в конец списка, старые шаги не править.
+# Версия 1 идемпотентна: на базе, созданной до появления schema_version, она лишь
+# досоздаст недостающее.
+MIGRATIONS = [
+    Migration(1, "Базовая схема", [
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id {bigint} PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            stars REAL DEFAULT 0,
+            referrals INTEGER DEFAULT 0,
+            last_daily TIMESTAMP,
+            last_luck TIMESTAMP,
+            ref_code TEXT UNIQUE,
+            ref_boost REAL DEFAULT 1.0,
+            is_active INTEGER DEFAULT 0,
+            total_earned REAL DEFAULT 0,
+            premium_mode INTEGER DEFAULT 0,
+            referred_by {bigint}
+        )""",
+        # Колонки, которых не было в старых версиях таблицы users
+        AddColumn('users', 'username', 'TEXT'),
+        AddColumn('users', 'first_name', 'TEXT'),
+        AddColumn('users', 'stars', 'REAL DEFAULT 0'),
+        AddColumn('users', 'referrals', 'INTEGER DEFAULT 0'),
+        AddColumn('users', 'last_daily', 'TIMESTAMP'),
+        AddColumn('users', 'last_luck', 'TIMESTAMP'),
+        AddColumn('users', 'ref_code', 'TEXT'),
+        AddColumn('users', 'ref_boost', 'REAL DEFAULT 1.0'),
+        AddColumn('users', 'is_active', 'INTEGER DEFAULT 0'),
+        AddColumn('users', 'total_earned', 'REAL DEFAULT 0'),
+        AddColumn('users', 'premium_mode', 'INTEGER DEFAULT 0'),
+        AddColumn('users', 'referred_by', '{bigint}'),
+        # Инвентарь
+        """CREATE TABLE IF NOT EXISTS inventory (
+            user_id {bigint},
+            item_name TEXT,
+            quantity INTEGER DEFAULT 1,
+            PRIMARY KEY (user_id, item_name)
+        )""",
+        # Маркетплейс P2P
+        """CREATE TABLE IF NOT EXISTS marketplace (
+            id {serial},
+            seller_id {bigint},
+            item_name TEXT,
+            price REAL
+        )""",
+        # Лотерея
+        """CREATE TABLE IF NOT EXISTS lottery (
+            id INTEGER PRIMARY KEY,
+            pool REAL DEFAULT 0,
+            participants TEXT DEFAULT ''
+        )""",
+        "INSERT INTO lottery (id, pool, participants) VALUES (1, 0, '') ON CONFLICT DO NOTHING",
+        """CREATE TABLE IF NOT EXISTS lottery_history (
+            user_id {bigint},
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # Задания за посты
+        """CREATE TABLE IF NOT EXISTS task_claims (
+            user_id {bigint},
+            task_id TEXT,
+            PRIMARY KEY (user_id, task_id)
+        )""",
+        # Промокоды
+        """CREATE TABLE IF NOT EXISTS promo (
+            code TEXT PRIMARY KEY,
+            reward_type TEXT,
+            reward_value TEXT,
+            uses INTEGER
+        )""",
+        """CREATE TABLE IF NOT EXISTS promo_history (
+            user_id {bigint},
+            code TEXT,
+            PRIMARY KEY (user_id, code)
+        )""",
+        # Стрики
+        """CREATE TABLE IF NOT EXISTS daily_bonus (
+            user_id {bigint} PRIMARY KEY,
+            last_date TEXT,
+            streak INTEGER DEFAULT 0
+        )""",
+        # Дуэли
+        """CREATE TABLE IF NOT EXISTS active_duels (
+            creator_id {bigint} PRIMARY KEY,
+            amount REAL
+        )""",
+        # Настройки
+        """CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            description TEXT
+        )""",
+        # Логи админов
+        """CREATE TABLE IF NOT EXISTS admin_logs (
+            id {serial},
+            admin_id {bigint},
+            action TEXT,
+            details TEXT,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )""",
+        # Квесты
+        """CREATE TABLE IF NOT EXISTS quests (
+            id {serial},
+            name TEXT,
+            description TEXT,
+            reward_type TEXT,
+            reward_value TEXT,
+            condition_type TEXT,
+            condition_value TEXT,
+            is_active INTEGER DEFAULT 1
+        )""",
+        """CREATE TABLE IF NOT EXISTS user_quests (
+            user_id {bigint},
+            quest_id INTEGER,
+            completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, quest_id)
+        )""",
+        # Чеки
+        """CREATE TABLE IF NOT EXISTS checks (
+            id TEXT PRIMARY KEY,
+            creator_id {bigint},
+            type TEXT,
+            value TEXT,
+            password TEXT,
+            max_uses INTEGER,
+            used INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1
+        )""",
+        """CREATE TABLE IF NOT EXISTS check_uses (
+            check_id TEXT,
+            user_id {bigint},
+            PRIMARY KEY (check_id, user_id)
+        )""",
+        _seed_default_config,
+    ]),
+    Migration(2, "Цепочки квестов и задание start_bot", [
+        AddColumn('quests', 'type', 'TEXT'),
+        AddColumn('quests', 'target', 'TEXT'),
+        AddColumn('quests', 'reward', 'REAL'),
+        AddColumn('quests', 'next_quest_id', 'INTEGER'),
+        AddColumn('user_quests', 'task_id', 'TEXT'),
+    ]),
+    Migration(3, "Индексы горячих запросов", [
+        INDEXES['idx_inventory_item'],
+        INDEXES['idx_users_stars'],
+        INDEXES['idx_users_referred_by'],
+        INDEXES['idx_marketplace_item_price'],
+        INDEXES['idx_lottery_history_user'],
+        INDEXES['idx_user_quests_task'],
+    ]),
+    Migration(4, "Счётчики продаж эксклюзивов", [
+        """CREATE TABLE IF NOT EXISTS special_stock (
+            item_key TEXT PRIMARY KEY,
+            item_limit INTEGER NOT NULL,
+            sold INTEGER NOT NULL DEFAULT 0
+        )""",
+        _seed_special_stock,
+    ]),
+    Migration(5, "Билеты лотереи отдельной таблицей", [
+        AddColumn('lottery', 'round_id', 'INTEGER DEFAULT 1'),
+        AddColumn('lottery', 'tickets', 'INTEGER DEFAULT 0'),
+        AddColumn('lottery', 'players', 'INTEGER DEFAULT 0'),
+        """CREATE TABLE IF NOT EXISTS lottery_tickets (
+            round_id INTEGER,
+            user_id {bigint},
+            tickets INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (round_id, user_id)
+        )""",
+        _migrate_lottery_participants,
+    ]),
+    Migration(6, "Настройка размера топа", [
+        "INSERT INTO config (key, value, description) VALUES ('top_size', '10', 'Размер топа по балансу') "
+        "ON CONFLICT (key) DO NOTHING",
+    ]),
+    Migration(7, "Корзины статистики для топов за день и неделю", [
+        """CREATE TABLE IF NOT EXISTS stat_buckets (
+            metric TEXT,
+            period TEXT,
+            bucket TEXT,
+            user_id {bigint},
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (metric, period, bucket, user_id)
+        )""",
+        INDEXES['idx_stat_buckets_top'],
+    ]),
+    Migration(8, "Задания рассылок с чекпоинтом", [
+        """CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id {serial},
+            admin_id {bigint},
+            from_chat_id {bigint},
+            message_id INTEGER,
+            status TEXT DEFAULT 'running',
+            last_user_id {bigint} DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            progress_chat_id {bigint},
+            progress_message_id INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMP
+        )""",
+    ]),
+    Migration(9, "Флаг доступности пользователя для рассылок", [
+        AddColumn('users', 'reachable', 'INTEGER DEFAULT 1'),
+        INDEXES['idx_users_reachable'],
+    ]),
+    Migration(10, "Сегменты рассылок и время последнего захода", [
+        AddColumn('users', 'last_seen', 'TIMESTAMP'),
+        AddColumn('broadcast_jobs', 'segment', "TEXT DEFAULT ''"),
+        INDEXES['idx_users_last_seen'],
+    ]),
+    Migration(11, "Outbox заявок в канал выплат", [
+        """CREATE TABLE IF NOT EXISTS outbox (
+            id {serial},
+            idem_key TEXT UNIQUE,
+            chat_id TEXT,
+            text TEXT,
+            reply_markup TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at TIMESTAMP,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )""",
+        INDEXES['idx_outbox_pending'],
+    ]),
+    Migration(12, "Состояния FSM в БД", [
+        """CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at TIMESTAMP
+        )""",
+        INDEXES['idx_fsm_states_updated'],
+    ]),
+]
+
+
 class Database:
     def __init__(self):
         self.use_postgres = DATABASE_URL is not None and PSYCOPG2_AVAILABLE
         if self.use_postgres:
-            self.conn = self._get_postgres_conn()
+            self.pool = PostgresPool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_HEALTHCHECK_IDLE)
+            # Сколько запросов можно выполнять параллельно
+            self.max_connections = self.pool.max_size
             self._init_postgres()
         else:
             self.conn = sqlite3.connect("bot_data.db", check_same_thread=False)
             self.conn.row_factory = sqlite3.Row
+            self.max_connections = 1
             self._init_sqlite()
-
-    def _get_postgres_conn(self):
-        conn = psycopg2.connect(DATABASE_URL, sslmode='require')
-        conn.autocommit = False
-        return conn
+        # Открытая транзакция (единица работы) в текущем контексте
+        self._tx: contextvars.ContextVar = contextvars.ContextVar("db_tx", default=None)
+        self.config_cache = ConfigCache(CONFIG_CACHE_TTL)
+        self.boosts = GlobalBoostManager()
+        self.config()
+        self.user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+        # Остатки эксклюзивов: item_key -> {'limit', 'sold'}
+        self.stock_cache = LRUCache(256, CONFIG_CACHE_TTL)
+        self.leaderboard = Leaderboard()
+        # Вызывается после коммита новой записи outbox (будит диспетчер)
+        self.on_outbox = None
 
     def _init_postgres(self):
-        with self.conn:
-            with self.conn.cursor() as cur:
-                # Таблица пользователей
-                cur.execute("ALTER TABLE quests ADD COLUMN IF NOT EXISTS type TEXT")
-                cur.execute("ALTER TABLE quests ADD COLUMN IF NOT EXISTS target TEXT")
-                cur.execute("ALTER TABLE quests ADD COLUMN IF NOT EXISTS reward REAL")
-                cur.execute("ALTER TABLE quests ADD COLUMN IF NOT EXISTS next_quest_id INTEGER")
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id BIGINT PRIMARY KEY,
-                        username TEXT,
-                        first_name TEXT,
-                        stars REAL DEFAULT 0,
-                        referrals INTEGER DEFAULT 0,
-                        last_daily TIMESTAMP,
-                        last_luck TIMESTAMP,
-                        ref_code TEXT UNIQUE,
-                        ref_boost REAL DEFAULT 1.0,
-                        is_active INTEGER DEFAULT 0,
-                        total_earned REAL DEFAULT 0,
-                        premium_mode INTEGER DEFAULT 0,
-                        referred_by BIGINT
-                    )
-                """)
-                # Добавляем недостающие колонки (если их нет)
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS username TEXT")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS premium_mode INTEGER DEFAULT 0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS first_name TEXT")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS stars REAL DEFAULT 0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referrals INTEGER DEFAULT 0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_daily TIMESTAMP")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS last_luck TIMESTAMP")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ref_code TEXT UNIQUE")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS ref_boost REAL DEFAULT 1.0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS is_active INTEGER DEFAULT 0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS total_earned REAL DEFAULT 0")
-                cur.execute("ALTER TABLE users ADD COLUMN IF NOT EXISTS referred_by BIGINT")
-
-                # Инвентарь
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS inventory (
-                        user_id BIGINT,
-                        item_name TEXT,
-                        quantity INTEGER DEFAULT 1,
-                        PRIMARY KEY (user_id, item_name)
-                    )
-                """)
-                # Маркетплейс P2P
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS marketplace (
-                        id SERIAL PRIMARY KEY,
-                        seller_id BIGINT,
-                        item_name TEXT,
-                        price REAL
-                    )
-                """)
-                # Лотерея
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS lottery (
-                        id INTEGER PRIMARY KEY,
-                        pool REAL DEFAULT 0,
-                        participants TEXT DEFAULT ''
-                    )
-                """)
-                cur.execute("INSERT INTO lottery (id, pool, participants) VALUES (1, 0, '') ON CONFLICT DO NOTHING")
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS lottery_history (
-                        user_id BIGINT,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                # Квесты
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS task_claims (
-                        user_id BIGINT,
-                        task_id TEXT,
-                        PRIMARY KEY (user_id, task_id)
-                    )
-                """)
-                # Промокоды
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS promo (
-                        code TEXT PRIMARY KEY,
-                        reward_type TEXT,
-                        reward_value TEXT,
-                        uses INTEGER
-                    )
-                """)
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS promo_history (
-                        user_id BIGINT,
-                        code TEXT,
-                        PRIMARY KEY (user_id, code)
-                    )
-                """)
-                # Стрики
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS daily_bonus (
-                        user_id BIGINT PRIMARY KEY,
-                        last_date TEXT,
-                        streak INTEGER DEFAULT 0
-                    )
-                """)
-                # Дуэли
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS active_duels (
-                        creator_id BIGINT PRIMARY KEY,
-                        amount REAL
-                    )
-                """)
-                # Таблица настроек config
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS config (
-                        key TEXT PRIMARY KEY,
-                        value TEXT,
-                        description TEXT
-                    )
-                """)
-                # Таблица логов админов
-                cur.execute("""
-                    CREATE TABLE IF NOT EXISTS admin_logs (
-                        id SERIAL PRIMARY KEY,
-                        admin_id BIGINT,
-                        action TEXT,
-                        details TEXT,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """)
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS quests (
-                id SERIAL PRIMARY KEY,
-                name TEXT,
-                description TEXT,
-                reward_type TEXT,
-                reward_value TEXT,
-                condition_type TEXT,
-                condition_value TEXT,
-                is_active INTEGER DEFAULT 1
-                )
-                """)
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS user_quests (
-                user_id BIGINT,
-                quest_id INTEGER,
-                completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                PRIMARY KEY (user_id, quest_id)
-                )
-
-                """)
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS checks (
-                id TEXT PRIMARY KEY,
-                creator_id BIGINT,
-                type TEXT,
-                value TEXT,
-                password TEXT,
-                max_uses INTEGER,
-                used INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1
-                )
-                """)
-                cur.execute("""
-                CREATE TABLE IF NOT EXISTS check_uses (
-                check_id TEXT,
-                user_id BIGINT,
-                PRIMARY KEY (check_id, user_id)
-                )
-                """)
-                # Заполняем config значениями по умолчанию
-                default_config = {
-                    'ref_reward': ('5.0', 'Награда за активного реферала (звезд)'),
-                    'view_reward': ('0.3', 'Награда за просмотр поста'),
-                    'daily_min': ('1', 'Минимум ежедневного бонуса'),
-                    'daily_max': ('3', 'Максимум ежедневного бонуса'),
-                    'luck_min': ('0', 'Минимум удачи'),
-                    'luck_max': ('5', 'Максимум удачи'),
-                    'luck_cooldown': ('21600', 'Кулдаун удачи (секунд)'),
-                    'withdrawal_options': ('15,25,50,100', 'Доступные суммы вывода через запятую'),
-                    'gifts_prices': ('{"🧸 Мишка":45,"❤️ Сердце":45,"🎁 Подарок":75,"🌹 Роза":75,"🍰 Тортик":150,"💐 Букет":150,"🚀 Ракета":150,"🍾 Шампанское":150,"🏆 Кубок":300,"💍 Колечко":300,"💎 Алмаз":300}', 'Цены на подарки (JSON)'),
-                    'special_items': ('{"Ramen":{"price":250,"limit":25,"full_name":"🍜 Ramen"},"Candle":{"price":199,"limit":30,"full_name":"🕯 B-Day Candle"},"Calendar":{"price":320,"limit":18,"full_name":"🗓 Desk Calendar"}}', 'Эксклюзивные товары (JSON)'),
-                }
-                for key, (value, desc) in default_config.items():
-                    cur.execute("INSERT INTO config (key, value, description) VALUES (%s, %s, %s) ON CONFLICT (key) DO NOTHING", (key, value, desc))
-                # Глобальные бусты
-                cur.execute("INSERT INTO config (key, value, description) VALUES ('global_ref_mult', '1.0', 'Глобальный множитель рефералов') ON CONFLICT DO NOTHING")
-                cur.execute("INSERT INTO config (key, value, description) VALUES ('global_ref_until', '', 'Время окончания глобального буста рефералов (ISO)') ON CONFLICT DO NOTHING")
-                cur.execute("INSERT INTO config (key, value, description) VALUES ('global_game_mult', '1.0', 'Глобальный множитель выигрышей в играх') ON CONFLICT DO NOTHING")
-                cur.execute("INSERT INTO config (key, value, description) VALUES ('global_game_until', '', 'Время окончания глобального буста игр') ON CONFLICT DO NOTHING")
-                cur.execute("ALTER TABLE user_quests ADD COLUMN IF NOT EXISTS task_id TEXT")
+        conn = self.pool.getconn()
+        try:
+            self.schema_version = self.migrate(conn)
+            self.missing_indexes = self.check_indexes(conn)
+        finally:
+            self.pool.putconn(conn)
 
     def _init_sqlite(self):
-        cursor = self.conn.cursor()
-        # Таблица пользователей
-        cursor.execute("ALTER TABLE quests ADD COLUMN type TEXT")
-        cursor.execute("ALTER TABLE quests ADD COLUMN target TEXT")
-        cursor.execute("ALTER TABLE quests ADD COLUMN reward REAL")
-        cursor.execute("ALTER TABLE quests ADD COLUMN next_quest_id INTEGER")
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                stars REAL DEFAULT 0,
-                referrals INTEGER DEFAULT 0,
-                last_daily TIMESTAMP,
-                last_luck TIMESTAMP,
-                ref_code TEXT UNIQUE,
-                ref_boost REAL DEFAULT 1.0,
-                is_active INTEGER DEFAULT 0,
-                total_earned REAL DEFAULT 0,
-                premium_mode INTEGER DEFAULT 0,
-                referred_by INTEGER
-            )
-        """)
-        # Инвентарь
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS inventory (
-                user_id INTEGER,
-                item_name TEXT,
-                quantity INTEGER DEFAULT 1,
-                PRIMARY KEY (user_id, item_name)
-            )
-        """)
-        # Маркетплейс P2P
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS marketplace (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                seller_id INTEGER,
-                item_name TEXT,
-                price REAL
-            )
-        """)
-        # Лотерея
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lottery (
-                id INTEGER PRIMARY KEY,
-                pool REAL DEFAULT 0,
-                participants TEXT DEFAULT ''
-            )
-        """)
-        cursor.execute("INSERT OR IGNORE INTO lottery (id, pool, participants) VALUES (1, 0, '')")
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS lottery_history (
-                user_id INTEGER,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Квесты
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS task_claims (
-                user_id INTEGER,
-                task_id TEXT,
-                PRIMARY KEY (user_id, task_id)
-            )
-        """)
-        # Промокоды
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS promo (
-                code TEXT PRIMARY KEY,
-                reward_type TEXT,
-                reward_value TEXT,
-                uses INTEGER
-            )
-        """)
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS promo_history (
-                user_id INTEGER,
-                code TEXT,
-                PRIMARY KEY (user_id, code)
-            )
-        """)
-        # Стрики
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS daily_bonus (
-                user_id INTEGER PRIMARY KEY,
-                last_date TEXT,
-                streak INTEGER DEFAULT 0
-            )
-        """)
-        # Дуэли
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS active_duels (
-                creator_id INTEGER PRIMARY KEY,
-                amount REAL
-            )
-        """)
-        # Таблица настроек config
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS config (
-                key TEXT PRIMARY KEY,
-                value TEXT,
-                description TEXT
-            )
-        """)
-        # Таблица логов админов
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS admin_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                admin_id INTEGER,
-                action TEXT,
-                details TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        description TEXT,
-        reward_type TEXT,
-        reward_value TEXT,
-        condition_type TEXT,
-        condition_value TEXT,
-        is_active INTEGER DEFAULT 1
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_quests (
-        user_id INTEGER,
-        quest_id INTEGER,
-        completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        PRIMARY KEY (user_id, quest_id)
+        self.schema_version = self.migrate(self.conn)
+        self.missing_indexes = self.check_indexes(self.conn)
+
+    def check_indexes(self, conn) -> List[str]:
+        """Самопроверка при старте: какие индексы из INDEXES отсутствуют в базе"""
+        cur = conn.cursor()
         try:
-        cursor.execute("ALTER TABLE user_quests ADD COLUMN task_id TEXT")
-        except sqlite3.OperationalError:
-        pass
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS checks (
-        id TEXT PRIMARY KEY,
-        creator_id INTEGER,
-        type TEXT,
-        value TEXT,
-        password TEXT,
-        max_uses INTEGER,
-        used INTEGER DEFAULT 0,
-        is_active INTEGER DEFAULT 1
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS check_uses (
-        check_id TEXT,
-        user_id INTEGER,
-        PRIMARY KEY (check_id, user_id)
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS checks (
-        id TEXT PRIMARY KEY,
-        creator_id INTEGER,
-        type TEXT,
-        value TEXT,
-        password TEXT,
-        max_uses INTEGER,
-        used INTEGER DEFAULT 0,
-        is_active INTEGER DEFAULT 1
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS check_uses (
-        check_id TEXT,
-        user_id INTEGER,
-        PRIMARY KEY (check_id, user_id)
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS quests (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        description TEXT,
-        reward_type TEXT,
-        reward_value TEXT,
-        condition_type TEXT,
-        condition_value TEXT,
-        is_active INTEGER DEFAULT 1
-        )
-        """)
-        cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_quests (
-        user_id INTEGER,
-        quest_id INTEGER,
-        completed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-        PRIMARY KEY (user_id, quest_id)
-        )
-        """)
+            if self.use_postgres:
+                cur.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()")
+            else:
+                cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+            existing = {row[0] for row in cur.fetchall()}
+            conn.commit()
+        finally:
+            cur.close()
+        missing = [name for name in INDEXES if name not in existing]
+        if missing:
+            logging.warning(f"В БД нет индексов: {', '.join(missing)} — запросы по ним идут полным сканом")
+        return missing
+
+    def migrate(self, conn):
+        """Доводит схему до последней версии из MIGRATIONS.
+        Обычный старт — один запрос версии; применяются только новые шаги,
+        каждый в своей транзакции вместе с записью в schema_version."""
+        dialect = 'postgres' if self.use_postgres else 'sqlite'
+        placeholder = '%s' if self.use_postgres else '?'
+        cur = conn.cursor()
         try:
-            cursor.execute("ALTER TABLE user_quests ADD COLUMN task_id TEXT")
-        except sqlite3.OperationalError:
-            pass
-        # Заполняем config значениями по умолчанию
-        default_config = {
-            'ref_reward': ('5.0', 'Награда за активного реферала (звезд)'),
-            'view_reward': ('0.3', 'Награда за просмотр поста'),
-            'daily_min': ('1', 'Минимум ежедневного бонуса'),
-            'daily_max': ('3', 'Максимум ежедневного бонуса'),
-            'luck_min': ('0', 'Минимум удачи'),
-            'luck_max': ('5', 'Максимум удачи'),
-            'luck_cooldown': ('21600', 'Кулдаун удачи (секунд)'),
-            'withdrawal_options': ('15,25,50,100', 'Доступные суммы вывода через запятую'),
-            'gifts_prices': ('{"🧸 Мишка":45,"❤️ Сердце":45,"🎁 Подарок":75,"🌹 Роза":75,"🍰 Тортик":150,"💐 Букет":150,"🚀 Ракета":150,"🍾 Шампанское":150,"🏆 Кубок":300,"💍 Колечко":300,"💎 Алмаз":300}', 'Цены на подарки (JSON)'),
-            'special_items': ('{"Ramen":{"price":250,"limit":25,"full_name":"🍜 Ramen"},"Candle":{"price":199,"limit":30,"full_name":"🕯 B-Day Candle"},"Calendar":{"price":320,"limit":18,"full_name":"🗓 Desk Calendar"}}', 'Эксклюзивные товары (JSON)'),
-        }
-        for key, (value, desc) in default_config.items():
-            cursor.execute("INSERT OR IGNORE INTO config (key, value, description) VALUES (?, ?, ?)", (key, value, desc))
-        # Глобальные бусты
-        cursor.execute("INSERT OR IGNORE INTO config (key, value, description) VALUES ('global_ref_mult', '1.0', 'Глобальный множитель рефералов')")
-        cursor.execute("INSERT OR IGNORE INTO config (key, value, description) VALUES ('global_ref_until', '', 'Время окончания глобального буста рефералов (ISO)')")
-        cursor.execute("INSERT OR IGNORE INTO config (key, value, description) VALUES ('global_game_mult', '1.0', 'Глобальный множитель выигрышей в играх')")
-        cursor.execute("INSERT OR IGNORE INTO config (key, value, description) VALUES ('global_game_until', '', 'Время окончания глобального буста игр')")
-        self.conn.commit()
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+            current = cur.fetchone()[0]
+            conn.commit()
+            pending = [m for m in MIGRATIONS if m.version > current]
+            if not pending:
+                logging.info(f"Схема БД актуальна (версия {current})")
+                return current
+            for migration in pending:
+                if self.use_postgres:
+                    # Два инстанса при перезапуске без простоя не должны мигрировать одновременно
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext('schema_version'))")
+                    cur.execute("SELECT 1 FROM schema_version WHERE version = %s", (migration.version,))
+                    if cur.fetchone():
+                        conn.commit()
+                        continue
+                else:
+                    cur.execute("BEGIN")
+                migration.apply(cur, dialect)
+                cur.execute(
+                    f"INSERT INTO schema_version (version, description) VALUES ({placeholder}, {placeholder})",
+                    (migration.version, migration.description)
+                )
+                conn.commit()
+                logging.info(f"Применена миграция {migration.version}: {migration.description}")
+            return pending[-1].version
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
 
     def execute(self, query: str, params: tuple = (), fetch: bool = False, fetchone: bool = False):
-        """Универсальный метод выполнения запросов"""
+        """Универсальный метод выполнения запросов.
+        Внутри транзакции запрос идёт на её соединение без коммита."""
+        tx = self._tx.get()
+        if tx is not None:
+            return self._run_query(tx.conn, query, params, fetch, fetchone)
+        if self.use_postgres:
+            return self._execute_postgres(query, params, fetch, fetchone)
+        result = self._run_query(self.conn, query, params, fetch, fetchone)
+        self.conn.commit()
+        return result
+
+    def _run_query(self, conn, query: str, params: tuple, fetch: bool, fetchone: bool):
+        if self.use_postgres:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
+                cur.execute(query.replace('?', '%s'), params)
+                return cur.fetchall() if fetch else cur.fetchone() if fetchone else None
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return cursor.fetchall() if fetch else cursor.fetchone() if fetchone else None
+
+    # --- Транзакции (единица работы) ---
+    def in_transaction(self) -> bool:
+        return self._tx.get() is not None
+
+    def begin(self) -> Transaction:
+        """Новая транзакция. SQLite открывает её неявно на первой записи"""
+        return Transaction(self.pool.getconn() if self.use_postgres else self.conn)
+
+    def commit(self, tx: Transaction):
         if self.use_postgres:
-            query = query.replace('?', '%s')
-            with self.conn:
-                with self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cur:
-                    cur.execute(query, params)
-                    if fetch:
-                        return cur.fetchall()
-                    if fetchone:
-                        return cur.fetchone()
-                    self.conn.commit()
-                    return None
+            try:
+                tx.conn.commit()
+            except Exception:
+                self.pool.putconn(tx.conn, broken=True)
+                raise
+            self.pool.putconn(tx.conn)
         else:
-            cursor = self.conn.cursor()
-            cursor.execute(query, params)
-            if fetch:
-                return cursor.fetchall()
-            if fetchone:
-                return cursor.fetchone()
-            self.conn.commit()
-            return None
+            tx.conn.commit()
+        for callback in tx.after_commit:
+            callback()
 
+    def rollback(self, tx: Transaction):
+        if self.use_postgres:
+            try:
+                tx.conn.rollback()
+                self.pool.putconn(tx.conn)
+            except psycopg2.Error:
+                self.pool.putconn(tx.conn, broken=True)
+        else:
+            tx.conn.rollback()
+        for callback in tx.after_rollback:
+            callback()
+
+    def on_commit(self, callback):
+        """Выполнить callback после коммита текущей транзакции (или сразу, если её нет)"""
+        tx = self._tx.get()
+        if tx is None:
+            callback()
+        else:
+            tx.after_commit.append(callback)
+
+    def on_rollback(self, callback):
+        """Выполнить callback, если текущая транзакция откатится"""
+        tx = self._tx.get()
+        if tx is not None:
+            tx.after_rollback.append(callback)
+
+    @contextmanager
+    def transaction(self):
+        """Синхронная единица работы для методов, выполняемых в потоке БД.
+        Вложенный вызов присоединяется к уже открытой транзакции."""
+        if self.in_transaction():
+            yield
+            return
+        tx = self.begin()
+        token = self._tx.set(tx)
+        try:
+            yield
+        except BaseException:
+            self._tx.reset(token)
+            self.rollback(tx)
+            raise
+        self._tx.reset(token)
+        self.commit(tx)
+
+    def _execute_postgres(self, query: str, params: tuple, fetch: bool, fetchone: bool):
+        # Одна повторная попытка, если соединение оборвалось до выполнения запроса:
+        # незакоммиченная транзакция на сервере при обрыве откатывается, повтор безопасен
+        for attempt in range(2):
+            conn = self.pool.getconn()
+            try:
+                result = self._run_query(conn, query, params, fetch, fetchone)
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                self.pool.putconn(conn, broken=True)
+                if attempt:
+                    raise
+                logging.warning("Запрос прерван обрывом соединения, повторяем")
+                continue
+            except Exception:
+                self.pool.putconn(conn)
+                raise
+            try:
+                conn.commit()
+            except Exception:
+                self.pool.putconn(conn, broken=True)
+                raise
+            self.pool.putconn(conn)
+            return result
+
+    def stats(self) -> dict:
+        """Статистика слоя БД для мониторинга"""
+        return {
+            'backend': 'postgres' if self.use_postgres else 'sqlite',
+            'pool': self.pool.stats() if self.use_postgres else None,
+            'config_cache': self.config_cache.stats(),
+            'global_boosts': self.boosts.stats(),
+            'user_cache': self.user_cache.stats(),
+            'special_stock_cache': self.stock_cache.stats(),
+            'leaderboard': self.leaderboard.stats(),
+            'schema': {'version': self.schema_version, 'missing_indexes': self.missing_indexes},
+        }
+
+    # --- Пользователи (через LRU-кэш со сквозной записью) ---
     def get_user(self, user_id: int) -> Optional[Dict]:
-        row = self.execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
-        return dict(row) if row else None
+        record = self.user_cache.get(user_id)
+        if record is None:
+            return self.load_user(user_id)
+        return record.as_dict()
+
+    def load_user(self, user_id: int) -> Optional[Dict]:
+        """Читает строку users из БД и кладёт её в кэш, если её не изменили во время чтения"""
+        ticket = self.user_cache.begin_load(user_id)
+        record = None
+        try:
+            row = self.execute("SELECT * FROM users WHERE user_id = ?", (user_id,), fetchone=True)
+            if row:
+                record = UserRecord(row)
+        finally:
+            self.user_cache.end_load(user_id, ticket, record)
+        return record.as_dict() if record is not None else None
+
+    def _user_changed(self, user_id: int, **fields):
+        """Сквозная запись: переносит в кэш поля, только что записанные в users"""
+        # Параллельный load_user мог прочитать строку до этой записи (или до её
+        # коммита) — его результат в кэш не кладём
+        self.user_cache.changed(user_id)
+        self.on_commit(lambda: self.user_cache.changed(user_id))
+        record = self.user_cache.peek(user_id)
+        if record is not None:
+            for field, value in fields.items():
+                setattr(record, field, value)
+        if 'stars' in fields:
+            name = (record.username or record.first_name) if record is not None else None
+            self.on_commit(lambda: self.leaderboard.observe(user_id, fields['stars'], name))
+        # Откат транзакции вернёт строку в БД к старым значениям — кэш тоже сбрасываем
+        self.on_rollback(lambda: self.user_cache.pop(user_id))
+
+    def invalidate_user(self, user_id: int):
+        """Сбросить кэш пользователя после записи в users в обход методов Database"""
+        self.user_cache.pop(user_id)
+        self.on_commit(lambda: self.user_cache.pop(user_id))
+
+    def update_user(self, user_id: int, **fields):
+        """UPDATE users по именованным колонкам с обновлением кэша"""
+        unknown = set(fields) - set(UserRecord.FIELDS)
+        if unknown:
+            raise ValueError(f"Неизвестные колонки users: {unknown}")
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        self.execute(f"UPDATE users SET {assignments} WHERE user_id = ?", (*fields.values(), user_id))
+        self._user_changed(user_id, **fields)
+
+    def add_ref_boost(self, user_id: int, delta: float) -> Optional[float]:
+        row = self.execute(
+            "UPDATE users SET ref_boost = ref_boost + ? WHERE user_id = ? RETURNING ref_boost",
+            (delta, user_id), fetchone=True
+        )
+        if not row:
+            return None
+        self._user_changed(user_id, ref_boost=row['ref_boost'])
+        return float(row['ref_boost'])
 
     def get_user_safe(self, user_id: int) -> Optional[Dict]:
         """Возвращает пользователя со значениями по умолчанию для отсутствующих полей"""
-        user = self.get_user(user_id)
+        return self.with_defaults(self.get_user(user_id))
+
+    @staticmethod
+    def with_defaults(user: Optional[Dict]) -> Optional[Dict]:
         if not user:
             return None
         defaults = {
@@ -526,7 +1382,8 @@ class Database:
             'ref_boost': 1.0,
             'is_active': 0,
             'total_earned': 0.0,
-            'referred_by': None
+            'referred_by': None,
+            'reachable': 1
         }
         for key, default_value in defaults.items():
             if key not in user:
@@ -536,91 +1393,845 @@ class Database:
     def create_user(self, user_id: int, username: str, first_name: str, referred_by: int = None):
         ref_code = f"ref{user_id}"
         self.execute(
-            "INSERT OR IGNORE INTO users (user_id, username, first_name, ref_code, referred_by) VALUES (?, ?, ?, ?, ?)",
+            "INSERT INTO users (user_id, username, first_name, ref_code, referred_by) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (user_id) DO NOTHING",
             (user_id, username, first_name, ref_code, referred_by)
         )
+        self.invalidate_user(user_id)
 
     def add_stars(self, user_id: int, amount: float):
         if amount == 0:
             return
         if amount > 0:
-            user = self.get_user_safe(user_id)
-            if user:
-                boost = user.get('ref_boost', 1.0)
-                amount = amount * boost
-            self.execute("UPDATE users SET stars = stars + ? WHERE user_id = ?", (amount, user_id))
-            self.update_user_activity(user_id, amount)
+            # Начисление, активность и бонус рефереру — один коммит
+            with self.transaction():
+                user = self.get_user_safe(user_id)
+                if user:
+                    boost = user.get('ref_boost', 1.0)
+                    amount = amount * boost
+                # Баланс и заработок одним UPDATE, новые значения сразу в кэш
+                row = self.execute(
+                    "UPDATE users SET stars = stars + ?, total_earned = total_earned + ? WHERE user_id = ? "
+                    "RETURNING stars, total_earned, is_active",
+                    (amount, amount, user_id), fetchone=True
+                )
+                if row:
+                    self._user_changed(user_id, stars=row['stars'], total_earned=row['total_earned'])
+                    self._bump_stat('earned', user_id, amount)
+                    self._activate_if_ready(user_id, row)
         else:
-            self.execute("UPDATE users SET stars = stars + ? WHERE user_id = ?", (amount, user_id))
+            row = self.execute(
+                "UPDATE users SET stars = stars + ? WHERE user_id = ? RETURNING stars",
+                (amount, user_id), fetchone=True
+            )
+            if row:
+                self._user_changed(user_id, stars=row['stars'])
+
+    # --- Кошелёк: атомарные списания и зачисления ---
+    @staticmethod
+    def _wallet_amount(amount: float) -> float:
+        """Сумма для кошелька: конечное число больше нуля, иначе ValueError.
+        Отрицательное списание было бы зачислением, и наоборот."""
+        amount = float(amount)
+        if not math.isfinite(amount) or amount <= 0:
+            raise ValueError(f"Некорректная сумма: {amount!r}")
+        return amount
+
+    def try_debit(self, user_id: int, amount: float) -> Optional[float]:
+        """Списывает amount одним условным UPDATE, только если звёзд хватает.
+        Возвращает новый баланс или None, если не хватило (или нет пользователя)."""
+        amount = self._wallet_amount(amount)
+        row = self.execute(
+            "UPDATE users SET stars = stars - ? WHERE user_id = ? AND stars >= ? RETURNING stars",
+            (amount, user_id, amount), fetchone=True
+        )
+        if not row:
+            return None
+        self._user_changed(user_id, stars=row['stars'])
+        return float(row['stars'])
+
+    def credit(self, user_id: int, amount: float, reason: str = '') -> Optional[float]:
+        """Зачисляет amount как есть, без бустов и учёта в заработке (возвраты и т.п.).
+        Возвращает новый баланс или None, если пользователя нет."""
+        amount = self._wallet_amount(amount)
+        row = self.execute(
+            "UPDATE users SET stars = stars + ? WHERE user_id = ? RETURNING stars",
+            (amount, user_id), fetchone=True
+        )
+        if not row:
+            logging.warning(f"Зачисление {amount} ({reason}) пользователю {user_id}: пользователь не найден")
+            return None
+        self._user_changed(user_id, stars=row['stars'])
+        return float(row['stars'])
+
+    def take_item(self, user_id: int, item_name: str, quantity: int = 1) -> bool:
+        """Забирает предмет условным UPDATE, только если его хватает; пустую строку удаляет"""
+        row = self.execute(
+            "UPDATE inventory SET quantity = quantity - ? WHERE user_id = ? AND item_name = ? AND quantity >= ? "
+            "RETURNING quantity",
+            (quantity, user_id, item_name, quantity), fetchone=True
+        )
+        if not row:
+            return False
+        if row['quantity'] <= 0:
+            self.execute("DELETE FROM inventory WHERE user_id = ? AND item_name = ? AND quantity <= 0", (user_id, item_name))
+        return True
+
+    def add_item(self, user_id: int, item_name: str, quantity: int = 1):
+        """Добавляет предмет в инвентарь одним запросом (upsert)"""
+        self.execute(
+            "INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id, item_name) DO UPDATE SET quantity = inventory.quantity + excluded.quantity",
+            (user_id, item_name, quantity)
+        )
 
     def update_user_activity(self, user_id: int, earned: float):
-        self.execute("UPDATE users SET total_earned = total_earned + ? WHERE user_id = ?", (earned, user_id))
-        user = self.get_user_safe(user_id)
-        if user and user['total_earned'] >= 1.0 and not user['is_active']:
-            self.execute("UPDATE users SET is_active = 1 WHERE user_id = ?", (user_id,))
-            if user['referred_by']:
-                ref_reward = float(self.get_config('ref_reward', 5.0))
-                global_mult = self.get_global_boost('ref')
-                self.add_stars(user['referred_by'], ref_reward * global_mult)
+        row = self.execute(
+            "UPDATE users SET total_earned = total_earned + ? WHERE user_id = ? RETURNING total_earned, is_active",
+            (earned, user_id), fetchone=True
+        )
+        if row:
+            self._user_changed(user_id, total_earned=row['total_earned'])
+            self._bump_stat('earned', user_id, earned)
+            self._activate_if_ready(user_id, row)
+
+    def _activate_if_ready(self, user_id: int, row):
+        """Активация после первой заработанной звезды и бонус рефереру"""
+        if row['total_earned'] < 1.0 or row['is_active']:
+            return
+        # Условный UPDATE: при гонке бонус рефереру начислится ровно один раз
+        activated = self.execute(
+            "UPDATE users SET is_active = 1 WHERE user_id = ? AND is_active = 0 RETURNING referred_by",
+            (user_id,), fetchone=True
+        )
+        if not activated:
+            return
+        self._user_changed(user_id, is_active=1)
+        if activated['referred_by']:
+            referrer = self.execute(
+                "UPDATE users SET referrals = referrals + 1 WHERE user_id = ? RETURNING referrals",
+                (activated['referred_by'],), fetchone=True
+            )
+            if referrer:
+                self._user_changed(activated['referred_by'], referrals=referrer['referrals'])
+                self._bump_stat('refs', activated['referred_by'], 1)
+            ref_reward = self.config().get_float('ref_reward', 5.0)
+            global_mult = self.get_global_boost('ref')
+            self.add_stars(activated['referred_by'], ref_reward * global_mult)
+
+    # --- Статистика по корзинам (топы за день и неделю) ---
+    def _bump_stat(self, metric: str, user_id: int, value: float):
+        buckets = stat_buckets()
+        self.execute(
+            "INSERT INTO stat_buckets (metric, period, bucket, user_id, value) VALUES (?, 'day', ?, ?, ?), (?, 'week', ?, ?, ?) "
+            "ON CONFLICT (metric, period, bucket, user_id) DO UPDATE SET value = stat_buckets.value + excluded.value",
+            (metric, buckets['day'], user_id, value, metric, buckets['week'], user_id, value)
+        )
+
+    def get_stat_top(self, metric: str, period: str, size: int) -> List[Tuple[int, float, Optional[str]]]:
+        rows = self.execute("""
+            SELECT b.user_id, b.value, u.username, u.first_name
+            FROM stat_buckets b LEFT JOIN users u ON u.user_id = b.user_id
+            WHERE b.metric = ? AND b.period = ? AND b.bucket = ?
+            ORDER BY b.value DESC LIMIT ?
+        """, (metric, period, stat_buckets()[period], size), fetch=True)
+        return [(row['user_id'], float(row['value']), row['username'] or row['first_name']) for row in rows]
+
+    def prune_stat_buckets(self, keep_days: int = 7, keep_weeks: int = 8):
+        """Удаляет старые корзины; ключи сортируются как строки"""
+        now = datetime.utcnow()
+        self.execute("DELETE FROM stat_buckets WHERE period = 'day' AND bucket < ?",
+                     (stat_buckets(now - timedelta(days=keep_days))['day'],))
+        self.execute("DELETE FROM stat_buckets WHERE period = 'week' AND bucket < ?",
+                     (stat_buckets(now - timedelta(weeks=keep_weeks))['week'],))
+
+    # --- Настройки (через кэш) ---
+    def config(self) -> ConfigSnapshot:
+        snapshot = self.config_cache.current()
+        if snapshot is None:
+            generation = self.config_cache.generation
+            rows = self.execute("SELECT key, value FROM config", fetch=True)
+            snapshot = ConfigSnapshot({row['key']: row['value'] for row in rows})
+            # Незакоммиченные значения из транзакции в общий кэш не кладём
+            if not self.in_transaction():
+                self.config_cache.store(snapshot, generation)
+                # Бусты, выставленные другим процессом, подхватятся вместе с настройками
+                self.boosts.load(snapshot)
+        return snapshot
 
     def get_config(self, key: str, default: Any = None) -> Any:
-        row = self.execute("SELECT value FROM config WHERE key = ?", (key,), fetchone=True)
-        if row:
-            return row['value']
-        return default
+        return self.config().get(key, default)
+
+    def get_config_float(self, key: str, default: float) -> float:
+        return self.config().get_float(key, default)
 
     def set_config(self, key: str, value: str):
-        self.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
+        self.execute(
+            "INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value)
+        )
+        self.config_cache.invalidate()
+        # Пока транзакция не закоммичена, другой поток мог закэшировать старые значения
+        self.on_commit(self.config_cache.invalidate)
 
     def get_gifts_prices(self) -> dict:
-        try:
-            return json.loads(self.get_config('gifts_prices', '{}'))
-        except:
-            return {}
+        return self.config().gifts_prices()
 
     def get_special_items(self) -> dict:
-        try:
-            return json.loads(self.get_config('special_items', '{}'))
-        except:
-            return {}
+        return self.config().special_items()
 
     def get_withdrawal_options(self) -> list:
-        opt = self.get_config('withdrawal_options', '15,25,50,100')
-        return [int(x.strip()) for x in opt.split(',') if x.strip()]
+        return self.config().withdrawal_options()
+
+    # --- Эксклюзивы: материализованные счётчики продаж ---
+    def get_special_stock(self) -> Dict[str, dict]:
+        """Остатки всех эксклюзивов одним SELECT, результат — в кэш"""
+        rows = self.execute("SELECT item_key, item_limit, sold FROM special_stock", fetch=True)
+        stock = {row['item_key']: {'limit': row['item_limit'], 'sold': row['sold']} for row in rows}
+        if not self.in_transaction():
+            for key, entry in stock.items():
+                self.stock_cache.put(key, entry)
+        return stock
+
+    def reserve_special(self, item_key: str) -> Optional[dict]:
+        """Списывает одну единицу из лимита одним условным UPDATE.
+        None — товар распродан. Вызывать в транзакции покупки."""
+        row = self.execute(
+            "UPDATE special_stock SET sold = sold + 1 WHERE item_key = ? AND sold < item_limit "
+            "RETURNING item_limit, sold",
+            (item_key,), fetchone=True
+        )
+        if not row:
+            return None
+        # Кэш не перезаписываем: коммиты параллельных покупок приходят в любом
+        # порядке, и старый sold мог бы затереть новый. Перечитаем при показе.
+        self.on_commit(lambda: self.stock_cache.pop(item_key))
+        return {'limit': row['item_limit'], 'sold': row['sold']}
+
+    def set_special_limit(self, item_key: str, limit: int):
+        self.execute(
+            "INSERT INTO special_stock (item_key, item_limit, sold) VALUES (?, ?, 0) "
+            "ON CONFLICT (item_key) DO UPDATE SET item_limit = excluded.item_limit",
+            (item_key, limit)
+        )
+        self.on_commit(lambda: self.stock_cache.pop(item_key))
 
     def get_global_boost(self, boost_type: str) -> float:
-        mult_key = f'global_{boost_type}_mult'
-        until_key = f'global_{boost_type}_until'
-        mult = float(self.get_config(mult_key, 1.0))
-        until_str = self.get_config(until_key, '')
-        if until_str:
-            try:
-                until = datetime.fromisoformat(until_str)
-                if datetime.utcnow() > until:
-                    self.set_config(mult_key, '1.0')
-                    self.set_config(until_key, '')
-                    return 1.0
-            except:
-                pass
-        return mult
+        return self.boosts.get(boost_type)
 
     def set_global_boost(self, boost_type: str, multiplier: float, duration_seconds: int = None):
-        self.set_config(f'global_{boost_type}_mult', str(multiplier))
-        if duration_seconds:
-            until = (datetime.utcnow() + timedelta(seconds=duration_seconds)).isoformat()
-            self.set_config(f'global_{boost_type}_until', until)
-        else:
-            self.set_config(f'global_{boost_type}_until', '')
+        until = datetime.utcnow() + timedelta(seconds=duration_seconds) if duration_seconds else None
+        with self.transaction():
+            self.set_config(f'global_{boost_type}_mult', str(multiplier))
+            self.set_config(f'global_{boost_type}_until', until.isoformat() if until else '')
+            self.on_commit(lambda: self.boosts.apply(boost_type, multiplier, until))
 
     def disable_global_boost(self, boost_type: str):
-        self.set_config(f'global_{boost_type}_mult', '1.0')
-        self.set_config(f'global_{boost_type}_until', '')
+        with self.transaction():
+            self.set_config(f'global_{boost_type}_mult', '1.0')
+            self.set_config(f'global_{boost_type}_until', '')
+            self.on_commit(lambda: self.boosts.apply(boost_type, 1.0, None))
+
+    def reconcile_leaderboard(self):
+        """Сверка топа в памяти с БД (по индексу idx_users_stars)"""
+        rows = self.execute(
+            "SELECT user_id, username, first_name, stars FROM users ORDER BY stars DESC LIMIT ?",
+            (self.leaderboard.capacity,), fetch=True
+        )
+        self.leaderboard.load(rows)
+
+    def set_reachable(self, user_id: int, reachable: bool) -> bool:
+        """Отметить, доходят ли до пользователя сообщения. True — флаг изменился"""
+        flag = 1 if reachable else 0
+        row = self.execute(
+            "UPDATE users SET reachable = ? WHERE user_id = ? AND reachable <> ? RETURNING user_id",
+            (flag, user_id, flag), fetchone=True
+        )
+        if not row:
+            return False
+        self._user_changed(user_id, reachable=flag)
+        return True
+
+    def touch_user(self, user_id: int) -> bool:
+        """Обновляет last_seen. False — строки пользователя ещё нет"""
+        now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+        row = self.execute(
+            "UPDATE users SET last_seen = ? WHERE user_id = ? RETURNING user_id", (now, user_id), fetchone=True
+        )
+        if not row:
+            return False
+        self._user_changed(user_id, last_seen=now)
+        return True
+
+    # --- Рассылки ---
+    def count_segment(self, segment: str = '') -> int:
+        """Размер сегмента для превью перед рассылкой"""
+        where, params = Segment.parse(segment).to_sql()
+        return self.execute(f"SELECT COUNT(*) AS cnt FROM users WHERE reachable = 1{where}", params, fetchone=True)['cnt']
+
+    def create_broadcast(self, admin_id: int, from_chat_id: int, message_id: int,
+                         progress_chat_id: int, progress_message_id: int, segment: str = '') -> int:
+        total = self.count_segment(segment)
+        row = self.execute(
+            "INSERT INTO broadcast_jobs (admin_id, from_chat_id, message_id, total, progress_chat_id, progress_message_id, segment) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) RETURNING id",
+            (admin_id, from_chat_id, message_id, total, progress_chat_id, progress_message_id, segment), fetchone=True
+        )
+        return row['id']
+
+    def get_broadcast(self, job_id: int) -> Optional[Dict]:
+        row = self.execute("SELECT * FROM broadcast_jobs WHERE id = ?", (job_id,), fetchone=True)
+        return dict(row) if row else None
+
+    def get_running_broadcasts(self) -> List[int]:
+        rows = self.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id", fetch=True)
+        return [row['id'] for row in rows]
+
+    def broadcast_page(self, after_user_id: int, limit: int, segment: str = '') -> List[int]:
+        """Следующая страница получателей по ключу (keyset): без OFFSET и без загрузки всей таблицы"""
+        where, params = Segment.parse(segment).to_sql()
+        rows = self.execute(
+            f"SELECT user_id FROM users WHERE reachable = 1 AND user_id > ?{where} ORDER BY user_id LIMIT ?",
+            (after_user_id, *params, limit), fetch=True
+        )
+        return [row['user_id'] for row in rows]
+
+    def checkpoint_broadcast(self, job_id: int, last_user_id: int, sent: int, failed: int):
+        self.execute(
+            "UPDATE broadcast_jobs SET last_user_id = ?, sent = ?, failed = ? WHERE id = ?",
+            (last_user_id, sent, failed, job_id)
+        )
+
+    def finish_broadcast(self, job_id: int, status: str):
+        self.execute(
+            "UPDATE broadcast_jobs SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ? AND status = 'running'",
+            (status, job_id)
+        )
+
+    # --- Outbox ---
+    @staticmethod
+    def _utc(delay: float = 0) -> str:
+        return (datetime.utcnow() + timedelta(seconds=delay)).strftime('%Y-%m-%d %H:%M:%S')
+
+    def outbox_put(self, key: str, chat_id: Any, text: str,
+                   reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        """Кладёт сообщение в outbox в текущей транзакции. key — ключ идемпотентности:
+        повтор с тем же ключом ничего не добавляет и возвращает False."""
+        markup = reply_markup.model_dump_json(exclude_none=True) if reply_markup else None
+        row = self.execute(
+            "INSERT INTO outbox (idem_key, chat_id, text, reply_markup, next_attempt_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (idem_key) DO NOTHING RETURNING id",
+            (key, str(chat_id), text, markup, self._utc()), fetchone=True
+        )
+        if row and self.on_outbox:
+            self.on_commit(self.on_outbox)
+        return row is not None
+
+    def claim_outbox(self, limit: int, lease: float) -> List[Dict]:
+        """Забирает пачку готовых записей, откладывая их на lease секунд.
+        Если отправитель упадёт, по истечении lease записи заберут снова."""
+        # Несколько процессов бота на PostgreSQL: строки, уже забранные другим
+        # диспетчером, пропускаются, а не отправляются второй раз. В SQLite
+        # запись сериализована блокировкой базы, оговорка не нужна.
+        skip_locked = " FOR UPDATE SKIP LOCKED" if self.use_postgres else ""
+        rows = self.execute(
+            "UPDATE outbox SET attempts = attempts + 1, next_attempt_at = ? WHERE id IN ("
+            f"SELECT id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?{skip_locked}"
+            ") RETURNING id, idem_key, chat_id, text, reply_markup, attempts",
+            (self._utc(lease), self._utc(), limit), fetch=True
+        )
+        return sorted((dict(row) for row in rows), key=lambda row: row['id'])
+
+    def outbox_sent(self, ids: List[int]):
+        placeholders = ', '.join('?' * len(ids))
+        self.execute(
+            f"UPDATE outbox SET status = 'sent', sent_at = ?, last_error = NULL WHERE id IN ({placeholders})",
+            (self._utc(), *ids)
+        )
+
+    def outbox_failed(self, outbox_id: int, error: str, retry_in: Optional[float]):
+        """Неудачная попытка: повтор через retry_in секунд, None — больше не пытаться"""
+        status = 'pending' if retry_in is not None else 'failed'
+        self.execute(
+            "UPDATE outbox SET status = ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+            (status, self._utc(retry_in or 0), error[:500], outbox_id)
+        )
+
+    def prune_outbox(self, keep_days: int = 7):
+        self.execute("DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?", (self._utc(-keep_days * 86400),))
+
+    # --- Состояния FSM ---
+    def fsm_load(self, key: str, ttl: float) -> Optional[Dict]:
+        row = self.execute(
+            "SELECT state, data FROM fsm_states WHERE key = ? AND updated_at >= ?",
+            (key, self._utc(-ttl)), fetchone=True
+        )
+        return dict(row) if row else None
+
+    def fsm_save(self, records: List[Tuple[str, Optional[str], str]]):
+        """Пачка (key, state, data_json) одной транзакцией; пустое состояние удаляется"""
+        now = self._utc()
+        with self.transaction():
+            for key, state, data in records:
+                if state is None and data == '{}':
+                    self.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+                else:
+                    self.execute(
+                        "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                        "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                        "updated_at = excluded.updated_at",
+                        (key, state, data, now)
+                    )
+
+    def prune_fsm(self, ttl: float):
+        self.execute("DELETE FROM fsm_states WHERE updated_at < ?", (self._utc(-ttl),))
+
+    # --- Лотерея ---
+    def get_lottery(self) -> Optional[Dict]:
+        row = self.execute("SELECT round_id, pool, tickets, players FROM lottery WHERE id = 1", fetchone=True)
+        return dict(row) if row else None
+
+    def buy_lottery_ticket(self, user_id: int, price: float):
+        """Билет в текущий раунд: банк и счётчики в строке lottery, билеты игрока — одной строкой.
+        Внутри транзакции покупки присоединяется к ней."""
+        with self.transaction():
+            # UPDATE строки lottery первым: розыгрыш её тоже блокирует, билет не попадёт в закрытый раунд
+            lottery = self.execute(
+                "UPDATE lottery SET pool = pool + ?, tickets = tickets + 1 WHERE id = 1 RETURNING round_id",
+                (price,), fetchone=True
+            )
+            row = self.execute(
+                "INSERT INTO lottery_tickets (round_id, user_id, tickets) VALUES (?, ?, 1) "
+                "ON CONFLICT (round_id, user_id) DO UPDATE SET tickets = lottery_tickets.tickets + 1 "
+                "RETURNING tickets",
+                (lottery['round_id'], user_id), fetchone=True
+            )
+            if row['tickets'] == 1:
+                self.execute("UPDATE lottery SET players = players + 1 WHERE id = 1")
+            self.execute("INSERT INTO lottery_history (user_id) VALUES (?)", (user_id,))
+
+    def draw_lottery(self, share: float = 0.8) -> Optional[Tuple[int, float]]:
+        """Розыгрыш: победитель выбирается с весом по числу билетов. Билеты в Python
+        не загружаются — случайный номер билета ищется по нарастающей сумме в SQL.
+        Возвращает (победитель, выигрыш) или None, если билетов нет."""
+        with self.transaction():
+            # Пустой UPDATE вместо SELECT ... FOR UPDATE: блокирует строку в обеих СУБД
+            lottery = self.execute(
+                "UPDATE lottery SET pool = pool WHERE id = 1 RETURNING round_id, pool, tickets", fetchone=True
+            )
+            if not lottery or not lottery['tickets']:
+                return None
+            ticket_no = random.randrange(lottery['tickets'])
+            winner = self.execute("""
+                SELECT user_id FROM (
+                    SELECT user_id, SUM(tickets) OVER (ORDER BY user_id) AS upto
+                    FROM lottery_tickets WHERE round_id = ?
+                ) ranked WHERE upto > ? ORDER BY upto LIMIT 1
+            """, (lottery['round_id'], ticket_no), fetchone=True)
+            if not winner:
+                logging.error(f"Лотерея: счётчик билетов ({lottery['tickets']}) разошёлся с lottery_tickets")
+                return None
+            self.execute(
+                "UPDATE lottery SET round_id = round_id + 1, pool = 0, tickets = 0, players = 0 WHERE id = 1"
+            )
+            self.execute("DELETE FROM lottery_tickets WHERE round_id = ?", (lottery['round_id'],))
+            win_amount = lottery['pool'] * share
+            self.add_stars(winner['user_id'], win_amount)
+            return winner['user_id'], win_amount
 
     def log_admin(self, admin_id: int, action: str, details: str = ''):
         self.execute("INSERT INTO admin_logs (admin_id, action, details) VALUES (?, ?, ?)", (admin_id, action, details))
 
+
+class OperationDeclined(Exception):
+    """Операция отклонена (не хватает звёзд, лот уже продан и т.п.).
+    Бросается внутри db.transaction(), чтобы откатить уже сделанные записи;
+    текст исключения показывается пользователю."""
+
+
+class AsyncDatabase:
+    """Асинхронная обёртка над Database.
+
+    Все запросы выполняются в выделенном потоке БД, поэтому медленный запрос
+    одного пользователя не блокирует event loop и апдейты остальных.
+    Набор методов повторяет Database, только каждый из них нужно await-ить.
+    """
+
+    def __init__(self, sync_db: Database):
+        self.sync = sync_db
+        # SQLite — одно соединение и один поток; PostgreSQL — по потоку на соединение пула
+        self._executor = ThreadPoolExecutor(max_workers=sync_db.max_connections, thread_name_prefix="db")
+        # Соединение занимается здесь, до передачи в поток: иначе все потоки могут
+        # повиснуть в getconn, пока открытые транзакции ждут поток под свой COMMIT.
+        # Открытая транзакция держит слот до конца, её запросы идут без очереди.
+        # На SQLite слот один — чужие запросы не попадут в открытую транзакцию.
+        self._conn_slots = asyncio.Semaphore(sync_db.max_connections)
+
+    @property
+    def use_postgres(self) -> bool:
+        return self.sync.use_postgres
+
+    async def _submit(self, func, *args, **kwargs):
+        # Контекст копируется, чтобы поток БД видел открытую транзакцию
+        loop = asyncio.get_running_loop()
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await loop.run_in_executor(self._executor, call)
+
+    async def _run(self, func, *args, **kwargs):
+        if self.sync.in_transaction():
+            return await self._submit(func, *args, **kwargs)
+        async with self._conn_slots:
+            return await self._submit(func, *args, **kwargs)
+
+    @asynccontextmanager
+    async def transaction(self):
+        """Единица работы: все запросы внутри блока уходят одной транзакцией
+        с одним коммитом, при исключении всё откатывается.
+
+            async with db.transaction():
+                await db.add_stars(buyer_id, -price)
+                await db.add_item(buyer_id, item)
+
+        Вложенный transaction() присоединяется к внешнему. Внутри блока не стоит
+        ходить в Telegram: на SQLite остальные запросы ждут коммита.
+        """
+        if self.sync.in_transaction():
+            yield
+            return
+        async with self._conn_slots:
+            tx = await self._submit(self.sync.begin)
+            token = self.sync._tx.set(tx)
+            try:
+                yield
+            except BaseException:
+                self.sync._tx.reset(token)
+                await self._submit(self.sync.rollback, tx)
+                raise
+            self.sync._tx.reset(token)
+            await self._submit(self.sync.commit, tx)
+
+    def start(self):
+        """Привязка к запущенному event loop (таймеры бустов, сверка топа)"""
+        self.sync.boosts.attach(asyncio.get_running_loop())
+        self._leaderboard_task = asyncio.create_task(self._leaderboard_loop())
+
+    async def _leaderboard_loop(self):
+        while True:
+            try:
+                await self._run(self.sync.reconcile_leaderboard)
+                await self._run(self.sync.prune_stat_buckets)
+            except Exception as e:
+                logging.error(f"Ошибка сверки топа: {e}")
+            await asyncio.sleep(LEADERBOARD_RECONCILE)
+
+    async def top_users(self, size: int) -> List[Tuple[int, float, Optional[str]]]:
+        if not self.sync.leaderboard.loaded:
+            await self._run(self.sync.reconcile_leaderboard)
+        top = self.sync.leaderboard.top(size)
+        # Попавшие в топ после сверки могут быть без имени — подтягиваем один раз
+        for i, (user_id, stars, name) in enumerate(top):
+            if name is None:
+                user = await self.get_user(user_id)
+                name = (user['username'] or user['first_name']) if user else None
+                self.sync.leaderboard.set_name(user_id, name or '')
+                top[i] = (user_id, stars, name)
+        return top
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self.sync.use_postgres:
+            self.sync.pool.closeall()
+
+    def stats(self) -> dict:
+        return self.sync.stats()
+
+    async def execute(self, query: str, params: tuple = (), fetch: bool = False, fetchone: bool = False):
+        return await self._run(self.sync.execute, query, params, fetch=fetch, fetchone=fetchone)
+
+    async def get_user(self, user_id: int) -> Optional[Dict]:
+        # Попадание в кэш отдаётся прямо из памяти, без похода в поток БД
+        record = self.sync.user_cache.get(user_id)
+        if record is not None:
+            return record.as_dict()
+        return await self._run(self.sync.load_user, user_id)
+
+    async def get_user_safe(self, user_id: int) -> Optional[Dict]:
+        # Промах или устаревшая запись кэша читается в потоке БД, как в get_user
+        return self.sync.with_defaults(await self.get_user(user_id))
+
+    async def update_user(self, user_id: int, **fields):
+        return await self._run(self.sync.update_user, user_id, **fields)
+
+    async def add_ref_boost(self, user_id: int, delta: float) -> Optional[float]:
+        return await self._run(self.sync.add_ref_boost, user_id, delta)
+
+    async def invalidate_user(self, user_id: int):
+        return await self._run(self.sync.invalidate_user, user_id)
+
+    async def create_user(self, user_id: int, username: str, first_name: str, referred_by: int = None):
+        return await self._run(self.sync.create_user, user_id, username, first_name, referred_by)
+
+    async def add_stars(self, user_id: int, amount: float):
+        return await self._run(self.sync.add_stars, user_id, amount)
+
+    async def try_debit(self, user_id: int, amount: float) -> Optional[float]:
+        return await self._run(self.sync.try_debit, user_id, amount)
+
+    async def credit(self, user_id: int, amount: float, reason: str = '') -> Optional[float]:
+        return await self._run(self.sync.credit, user_id, amount, reason)
+
+    async def take_item(self, user_id: int, item_name: str, quantity: int = 1) -> bool:
+        return await self._run(self.sync.take_item, user_id, item_name, quantity)
+
+    async def add_item(self, user_id: int, item_name: str, quantity: int = 1):
+        return await self._run(self.sync.add_item, user_id, item_name, quantity)
+
+    async def update_user_activity(self, user_id: int, earned: float):
+        return await self._run(self.sync.update_user_activity, user_id, earned)
+
+    async def config(self) -> ConfigSnapshot:
+        # Свежий снимок отдаётся прямо из памяти, без похода в поток БД
+        snapshot = self.sync.config_cache.current()
+        if snapshot is None:
+            snapshot = await self._run(self.sync.config)
+        return snapshot
+
+    async def get_config(self, key: str, default: Any = None) -> Any:
+        return (await self.config()).get(key, default)
+
+    async def get_config_float(self, key: str, default: float) -> float:
+        return (await self.config()).get_float(key, default)
+
+    async def set_config(self, key: str, value: str):
+        return await self._run(self.sync.set_config, key, value)
+
+    async def get_gifts_prices(self) -> dict:
+        return (await self.config()).gifts_prices()
+
+    async def get_special_items(self) -> dict:
+        return (await self.config()).special_items()
+
+    async def get_withdrawal_options(self) -> list:
+        return (await self.config()).withdrawal_options()
+
+    async def get_special_stock(self, keys) -> Dict[str, dict]:
+        # Если в кэше есть все нужные товары — отдаём из памяти
+        cached = {key: self.sync.stock_cache.get(key) for key in keys}
+        if all(entry is not None for entry in cached.values()):
+            return cached
+        return await self._run(self.sync.get_special_stock)
+
+    async def reserve_special(self, item_key: str) -> Optional[dict]:
+        return await self._run(self.sync.reserve_special, item_key)
+
+    async def set_special_limit(self, item_key: str, limit: int):
+        return await self._run(self.sync.set_special_limit, item_key, limit)
+
+    async def get_global_boost(self, boost_type: str) -> float:
+        return self.sync.get_global_boost(boost_type)
+
+    async def set_global_boost(self, boost_type: str, multiplier: float, duration_seconds: int = None):
+        return await self._run(self.sync.set_global_boost, boost_type, multiplier, duration_seconds)
+
+    async def disable_global_boost(self, boost_type: str):
+        return await self._run(self.sync.disable_global_boost, boost_type)
+
+    async def get_stat_top(self, metric: str, period: str, size: int) -> List[Tuple[int, float, Optional[str]]]:
+        return await self._run(self.sync.get_stat_top, metric, period, size)
+
+    async def set_reachable(self, user_id: int, reachable: bool) -> bool:
+        return await self._run(self.sync.set_reachable, user_id, reachable)
+
+    async def touch_user(self, user_id: int) -> bool:
+        return await self._run(self.sync.touch_user, user_id)
+
+    async def count_segment(self, segment: str = '') -> int:
+        return await self._run(self.sync.count_segment, segment)
+
+    async def create_broadcast(self, admin_id: int, from_chat_id: int, message_id: int,
+                               progress_chat_id: int, progress_message_id: int, segment: str = '') -> int:
+        return await self._run(self.sync.create_broadcast, admin_id, from_chat_id, message_id,
+                               progress_chat_id, progress_message_id, segment)
+
+    async def get_broadcast(self, job_id: int) -> Optional[Dict]:
+        return await self._run(self.sync.get_broadcast, job_id)
+
+    async def get_running_broadcasts(self) -> List[int]:
+        return await self._run(self.sync.get_running_broadcasts)
+
+    async def broadcast_page(self, after_user_id: int, limit: int, segment: str = '') -> List[int]:
+        return await self._run(self.sync.broadcast_page, after_user_id, limit, segment)
+
+    async def checkpoint_broadcast(self, job_id: int, last_user_id: int, sent: int, failed: int):
+        return await self._run(self.sync.checkpoint_broadcast, job_id, last_user_id, sent, failed)
+
+    async def finish_broadcast(self, job_id: int, status: str):
+        return await self._run(self.sync.finish_broadcast, job_id, status)
+
+    async def outbox_put(self, key: str, chat_id: Any, text: str,
+                         reply_markup: Optional[InlineKeyboardMarkup] = None) -> bool:
+        return await self._run(self.sync.outbox_put, key, chat_id, text, reply_markup)
+
+    async def claim_outbox(self, limit: int, lease: float) -> List[Dict]:
+        return await self._run(self.sync.claim_outbox, limit, lease)
+
+    async def outbox_sent(self, ids: List[int]):
+        return await self._run(self.sync.outbox_sent, ids)
+
+    async def outbox_failed(self, outbox_id: int, error: str, retry_in: Optional[float]):
+        return await self._run(self.sync.outbox_failed, outbox_id, error, retry_in)
+
+    async def prune_outbox(self, keep_days: int = 7):
+        return await self._run(self.sync.prune_outbox, keep_days)
+
+    async def fsm_load(self, key: str, ttl: float) -> Optional[Dict]:
+        return await self._run(self.sync.fsm_load, key, ttl)
+
+    async def fsm_save(self, records: List[Tuple[str, Optional[str], str]]):
+        return await self._run(self.sync.fsm_save, records)
+
+    async def prune_fsm(self, ttl: float):
+        return await self._run(self.sync.prune_fsm, ttl)
+
+    async def get_lottery(self) -> Optional[Dict]:
+        return await self._run(self.sync.get_lottery)
+
+    async def buy_lottery_ticket(self, user_id: int, price: float):
+        return await self._run(self.sync.buy_lottery_ticket, user_id, price)
+
+    async def draw_lottery(self, share: float = 0.8) -> Optional[Tuple[int, float]]:
+        return await self._run(self.sync.draw_lottery, share)
+
+    async def log_admin(self, admin_id: int, action: str, details: str = ''):
+        return await self._run(self.sync.log_admin, admin_id, action, details)
+
 # ========== ИНИЦИАЛИЗАЦИЯ БД ==========
-db = Database()
+db = AsyncDatabase(Database())
+
+
+# ========== ХРАНИЛИЩЕ FSM ==========
+class DatabaseStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states вместо MemoryStorage.
+
+    Незаконченные сценарии (промокод, цена на P2P, чек, мастер квестов,
+    черновик рассылки) переживают перезапуск и видны всем процессам бота.
+    Запись отложенная: изменения копятся в памяти и раз в flush_interval
+    уходят в БД одной транзакцией, так что set_state + update_data одного
+    хендлера — одна запись. Чтение — из ещё не записанных изменений, затем
+    из LRU-кеша (cache_ttl), затем из БД. Состояние, не менявшееся дольше
+    ttl, считается брошенным: не читается и раз в час удаляется.
+
+    Другой процесс видит изменения с задержкой до flush_interval + cache_ttl.
+    Если апдейты одного пользователя могут попасть в разные процессы,
+    ставьте FSM_CACHE_TTL=0 или используйте REDIS_URL.
+    """
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, database: AsyncDatabase, ttl: float, cache_ttl: float, flush_interval: float):
+        self.db = database
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        # key -> (state, data); данные не меняются на месте, только заменяются
+        self._cache = LRUCache(10000, cache_ttl)
+        self._pending: Dict[str, Tuple[Optional[str], Dict[str, Any]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.loads = 0
+        self.flushes = 0
+        self.written = 0
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id, key.business_connection_id, key.destiny)
+        return ':'.join('' if part is None else str(part) for part in parts)
+
+    async def _record(self, key: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        if key in self._pending:
+            return self._pending[key]
+        record = self._cache.get(key)
+        if record is None:
+            row = await self.db.fsm_load(key, self.ttl)
+            self.loads += 1
+            record = (row['state'], json.loads(row['data'] or '{}')) if row else (None, {})
+            self._cache.put(key, record)
+        return record
+
+    def _write(self, key: str, record: Tuple[Optional[str], Dict[str, Any]]):
+        self._pending[key] = record
+        self._cache.put(key, record)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        _, data = await self._record(storage_key)
+        self._write(storage_key, (state.state if isinstance(state, State) else state, data))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._record(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        state, _ = await self._record(storage_key)
+        self._write(storage_key, (state, data.copy()))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return (await self._record(self._key(key)))[1].copy()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def flush(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        records = [(key, state, json.dumps(data, ensure_ascii=False)) for key, (state, data) in batch.items()]
+        try:
+            await self.db.fsm_save(records)
+        except Exception:
+            # Вернуть несохранённое, не затирая то, что успели поменять за время записи
+            for key, record in batch.items():
+                self._pending.setdefault(key, record)
+            raise
+        self.flushes += 1
+        self.written += len(records)
+
+    async def _run(self):
+        pruned_at = 0.0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - pruned_at > self.PRUNE_INTERVAL:
+                    await self.db.prune_fsm(self.ttl)
+                    pruned_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Ошибка записи состояний FSM: {e}")
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self._pending),
+            'cache': self._cache.stats(),
+            'loads': self.loads,
+            'flushes': self.flushes,
+            'written': self.written,
+        }
+
+
+def create_fsm_storage() -> BaseStorage:
+    if REDIS_URL:
+        if REDIS_AVAILABLE:
+            return RedisStorage.from_url(REDIS_URL, state_ttl=int(FSM_TTL), data_ttl=int(FSM_TTL))
+        logging.warning("REDIS_URL задан, но пакет redis не установлен — состояния FSM хранятся в БД")
+    return DatabaseStorage(db, FSM_TTL, FSM_CACHE_TTL, FSM_FLUSH_INTERVAL)
+
+
+fsm_storage = create_fsm_storage()
 
 
 # ========== СОСТОЯНИЯ FSM ==========
@@ -628,6 +2239,7 @@ class AdminStates(StatesGroup):
     waiting_fake_name = State()
     waiting_give_data = State()
     waiting_broadcast_msg = State()
+    waiting_broadcast_segment = State()
     waiting_channel_post = State()
     waiting_promo_data = State()
     waiting_config_key = State()
@@ -669,7 +2281,389 @@ class CheckStates(StatesGroup):
 
 # ========== ИНИЦИАЛИЗАЦИЯ БОТА ==========
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
+dp = Dispatcher(storage=fsm_storage)
+
+
+class BotIdentity:
+    """Данные самого бота (get_me). Запрашиваются один раз в main(), дальше берутся из памяти.
+    refresh() перечитывает их, например после смены username в BotFather."""
+
+    def __init__(self):
+        self.me: Optional[User] = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> User:
+        async with self._lock:
+            self.me = await bot.get_me()
+        return self.me
+
+    async def get(self) -> User:
+        return self.me if self.me is not None else await self.refresh()
+
+    async def deep_link(self, payload: str) -> str:
+        """Ссылка t.me/<бот>?start=<payload>; payload разбирает cmd_start"""
+        return f"https://t.me/{(await self.get()).username}?start={payload}"
+
+    async def ref_link(self, ref_code: str) -> str:
+        return await self.deep_link(ref_code)
+
+    async def duel_link(self, user_id: int) -> str:
+        return await self.deep_link(f"duel{user_id}")
+
+    async def check_link(self, check_id: str) -> str:
+        return await self.deep_link(f"check_{check_id}")
+
+
+identity = BotIdentity()
+
+
+# ========== МИДЛВАРИ ==========
+class LastSeenMiddleware(BaseMiddleware):
+    """Отмечает время последнего захода (users.last_seen) для сегментов рассылки.
+    Пишет не чаще раза в resolution секунд на пользователя и не задерживает апдейт."""
+
+    def __init__(self, resolution: float):
+        self._recent = LRUCache(USER_CACHE_SIZE, resolution)
+        self._pending: set = set()
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is not None and self._recent.get(user.id) is None:
+            self._recent.put(user.id, True)
+            task = asyncio.create_task(self._touch(user.id))
+            self._pending.add(task)
+            task.add_done_callback(self._pending.discard)
+        return await handler(event, data)
+
+    async def _touch(self, user_id: int):
+        try:
+            # Новичка ещё нет в users (его создаст /start) — отметим на следующем апдейте
+            if await db.touch_user(user_id):
+                return
+        except Exception as e:
+            logging.warning(f"Не удалось обновить last_seen {user_id}: {e}")
+        self._recent.pop(user_id)
+
+
+class KeyedLock:
+    """asyncio.Lock на каждый ключ. Запись живёт, пока блокировку кто-то держит или ждёт,
+    и удаляется сразу после — память растёт только с числом активных ключей.
+
+        async with locks(user_id):
+            ...
+    """
+
+    def __init__(self):
+        self._locks: Dict[Any, List] = {}  # ключ -> [Lock, сколько держат и ждут]
+        self.acquired = 0
+        self.contended = 0
+
+    @asynccontextmanager
+    async def __call__(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                self.acquired += 1
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def stats(self) -> dict:
+        return {'active': len(self._locks), 'acquired': self.acquired, 'contended': self.contended}
+
+
+class UserSerialMiddleware(BaseMiddleware):
+    """Апдейты одного пользователя обрабатываются строго по очереди, разных — параллельно.
+    Хендлеры меняют баланс по схеме «прочитал — записал», и два быстрых нажатия
+    (casino_spin_10, buy_p2p_) не должны пересекаться."""
+
+    def __init__(self):
+        self.locks = KeyedLock()
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        async with self.locks(user.id):
+            return await handler(event, data)
+
+
+user_serial = UserSerialMiddleware()
+
+
+# Лимиты на дорогие кнопки: префикс callback_data -> (нажатий в секунду, всплеск)
+THROTTLE_RULES = {
+    'casino_spin_': (1.0, 3),
+    'luck': (0.5, 2),
+    'daily': (0.5, 2),
+    'buy_ticket': (2.0, 5),
+    'top': (0.5, 3),  # top, top_day, top_week, top_refs
+}
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Антифлуд для дорогих кнопок.
+
+    На каждую пару (пользователь, префикс из rules) — своё ведро токенов в
+    памяти. Лишнее нажатие получает пустой call.answer и до хендлера (и БД)
+    не доходит. Если передан redis (общее хранилище FSM), лимит считается
+    там окном фиксированной длины и общий для всех процессов; при ошибке
+    Redis — локальное ведро. Стоит раньше UserSerialMiddleware, чтобы спам
+    не вставал в очередь за блокировкой пользователя.
+    """
+
+    def __init__(self, rules: Dict[str, Tuple[float, float]], redis=None):
+        # Длинные префиксы проверяются первыми
+        self.rules = sorted(rules.items(), key=lambda rule: -len(rule[0]))
+        self.redis = redis
+        self._buckets = LRUCache(USER_CACHE_SIZE, 600)
+        self.passed = 0
+        self.dropped: Dict[str, int] = {}
+
+    def _match(self, data: str) -> Optional[Tuple[str, Tuple[float, float]]]:
+        for prefix, rule in self.rules:
+            if data.startswith(prefix):
+                return prefix, rule
+        return None
+
+    async def _allow(self, user_id: int, prefix: str, rate: float, burst: float) -> bool:
+        if self.redis is not None:
+            window = max(1, round(burst / rate))
+            key = f"throttle:{prefix}:{user_id}:{int(time.time() // window)}"
+            try:
+                count = await self.redis.incr(key)
+                if count == 1:
+                    await self.redis.expire(key, window)
+                return count <= burst
+            except Exception as e:
+                logging.warning(f"Антифлуд: Redis недоступен, считаем локально: {e}")
+        bucket = self._buckets.get((user_id, prefix))
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            self._buckets.put((user_id, prefix), bucket)
+        return bucket.try_acquire() == 0
+
+    async def __call__(self, handler, event, data):
+        call = event.callback_query
+        match = self._match(call.data) if call is not None and call.data else None
+        if match is None:
+            return await handler(event, data)
+        prefix, (rate, burst) = match
+        if await self._allow(call.from_user.id, prefix, rate, burst):
+            self.passed += 1
+            return await handler(event, data)
+        self.dropped[prefix] = self.dropped.get(prefix, 0) + 1
+        with suppress(TelegramBadRequest):
+            await call.answer("⏳ Не так быстро")
+        return None
+
+    def stats(self) -> dict:
+        return {
+            'backend': 'redis' if self.redis is not None else 'memory',
+            'passed': self.passed,
+            'dropped': dict(self.dropped),
+        }
+
+
+class CallbackDedupMiddleware(BaseMiddleware):
+    """
+    Отбрасывает повторы одного и того же нажатия: клиент Telegram переотправляет
+    callback на плохой сети, пользователь жмёт дважды. Ключ — (пользователь,
+    callback_data, сообщение). Повтор получает пустой call.answer и до хендлера
+    не доходит.
+
+    Виденные ключи — в двух корзинах-множествах: текущей и предыдущей. Раз в
+    window (или когда текущая заполнилась до maxsize) предыдущая выбрасывается
+    целиком, поэтому память ограничена, а ключ помнится от window до 2 * window.
+    """
+
+    def __init__(self, window: float, maxsize: int = 50000):
+        self.window = window
+        self.maxsize = maxsize
+        self._current: set = set()
+        self._previous: set = set()
+        self._rotated_at = time.monotonic()
+        self.dropped = 0
+
+    def _seen(self, key: tuple) -> bool:
+        now = time.monotonic()
+        if now - self._rotated_at >= self.window or len(self._current) >= self.maxsize:
+            # Простояли дольше двух окон — устарели обе корзины
+            self._previous = self._current if now - self._rotated_at < 2 * self.window else set()
+            self._current = set()
+            self._rotated_at = now
+        if key in self._current or key in self._previous:
+            return True
+        self._current.add(key)
+        return False
+
+    async def __call__(self, handler, event, data):
+        call = event.callback_query
+        if call is None:
+            return await handler(event, data)
+        message_ref = call.message.message_id if call.message else call.inline_message_id
+        if not self._seen((call.from_user.id, call.data, message_ref)):
+            return await handler(event, data)
+        self.dropped += 1
+        with suppress(TelegramBadRequest):
+            await call.answer()
+        return None
+
+    def stats(self) -> dict:
+        return {'window': self.window, 'tracked': len(self._current) + len(self._previous), 'dropped': self.dropped}
+
+
+callback_dedup = CallbackDedupMiddleware(CALLBACK_DEDUP_WINDOW)
+
+throttling = ThrottlingMiddleware(
+    THROTTLE_RULES,
+    redis=fsm_storage.redis if REDIS_AVAILABLE and isinstance(fsm_storage, RedisStorage) else None,
+)
+
+dp.update.outer_middleware(callback_dedup)
+dp.update.outer_middleware(throttling)
+dp.update.outer_middleware(LastSeenMiddleware(LAST_SEEN_RESOLUTION))
+dp.update.outer_middleware(user_serial)
+
+
+# ========== МАРШРУТИЗАЦИЯ КНОПОК ==========
+class CallbackPayload(NamedTuple):
+    """Разобранная callback_data: action — значение или префикс маршрута, args — типизированный хвост"""
+    action: str
+    args: tuple
+
+
+class CallbackRoute:
+    __slots__ = ('handler', 'action', 'types', 'required', 'state', 'wants_state', 'wants_payload')
+
+    def __init__(self, handler, action: str, types: tuple, state: Optional[State], optional: tuple = ()):
+        self.handler = handler
+        self.action = action
+        self.types = types + optional
+        self.required = len(types)
+        self.state = state
+        params = inspect.signature(handler).parameters
+        self.wants_state = 'state' in params
+        self.wants_payload = 'payload' in params
+
+    def parse(self, tail: str) -> tuple:
+        """Хвост после префикса -> аргументы. Последний аргумент забирает остаток
+        вместе с '_' (названия предметов), лишних частей не бывает. Не хватает
+        обязательных аргументов или значение не приводится к типу — ValueError,
+        маршрут не подходит. Отсутствующие необязательные аргументы — None."""
+        if not self.types:
+            if tail:
+                raise ValueError(tail)
+            return ()
+        parts = tail.split('_', len(self.types) - 1) if tail else []
+        if len(parts) < self.required:
+            raise ValueError(f"нужно аргументов: {self.required}, есть {len(parts)}")
+        args = tuple(cast(part) for cast, part in zip(self.types, parts))
+        return args + (None,) * (len(self.types) - len(args))
+
+
+class CallbackRouter:
+    """
+    Маршрутизация нажатий без перебора фильтров.
+
+    Точные значения callback_data лежат в словаре, префиксы — в префиксном
+    дереве по символам. Поиск стоит O(длины callback_data) и не зависит от
+    числа хендлеров, а из пересекающихся префиксов выигрывает самый длинный.
+    Хвост после префикса один раз разбирается по типам маршрута и приходит
+    в хендлер как payload; длина payload.args всегда равна числу типов.
+    Необязательные хвостовые аргументы объявляются в optional и приходят как
+    None, если их нет. Маршрут с state срабатывает только в этом состоянии FSM,
+    иначе пробуется более короткий.
+
+        @callbacks.prefix("buy_p2p_", int)
+        async def cb_buy_p2p(call: CallbackQuery, payload: CallbackPayload):
+            order_id, = payload.args
+
+    Хендлер получает state и payload, только если объявил такие параметры,
+    поэтому его можно вызывать и напрямую: await cb_p2p_market(call).
+    """
+
+    def __init__(self):
+        self._exact: Dict[str, List[CallbackRoute]] = {}
+        # символ -> узел; под ключом None — маршруты префикса, который кончается в этом узле
+        self._trie: Dict[Any, Any] = {}
+        self.routed = 0
+        self.unmatched = 0
+
+    def exact(self, *values: str, state: Optional[State] = None):
+        def decorator(handler):
+            for value in values:
+                self._exact.setdefault(value, []).append(CallbackRoute(handler, value, (), state))
+            return handler
+        return decorator
+
+    def prefix(self, prefix: str, *types, optional: tuple = (), state: Optional[State] = None):
+        def decorator(handler):
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node.setdefault(None, []).append(CallbackRoute(handler, prefix, types, state, optional))
+            return handler
+        return decorator
+
+    def _candidates(self, data: str):
+        """Маршруты-кандидаты: точное совпадение, затем префиксы от длинного к короткому"""
+        for route in self._exact.get(data, ()):
+            yield route, ''
+        matched = []
+        node = self._trie
+        for i, char in enumerate(data):
+            node = node.get(char)
+            if node is None:
+                break
+            if None in node:
+                matched.append((i + 1, node[None]))
+        for end, routes in reversed(matched):
+            for route in routes:
+                yield route, data[end:]
+
+    async def dispatch(self, call: CallbackQuery, state: FSMContext):
+        current_state = None
+        for route, tail in self._candidates(call.data or ''):
+            if route.state is not None:
+                if current_state is None:
+                    current_state = await state.get_state() or ''
+                if current_state != route.state.state:
+                    continue
+            try:
+                args = route.parse(tail)
+            except ValueError:
+                continue
+            self.routed += 1
+            kwargs = {}
+            if route.wants_state:
+                kwargs['state'] = state
+            if route.wants_payload:
+                kwargs['payload'] = CallbackPayload(route.action, args)
+            return await route.handler(call, **kwargs)
+        self.unmatched += 1
+        logging.info(f"Кнопка без обработчика: {call.data!r}")
+        await call.answer()
+
+    def stats(self) -> dict:
+        return {
+            'exact': len(self._exact),
+            'routed': self.routed,
+            'unmatched': self.unmatched,
+        }
+
+
+callbacks = CallbackRouter()
+# Единственный хендлер callback_query: дальше выбирает CallbackRouter
+dp.callback_query.register(callbacks.dispatch)
 
 
 # ========== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
@@ -722,6 +2716,412 @@ def get_admin_decision_kb(uid: int, amount: Any) -> InlineKeyboardMarkup:
     return builder.as_markup()
 
 
+# ========== ИСХОДЯЩИЕ СООБЩЕНИЯ И РАССЫЛКИ ==========
+def classify_send_error(error: Exception) -> str:
+    """Причина недоставки: 'blocked' — бот заблокирован или аккаунт удалён,
+    'not_found' — чата нет, 'retry' — флуд-лимит, 'transient' — сеть/сервер Telegram"""
+    if isinstance(error, TelegramRetryAfter):
+        return 'retry'
+    if isinstance(error, TelegramForbiddenError):
+        return 'blocked'
+    if isinstance(error, TelegramBadRequest) and 'chat not found' in str(error).lower():
+        return 'not_found'
+    return 'transient'
+
+# После этих ошибок писать пользователю бесполезно, пока он сам не нажмёт /start
+UNREACHABLE_ERRORS = ('blocked', 'not_found')
+
+
+async def mark_send_failure(user_id: int, error: Exception) -> str:
+    kind = classify_send_error(error)
+    if kind in UNREACHABLE_ERRORS:
+        await db.set_reachable(user_id, False)
+    return kind
+
+
+class TokenBucket:
+    """Ведро токенов для asyncio: rate отправок в секунду, всплеск до capacity.
+    После 429 от Telegram ведро ставится на паузу на retry_after секунд."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def try_acquire(self) -> float:
+        """Взять токен без ожидания: 0 — взят, иначе через сколько секунд пробовать снова"""
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def pause(self, seconds: float):
+        # Во время паузы токены не копятся: после неё сразу уходит одно сообщение, дальше — по rate
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._updated = self._paused_until
+        self._tokens = 1
+
+
+class OutboundQueue:
+    """
+    Общая очередь исходящих сообщений.
+
+    Всё, что бот пишет не в ответ на текущий апдейт (уведомления, заявки в
+    канал выплат, рассылки), идёт через неё. Порядок — по приоритету:
+    USER (уведомления игрокам) раньше ADMIN (каналы) раньше BULK (рассылки).
+    Темп ограничен общим TokenBucket и ведром на каждый чат (личка — 1 в
+    секунду, группы и каналы — 20 в минуту). На 429 чат ставится на паузу
+    на retry_after и сообщение возвращается в очередь, сетевые ошибки
+    повторяются с нарастающей задержкой. Если личка недоступна, пользователь
+    помечается через mark_send_failure.
+    """
+    USER, ADMIN, BULK = 0, 1, 2
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, rate: float, workers: int):
+        self.bucket = TokenBucket(rate)
+        self.workers = workers
+        self._queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self._chat_buckets = LRUCache(10000, 300)
+        self._tasks: List[asyncio.Task] = []
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, method: str, chat_id: Union[int, str], priority: int, **kwargs) -> asyncio.Future:
+        """Поставить вызов метода Bot в очередь; результат придёт во future"""
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), method, chat_id, kwargs, future, 1))
+        return future
+
+    def send_message(self, chat_id: Union[int, str], text: str, priority: int = USER, **kwargs) -> asyncio.Future:
+        return self.submit('send_message', chat_id, priority, text=text, **kwargs)
+
+    def copy_message(self, chat_id: Union[int, str], from_chat_id: int, message_id: int, priority: int = BULK) -> asyncio.Future:
+        return self.submit('copy_message', chat_id, priority, from_chat_id=from_chat_id, message_id=message_id)
+
+    def enqueue_message(self, chat_id: Union[int, str], text: str, priority: int = USER, **kwargs):
+        """Отправить без ожидания: ошибка доставки только попадёт в лог"""
+        self.send_message(chat_id, text, priority, **kwargs).add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future: asyncio.Future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.info(f"Сообщение не доставлено: {future.exception()}")
+
+    @staticmethod
+    def _is_private(chat_id: Union[int, str]) -> bool:
+        # Каналы в конфиге заданы строками ("-100..." или "@name")
+        return isinstance(chat_id, int) and chat_id > 0
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(1.0) if self._is_private(chat_id) else TokenBucket(20 / 60, 3)
+            self._chat_buckets.put(chat_id, bucket)
+        return bucket
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._queue.get()
+            priority, _, method, chat_id, kwargs, future, attempt = item
+            try:
+                if future.done():
+                    continue
+                chat_bucket = self._chat_bucket(chat_id)
+                # Занятый чат откладываем, а не ждём, чтобы он не держал воркер
+                wait = chat_bucket.try_acquire()
+                if wait:
+                    loop.call_later(wait, self._queue.put_nowait, item)
+                    continue
+                await self.bucket.acquire()
+                try:
+                    result = await getattr(bot, method)(chat_id=chat_id, **kwargs)
+                except TelegramRetryAfter as e:
+                    chat_bucket.pause(e.retry_after)
+                    # Флуд во время рассылки тормозит всю отправку, в остальных случаях — только этот чат
+                    if priority == self.BULK:
+                        self.bucket.pause(e.retry_after)
+                    self._retry(loop, item, e.retry_after, e)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    self._fail(future, e)
+                    if self._is_private(chat_id):
+                        await mark_send_failure(chat_id, e)
+                except Exception as e:
+                    self._retry(loop, item, min(2 ** attempt, 60), e)
+                else:
+                    self.sent += 1
+                    future.set_result(result)
+            except Exception as e:
+                logging.error(f"Ошибка очереди отправки: {e}")
+            finally:
+                self._queue.task_done()
+
+    def _retry(self, loop: asyncio.AbstractEventLoop, item: tuple, delay: float, error: Exception):
+        priority, seq, method, chat_id, kwargs, future, attempt = item
+        if attempt >= self.MAX_ATTEMPTS:
+            return self._fail(future, error)
+        self.retried += 1
+        loop.call_later(delay, self._queue.put_nowait, (priority, seq, method, chat_id, kwargs, future, attempt + 1))
+
+    def _fail(self, future: asyncio.Future, error: Exception):
+        self.failed += 1
+        if not future.done():
+            future.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+        }
+
+
+outbound = OutboundQueue(OUTBOUND_RATE, OUTBOUND_WORKERS)
+
+
+async def notify_user(user_id: int, text: str, **kwargs) -> bool:
+    """Личное уведомление через очередь, без ожидания Telegram.
+    False — пользователь недоступен, сообщение не отправлялось."""
+    user = await db.get_user(user_id)
+    if user and not user.get('reachable', 1):
+        return False
+    outbound.enqueue_message(user_id, text, OutboundQueue.USER, **kwargs)
+    return True
+
+
+class OutboxDispatcher:
+    """
+    Доставка сообщений из таблицы outbox.
+
+    Хендлер пишет заявку в outbox той же транзакцией, что и списание, поэтому
+    она не теряется ни при ошибке Telegram, ни при перезапуске. Диспетчер
+    просыпается после коммита (и на всякий случай раз в poll_interval),
+    забирает пачку готовых записей, отправляет их через OutboundQueue и одним
+    запросом отмечает доставленные. Упавший посреди отправки процесс
+    повторит запись после LEASE — доставка «хотя бы один раз». Ошибки
+    повторяются с нарастающей задержкой, после MAX_ATTEMPTS запись остаётся
+    со статусом failed и текстом последней ошибки.
+    """
+    LEASE = 120
+    MAX_ATTEMPTS = 10
+    PRUNE_INTERVAL = 3600
+
+    def __init__(self, batch_size: int, poll_interval: float):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self._wake = asyncio.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        # Коммит выполняется в потоке БД — будим диспетчер через loop
+        db.sync.on_outbox = self.notify
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _deliver(self, row: Dict) -> Optional[str]:
+        """None — доставлено, иначе текст ошибки"""
+        chat_id = row['chat_id']
+        if chat_id.lstrip('-').isdigit():
+            chat_id = int(chat_id)
+        markup = InlineKeyboardMarkup.model_validate_json(row['reply_markup']) if row['reply_markup'] else None
+        try:
+            await outbound.send_message(chat_id, row['text'], OutboundQueue.ADMIN, reply_markup=markup)
+            return None
+        except Exception as e:
+            return str(e) or e.__class__.__name__
+
+    async def _dispatch(self) -> int:
+        batch = await db.claim_outbox(self.batch_size, self.LEASE)
+        if not batch:
+            return 0
+        errors = await asyncio.gather(*(self._deliver(row) for row in batch))
+        delivered = [row['id'] for row, error in zip(batch, errors) if error is None]
+        if delivered:
+            await db.outbox_sent(delivered)
+            self.sent += len(delivered)
+        for row, error in zip(batch, errors):
+            if error is None:
+                continue
+            if row['attempts'] >= self.MAX_ATTEMPTS:
+                logging.error(f"Outbox {row['idem_key']}: не доставлено за {row['attempts']} попыток: {error}")
+                self.failed += 1
+                await db.outbox_failed(row['id'], error, None)
+            else:
+                self.retried += 1
+                await db.outbox_failed(row['id'], error, min(30 * 2 ** row['attempts'], 3600))
+        return len(batch)
+
+    async def _run(self):
+        pruned_at = 0.0
+        while True:
+            self._wake.clear()
+            claimed = 0
+            try:
+                claimed = await self._dispatch()
+                if time.monotonic() - pruned_at > self.PRUNE_INTERVAL:
+                    await db.prune_outbox()
+                    pruned_at = time.monotonic()
+            except Exception as e:
+                logging.error(f"Ошибка диспетчера outbox: {e}")
+            # Полная пачка — вероятно, есть ещё, забираем сразу
+            if claimed >= self.batch_size:
+                continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> dict:
+        return {'sent': self.sent, 'failed': self.failed, 'retried': self.retried}
+
+
+outbox = OutboxDispatcher(OUTBOX_BATCH, OUTBOX_POLL_INTERVAL)
+
+
+class BroadcastEngine:
+    """Рассылки фоновыми задачами.
+
+    Получатели читаются страницами по user_id, отправка идёт параллельно
+    (не больше concurrency одновременно) через OutboundQueue с приоритетом
+    BULK. После каждой
+    страницы прогресс пишется в broadcast_jobs, поэтому после перезапуска
+    рассылка продолжается с места остановки (повторно может уйти не больше
+    одной страницы). Сообщение с прогрессом обновляется не чаще
+    progress_interval секунд.
+    """
+
+    def __init__(self, concurrency: int, page_size: int, progress_interval: float):
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.progress_interval = progress_interval
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._cancelled: set = set()
+
+    def start(self, job_id: int):
+        if job_id not in self._tasks:
+            self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    def cancel(self, job_id: int) -> bool:
+        if job_id not in self._tasks:
+            return False
+        self._cancelled.add(job_id)
+        return True
+
+    async def resume(self):
+        """Продолжить рассылки, прерванные перезапуском"""
+        for job_id in await db.get_running_broadcasts():
+            logging.info(f"Продолжаю рассылку #{job_id}")
+            self.start(job_id)
+
+    async def _deliver(self, job: Dict, user_id: int, semaphore: asyncio.Semaphore) -> bool:
+        async with semaphore:
+            try:
+                await outbound.copy_message(user_id, job['from_chat_id'], job['message_id'], OutboundQueue.BULK)
+                return True
+            except Exception as e:
+                logging.debug(f"Рассылка #{job['id']}: не доставлено {user_id}: {e}")
+                return False
+
+    async def _report(self, job: Dict, sent: int, failed: int, rate: float, final: bool = False):
+        done = sent + failed
+        if final:
+            text = (f"✅ <b>Рассылка #{job['id']} завершена!</b>\n\n"
+                    f"📊 Успешно: {sent}\n🚫 Ошибок: {failed}")
+        else:
+            left = max(job['total'] - done, 0)
+            eta = f"{int(left / rate // 60)} мин {int(left / rate % 60)} сек" if rate > 0 else "—"
+            text = (f"⏳ <b>Рассылка #{job['id']}</b>\n"
+                    f"🎯 Сегмент: {Segment.parse(job.get('segment') or '').describe()}\n\n"
+                    f"📨 Обработано: {done} из {job['total']}\n"
+                    f"📊 Успешно: {sent}, 🚫 ошибок: {failed}\n"
+                    f"⚡ Скорость: {rate:.1f} сообщ./сек\n"
+                    f"⏱ Осталось примерно: {eta}")
+        kb = None
+        if not final:
+            kb = InlineKeyboardBuilder().row(
+                InlineKeyboardButton(text="⛔ Остановить", callback_data=f"bc_cancel_{job['id']}")
+            ).as_markup()
+        try:
+            await bot.edit_message_text(text, chat_id=job['progress_chat_id'],
+                                        message_id=job['progress_message_id'], reply_markup=kb)
+        except Exception as e:
+            logging.debug(f"Рассылка #{job['id']}: не удалось обновить прогресс: {e}")
+
+    async def _run(self, job_id: int):
+        try:
+            job = await db.get_broadcast(job_id)
+            if not job or job['status'] != 'running':
+                return
+            semaphore = asyncio.Semaphore(self.concurrency)
+            last_user_id, sent, failed = job['last_user_id'] or 0, job['sent'], job['failed']
+            started, done_at_start = time.monotonic(), sent + failed
+            reported = started
+            while job_id not in self._cancelled:
+                page = await db.broadcast_page(last_user_id, self.page_size, job.get('segment') or '')
+                if not page:
+                    break
+                results = await asyncio.gather(*(self._deliver(job, uid, semaphore) for uid in page))
+                sent += sum(results)
+                failed += len(results) - sum(results)
+                last_user_id = page[-1]
+                await db.checkpoint_broadcast(job_id, last_user_id, sent, failed)
+                now = time.monotonic()
+                if now - reported >= self.progress_interval:
+                    reported = now
+                    await self._report(job, sent, failed, (sent + failed - done_at_start) / (now - started))
+            status = 'cancelled' if job_id in self._cancelled else 'done'
+            await db.finish_broadcast(job_id, status)
+            await self._report(job, sent, failed, 0, final=True)
+            await db.log_admin(job['admin_id'], "broadcast", f"#{job_id} {status}: успешно {sent}, ошибок {failed}")
+        except Exception as e:
+            logging.error(f"Рассылка #{job_id} прервана: {e}")
+        finally:
+            self._tasks.pop(job_id, None)
+            self._cancelled.discard(job_id)
+
+
+broadcasts = BroadcastEngine(BROADCAST_CONCURRENCY, BROADCAST_PAGE, BROADCAST_PROGRESS_INTERVAL)
+
+
 # ========== ОБРАБОТЧИКИ ПОЛЬЗОВАТЕЛЕЙ ==========
     
 @dp.message(CommandStart())
@@ -734,20 +3134,20 @@ async def cmd_start(message: Message):
         param = args[1]
         if param.startswith("check_"):
             check_id = param.replace("check_", "")
-            check = db.execute("SELECT * FROM checks WHERE id = ? AND is_active = 1", (check_id,), fetchone=True)
-        if not check:
-            await message.answer("❌ Чек не найден или неактивен")
+            check = await db.execute("SELECT * FROM checks WHERE id = ? AND is_active = 1", (check_id,), fetchone=True)
+            if not check:
+                await message.answer("❌ Чек не найден или неактивен")
+                return
+            if check['type'] == 'stars':
+                per_use = float(check['value']) / check['max_uses']
+                text = f"🎁 Чек на {per_use:.2f} ⭐"
+            else:
+                text = f"🎁 Чек на {check['value']}"
+            if check['password']:
+                text += "\n🔒 Защищён паролем"
+            kb = InlineKeyboardBuilder().row(InlineKeyboardButton(text="🎁 Забрать", callback_data=f"claim_{check_id}")).as_markup()
+            await message.answer(text, reply_markup=kb)
             return
-        if check['type'] == 'stars':
-            per_use = float(check['value']) / check['max_uses']
-            text = f"🎁 Чек на {per_use:.2f} ⭐"
-        else:
-            text = f"🎁 Чек на {check['value']}"
-        if check['password']:
-            text += "\n🔒 Защищён паролем"
-        kb = InlineKeyboardBuilder().row(InlineKeyboardButton(text="🎁 Забрать", callback_data=f"claim_{check_id}")).as_markup()
-        await message.answer(text, reply_markup=kb)
-        return
 
     # Проверка на реферальную ссылку
     if len(args) > 1:
@@ -770,14 +3170,14 @@ async def cmd_start(message: Message):
                 return
 
     # Создание пользователя, если новый
-    user = db.get_user(uid)
+    user = await db.get_user(uid)
     if not user:
-        db.create_user(uid, message.from_user.username or "", message.from_user.first_name or "", referred_by)
+        await db.create_user(uid, message.from_user.username or "", message.from_user.first_name or "", referred_by)
         if referred_by:
-            try:
-                await bot.send_message(referred_by, "👥 У вас новый реферал! Он получит бонус, когда заработает первые 1.0 ⭐.")
-            except:
-                pass
+            await notify_user(referred_by, "👥 У вас новый реферал! Он получит бонус, когда заработает первые 1.0 ⭐.")
+    elif not user.get('reachable', 1):
+        # Вернулся после блокировки — снова получает рассылки и уведомления
+        await db.set_reachable(uid, True)
 
     await message.answer(
         f"👋 Привет, <b>{message.from_user.first_name}</b>!\n\n"
@@ -786,15 +3186,15 @@ async def cmd_start(message: Message):
         reply_markup=get_main_kb(uid)
     )
 
-@dp.callback_query(F.data == "menu")
+@callbacks.exact("menu")
 async def cb_menu(call: CallbackQuery):
     await call.message.edit_text("⭐ <b>Главное меню</b>", reply_markup=get_main_kb(call.from_user.id))
 
-@dp.callback_query(F.data == "profile")
+@callbacks.exact("profile")
 async def cb_profile(call: CallbackQuery):
     logging.info(f"Profile callback from {call.from_user.id}")
     await call.answer()
-    u = db.get_user(call.from_user.id)
+    u = await db.get_user(call.from_user.id)
     if not u:
         return await call.message.answer("❌ Ошибка: вас нет в базе. Напишите /start")
     
@@ -819,17 +3219,16 @@ async def cb_profile(call: CallbackQuery):
         logging.error(f"Error editing message in profile: {e}")
         await call.message.answer(text, reply_markup=kb)
 
-@dp.callback_query(F.data == "referrals")
+@callbacks.exact("referrals")
 async def cb_referrals(call: CallbackQuery):
     logging.info(f"Referrals callback from {call.from_user.id}")
     await call.answer()
-    u = db.get_user(call.from_user.id)
+    u = await db.get_user(call.from_user.id)
     if not u:
         return
     ref_code = u.get('ref_code', f"ref{call.from_user.id}")
-    bot_username = (await bot.get_me()).username
-    ref_link = f"https://t.me/{bot_username}?start={ref_code}"
-    ref_reward = float(db.get_config('ref_reward', 5.0))
+    ref_link = await identity.ref_link(ref_code)
+    ref_reward = await db.get_config_float('ref_reward', 5.0)
     text = (
         f"👥 <b>Рефералы</b>\n\n"
         f"За активного друга (заработал ≥1 ⭐): <b>{ref_reward} ⭐</b>\n\n"
@@ -842,14 +3241,14 @@ async def cb_referrals(call: CallbackQuery):
         logging.error(f"Error editing message in referrals: {e}")
         await call.message.answer(text, reply_markup=kb)
 
-@dp.callback_query(F.data == "daily")
+@callbacks.exact("daily")
 async def cb_daily(call: CallbackQuery):
     uid = call.from_user.id
     now = datetime.now()
     today_str = now.strftime("%Y-%m-%d")
 
     # Получаем текущий стрик
-    row = db.execute("SELECT last_date, streak FROM daily_bonus WHERE user_id = ?", (uid,), fetchone=True)
+    row = await db.execute("SELECT last_date, streak FROM daily_bonus WHERE user_id = ?", (uid,), fetchone=True)
     if row:
         last_date = datetime.strptime(row['last_date'], "%Y-%m-%d")
         delta = (now.date() - last_date.date()).days
@@ -859,21 +3258,21 @@ async def cb_daily(call: CallbackQuery):
             new_streak = min(row['streak'] + 1, 7)
         else:
             new_streak = 1
-        db.execute("UPDATE daily_bonus SET last_date = ?, streak = ? WHERE user_id = ?", (today_str, new_streak, uid))
+        await db.execute("UPDATE daily_bonus SET last_date = ?, streak = ? WHERE user_id = ?", (today_str, new_streak, uid))
     else:
         new_streak = 1
-        db.execute("INSERT INTO daily_bonus (user_id, last_date, streak) VALUES (?, ?, ?)", (uid, today_str, new_streak))
+        await db.execute("INSERT INTO daily_bonus (user_id, last_date, streak) VALUES (?, ?, ?)", (uid, today_str, new_streak))
 
     # Размер бонуса: 0.1 * стрик
     reward = round(0.1 * new_streak, 2)
-    db.add_stars(uid, reward)
+    await db.add_stars(uid, reward)
     await call.answer(f"✅ День {new_streak}! Получено: {reward} ⭐", show_alert=True)
     await call.message.edit_text("⭐ <b>Главное меню</b>", reply_markup=get_main_kb(uid))
 
-@dp.callback_query(F.data == "casino_menu")
+@callbacks.exact("casino_menu")
 async def casino_menu(call: CallbackQuery):
     uid = call.from_user.id
-    user = db.get_user_safe(uid)
+    user = await db.get_user_safe(uid)
     premium = user.get('premium_mode', 0)
     status = "💎 Премиум (x2 ставка, x2 выигрыш)" if premium else "⚪ Обычный режим"
     kb = InlineKeyboardBuilder()
@@ -894,25 +3293,22 @@ async def casino_menu(call: CallbackQuery):
         reply_markup=kb.as_markup()
     )
 
-@dp.callback_query(F.data.startswith("casino_spin_"))
-async def casino_spin(call: CallbackQuery):
+@callbacks.prefix("casino_spin_", int)
+async def casino_spin(call: CallbackQuery, payload: CallbackPayload):
     uid = call.from_user.id
-    user = db.get_user_safe(uid)
+    user = await db.get_user_safe(uid)
     if not user:
         return await call.answer("Ошибка: вас нет в базе", show_alert=True)
 
-    spin_count = int(call.data.split("_")[2])
+    spin_count, = payload.args
+    if spin_count not in (1, 10):
+        return await call.answer("❌ Недопустимое число спинов", show_alert=True)
     premium = user.get('premium_mode', 0)
 
     # Базовая стоимость
     base_cost = 2 if spin_count == 1 else 15
     cost = base_cost * (2 if premium else 1)
 
-    if user['stars'] < cost:
-        return await call.answer(f"❌ Недостаточно ⭐! Нужно {cost}", show_alert=True)
-
-    db.add_stars(uid, -cost)
-
     total_win = 0
     results = []
     for _ in range(spin_count):
@@ -922,7 +3318,13 @@ async def casino_spin(call: CallbackQuery):
         total_win += win
         results.append(round(win, 2))
 
-    db.add_stars(uid, total_win)
+    try:
+        async with db.transaction():
+            if await db.try_debit(uid, cost) is None:
+                raise OperationDeclined(f"❌ Недостаточно ⭐! Нужно {cost}")
+            await db.add_stars(uid, total_win)
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
 
     if spin_count == 1:
         msg = f"🎰 Выигрыш: <b>{total_win:.2f} ⭐</b>"
@@ -932,28 +3334,29 @@ async def casino_spin(call: CallbackQuery):
     await call.message.answer(msg)
     await casino_menu(call)
     
-@dp.callback_query(F.data == "casino_premium_toggle")
+@callbacks.exact("casino_premium_toggle")
 async def casino_premium_toggle(call: CallbackQuery):
     uid = call.from_user.id
-    user = db.get_user_safe(uid)
+    user = await db.get_user_safe(uid)
     if not user:
         return
     new_mode = 0 if user.get('premium_mode', 0) else 1
-    db.execute("UPDATE users SET premium_mode = ? WHERE user_id = ?", (new_mode, uid))
+    await db.update_user(uid, premium_mode=new_mode)
     status = "включён" if new_mode else "выключен"
     await call.answer(f"💎 Премиум режим {status}", show_alert=True)
     await casino_menu(call)
 
-@dp.callback_query(F.data == "luck")
+@callbacks.exact("luck")
 async def cb_luck(call: CallbackQuery):
     logging.info(f"Luck callback from {call.from_user.id}")
     await call.answer()
     uid = call.from_user.id
-    user = db.get_user(uid)
+    user = await db.get_user(uid)
     if not user:
         return await call.message.answer("❌ Ошибка: вас нет в базе. Напишите /start")
     now = datetime.now()
-    cooldown = int(db.get_config('luck_cooldown', 21600))
+    config = await db.config()
+    cooldown = int(config.get_float('luck_cooldown', 21600))
     last_luck = user.get('last_luck')
     if last_luck:
         try:
@@ -964,13 +3367,13 @@ async def cb_luck(call: CallbackQuery):
                 return await call.answer(f"⏳ Подожди {minutes} мин.", show_alert=True)
         except:
             pass
-    luck_min = float(db.get_config('luck_min', 0))
-    luck_max = float(db.get_config('luck_max', 5))
+    luck_min = config.get_float('luck_min', 0)
+    luck_max = config.get_float('luck_max', 5)
     win = round(random.uniform(luck_min, luck_max), 2)
-    game_boost = db.get_global_boost('game')
+    game_boost = await db.get_global_boost('game')
     win *= game_boost
-    db.add_stars(uid, win)
-    db.execute("UPDATE users SET last_luck = ? WHERE user_id = ?", (now.isoformat(), uid))
+    await db.add_stars(uid, win)
+    await db.update_user(uid, last_luck=now.isoformat())
     await call.answer(f"🎰 +{win:.2f} ⭐", show_alert=True)
     try:
         await call.message.edit_text("⭐ <b>Главное меню</b>", reply_markup=get_main_kb(uid))
@@ -980,17 +3383,17 @@ async def cb_luck(call: CallbackQuery):
 
 # ========== КВЕСТЫ ==========
 
-@dp.callback_query(F.data == "tasks")
+@callbacks.exact("tasks")
 async def cb_tasks(call: CallbackQuery):
     uid = call.from_user.id
     # Получаем все активные квесты, отсортированные по порядку (можно по id)
-    quests = db.execute("SELECT * FROM quests WHERE is_active = 1 ORDER BY id", fetch=True)
+    quests = await db.execute("SELECT * FROM quests WHERE is_active = 1 ORDER BY id", fetch=True)
 
     # Определяем, какие квесты доступны: либо первый невыполненный, либо все, если они независимы.
     # Для простоты покажем все, но отметим выполненные.
     kb = InlineKeyboardBuilder()
     for q in quests:
-        done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, q['id']), fetchone=True)
+        done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, q['id']), fetchone=True)
         status = "✅" if done else "⏳"
         kb.row(InlineKeyboardButton(text=f"{status} {q['name']}", callback_data=f"quest_info_{q['id']}"))
 
@@ -1001,15 +3404,15 @@ async def cb_tasks(call: CallbackQuery):
         reply_markup=kb.as_markup()
     )
 
-@dp.callback_query(F.data.startswith("quest_info_"))
-async def quest_info(call: CallbackQuery):
-    quest_id = int(call.data.split("_")[2])
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+@callbacks.prefix("quest_info_", int)
+async def quest_info(call: CallbackQuery, payload: CallbackPayload):
+    quest_id, = payload.args
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if not q:
         return await call.answer("Квест не найден", show_alert=True)
 
     uid = call.from_user.id
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
 
     text = f"<b>{q['name']}</b>\n{q['description']}\n\nНаграда: {q['reward']} ⭐"
 
@@ -1025,16 +3428,16 @@ async def quest_info(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="tasks"))
     await call.message.edit_text(text, reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("quest_check_sub_"))
-async def quest_check_sub(call: CallbackQuery):
-    quest_id = int(call.data.split("_")[3])
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+@callbacks.prefix("quest_check_sub_", int)
+async def quest_check_sub(call: CallbackQuery, payload: CallbackPayload):
+    quest_id, = payload.args
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if not q:
         return await call.answer("Квест не найден", show_alert=True)
 
     uid = call.from_user.id
     # Проверяем, не выполнен ли уже
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
     if done:
         await call.answer("Ты уже выполнил этот квест", show_alert=True)
         return
@@ -1044,12 +3447,12 @@ async def quest_check_sub(call: CallbackQuery):
         chat_member = await bot.get_chat_member(chat_id=int(q['target']), user_id=uid)
         if chat_member.status in ['member', 'administrator', 'creator']:
             # Начисляем награду
-            db.add_stars(uid, float(q['reward']))
-            db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
+            await db.add_stars(uid, float(q['reward']))
+            await db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
             await call.answer(f"✅ +{q['reward']} ⭐ за подписку!", show_alert=True)
             # Если есть следующий квест, предложить его
             if q['next_quest_id']:
-                next_q = db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
+                next_q = await db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
                 if next_q:
                     await call.message.answer(f"🎯 Следующий квест: {next_q['name']}")
         else:
@@ -1057,15 +3460,15 @@ async def quest_check_sub(call: CallbackQuery):
     except Exception as e:
         await call.answer(f"Ошибка проверки: {e}", show_alert=True)
 
-@dp.callback_query(F.data.startswith("quest_forward_"))
-async def quest_forward_start(call: CallbackQuery, state: FSMContext):
-    quest_id = int(call.data.split("_")[2])
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+@callbacks.prefix("quest_forward_", int)
+async def quest_forward_start(call: CallbackQuery, state: FSMContext, payload: CallbackPayload):
+    quest_id, = payload.args
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if not q:
         return await call.answer("Квест не найден", show_alert=True)
 
     uid = call.from_user.id
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
     if done:
         await call.answer("Ты уже выполнил этот квест", show_alert=True)
         return
@@ -1099,49 +3502,49 @@ async def quest_forward_message(message: Message, state: FSMContext):
 
     # Всё ок, выдаём награду
     uid = message.from_user.id
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if q:
-        db.add_stars(uid, float(q['reward']))
-        db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
+        await db.add_stars(uid, float(q['reward']))
+        await db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
         await message.answer(f"✅ +{q['reward']} ⭐ за выполнение!")
         if q['next_quest_id']:
-            next_q = db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
+            next_q = await db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
             if next_q:
                 await message.answer(f"🎯 Следующий квест: {next_q['name']}")
     await state.clear()
 
-@dp.callback_query(F.data.startswith("quest_view_"))
-async def quest_view(call: CallbackQuery):
-    quest_id = int(call.data.split("_")[2])
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+@callbacks.prefix("quest_view_", int)
+async def quest_view(call: CallbackQuery, payload: CallbackPayload):
+    quest_id, = payload.args
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if not q:
         return await call.answer("Квест не найден", show_alert=True)
 
     uid = call.from_user.id
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
     if done:
         await call.answer("Ты уже выполнил этот квест", show_alert=True)
         return
 
     # Выдаём награду
-    db.add_stars(uid, float(q['reward']))
-    db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
+    await db.add_stars(uid, float(q['reward']))
+    await db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
     await call.answer(f"✅ +{q['reward']} ⭐ за просмотр!", show_alert=True)
     if q['next_quest_id']:
-        next_q = db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
+        next_q = await db.execute("SELECT * FROM quests WHERE id = ?", (q['next_quest_id'],), fetchone=True)
         if next_q:
             await call.message.answer(f"🎯 Следующий квест: {next_q['name']}")
 
-@dp.callback_query(F.data.startswith("quest_do_"))
-async def quest_do(call: CallbackQuery):
-    quest_id = int(call.data.split("_")[2])
+@callbacks.prefix("quest_do_", int)
+async def quest_do(call: CallbackQuery, payload: CallbackPayload):
+    quest_id, = payload.args
     uid = call.from_user.id
-    q = db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
+    q = await db.execute("SELECT * FROM quests WHERE id = ?", (quest_id,), fetchone=True)
     if not q:
         return await call.answer("Квест не найден", show_alert=True)
 
     # Проверяем, не выполнен ли уже
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND quest_id = ?", (uid, quest_id), fetchone=True)
     if done:
         return await call.answer("Ты уже выполнил этот квест", show_alert=True)
 
@@ -1166,47 +3569,46 @@ async def quest_do(call: CallbackQuery):
 
     # Выдача награды
     if q['reward_type'] == 'stars':
-        db.add_stars(uid, float(q['reward_value']))
+        await db.add_stars(uid, float(q['reward_value']))
     else:
         item = q['reward_value']
-        existing = db.execute("SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item), fetchone=True)
+        existing = await db.execute("SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item), fetchone=True)
         if existing:
-            db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (uid, item))
+            await db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (uid, item))
         else:
-            db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (uid, item))
+            await db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (uid, item))
 
-    db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
+    await db.execute("INSERT INTO user_quests (user_id, quest_id) VALUES (?, ?)", (uid, quest_id))
     await call.answer("✅ Награда получена!", show_alert=True)
-    await quest_info(call)  # обновляем
+    await quest_info(call, CallbackPayload("quest_info_", (quest_id,)))  # обновляем
 
-@dp.callback_query(F.data == "quest_channel")
+@callbacks.exact("quest_channel")
 async def quest_channel(call: CallbackQuery):
     # Здесь можно проверить подписку на конкретный канал
     await call.answer("Функция в разработке", show_alert=True)
 
-@dp.callback_query(F.data == "quest_start")
+@callbacks.exact("quest_start")
 async def quest_start(call: CallbackQuery):
     # Запуск бота – уже выполнено, можно выдать награду один раз
     uid = call.from_user.id
-    done = db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND task_id = 'start_bot'", (uid,), fetchone=True)
+    done = await db.execute("SELECT 1 FROM user_quests WHERE user_id = ? AND task_id = 'start_bot'", (uid,), fetchone=True)
     if done:
         await call.answer("Ты уже получал награду за запуск", show_alert=True)
     else:
-        db.add_stars(uid, 1.0)
-        db.execute("INSERT INTO user_quests (user_id, task_id) VALUES (?, 'start_bot')", (uid,))
+        await db.add_stars(uid, 1.0)
+        await db.execute("INSERT INTO user_quests (user_id, task_id) VALUES (?, 'start_bot')", (uid,))
         await call.answer("✅ +1 ⭐ за запуск бота!", show_alert=True)
 
-@dp.callback_query(F.data == "quest_posts")
+@callbacks.exact("quest_posts")
 async def quest_posts(call: CallbackQuery):
     # Здесь можно давать награду за просмотр постов (нужна отдельная логика)
     await call.answer("Функция в разработке", show_alert=True)
 
 # ========== ДУЭЛИ ==========
-@dp.callback_query(F.data == "duel_menu")
+@callbacks.exact("duel_menu")
 async def cb_duel_menu(call: CallbackQuery):
     uid = call.from_user.id
-    bot_username = (await bot.get_me()).username
-    link = f"https://t.me/{bot_username}?start=duel{uid}"
+    link = await identity.duel_link(uid)
     text = (
         "⚔️ <b>ДУЭЛЬНЫЙ КЛУБ</b>\n━━━━━━━━━━━━━━\n"
         "Ставка: <b>5.0 ⭐</b>\n"
@@ -1218,21 +3620,19 @@ async def cb_duel_menu(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
     await call.message.edit_text(f"{text}\n<code>{link}</code>", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("accept_duel_"))
-async def cb_accept_duel(call: CallbackQuery):
+@callbacks.prefix("accept_duel_", int)
+async def cb_accept_duel(call: CallbackQuery, payload: CallbackPayload):
     opponent_id = call.from_user.id
-    creator_id = int(call.data.split("_")[2])
+    creator_id, = payload.args
     if opponent_id == creator_id:
         return await call.answer("❌ Нельзя играть с самим собой!", show_alert=True)
-    user = db.get_user(opponent_id)
-    if not user or user['stars'] < 5.0:
+    if await db.try_debit(opponent_id, 5.0) is None:
         return await call.answer("❌ Недостаточно ⭐ для ставки!", show_alert=True)
-    db.add_stars(opponent_id, -5.0)
     msg = await call.message.answer("🎲 Бросаем кости...")
     dice = await msg.answer_dice("🎲")
     await asyncio.sleep(3.5)
     winner_id = creator_id if dice.dice.value <= 3 else opponent_id
-    db.add_stars(winner_id, 9.0)
+    await db.add_stars(winner_id, 9.0)
     await call.message.answer(
         f"🎰 Выпало <b>{dice.dice.value}</b>!\n"
         f"👑 Победитель: <a href='tg://user?id={winner_id}'>Игрок</a>\n"
@@ -1240,18 +3640,17 @@ async def cb_accept_duel(call: CallbackQuery):
     )
 
 # ========== ЛОТЕРЕЯ ==========
-@dp.callback_query(F.data == "lottery")
+@callbacks.exact("lottery")
 async def cb_lottery(call: CallbackQuery):
-    data = db.execute("SELECT pool, participants FROM lottery WHERE id = 1", fetchone=True)
+    data = await db.get_lottery()
     if not data:
         return
-    participants = data['participants'].split(',') if data['participants'] else []
-    count = len([p for p in participants if p])
     text = (
         "🎟 <b>ЗВЁЗДНАЯ ЛОТЕРЕЯ</b>\n"
         "━━━━━━━━━━━━━━━━━━\n"
         f"💰 Текущий банк: <b>{data['pool']:.2f} ⭐</b>\n"
-        f"👥 Участников: <b>{count}</b>\n"
+        f"👥 Участников: <b>{data['players']}</b>\n"
+        f"🎟 Билетов продано: <b>{data['tickets']}</b>\n"
         f"🎫 Цена билета: <b>2.0 ⭐</b>\n"
         "━━━━━━━━━━━━━━━━━━\n"
         "<i>Победитель забирает 80% банка. Розыгрыш происходит автоматически при запуске админом!</i>"
@@ -1261,44 +3660,87 @@ async def cb_lottery(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
     await call.message.edit_text(text, reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data == "buy_ticket")
+@callbacks.exact("buy_ticket")
 async def cb_buy_ticket(call: CallbackQuery):
     uid = call.from_user.id
-    user = db.get_user(uid)
-    if not user or user['stars'] < 2:
-        return await call.answer("❌ Недостаточно звёзд (нужно 2.0)", show_alert=True)
-    db.add_stars(uid, -2)
-    db.execute("UPDATE lottery SET pool = pool + 2, participants = participants || ? WHERE id = 1", (f"{uid},",))
-    db.execute("INSERT INTO lottery_history (user_id) VALUES (?)", (uid,))
+    try:
+        async with db.transaction():
+            if await db.try_debit(uid, 2) is None:
+                raise OperationDeclined("❌ Недостаточно звёзд (нужно 2.0)")
+            await db.buy_lottery_ticket(uid, 2)
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.answer("✅ Билет куплен!", show_alert=True)
     await cb_lottery(call)
 
 # ========== ТОП ==========
 
-@dp.callback_query(F.data == "top")
+# Топы: кнопка -> (метрика, период, заголовок, единица). 'top' — баланс из Leaderboard
+TOP_BOARDS = {
+    'top': (None, None, "🏆 <b>ТОП-{size} МАГНАТОВ</b>", "⭐"),
+    'top_day': ('earned', 'day', "📅 <b>ТОП ЗАРАБОТКА ЗА ДЕНЬ</b>", "⭐"),
+    'top_week': ('earned', 'week', "🗓 <b>ТОП ЗАРАБОТКА ЗА НЕДЕЛЮ</b>", "⭐"),
+    'top_refs': ('refs', 'week', "👥 <b>ТОП ПРИГЛАСИВШИХ ЗА НЕДЕЛЮ</b>", "👥"),
+}
+
+# Готовые экраны топов: перерисовываются не чаще раза в TOP_RENDER_TTL секунд,
+# топ по балансу — ещё и только если он изменился
+_top_render: Dict[str, dict] = {}
+
+def get_top_kb() -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    kb.row(
+        InlineKeyboardButton(text="💰 Баланс", callback_data="top"),
+        InlineKeyboardButton(text="📅 День", callback_data="top_day"),
+        InlineKeyboardButton(text="🗓 Неделя", callback_data="top_week"),
+        InlineKeyboardButton(text="👥 Рефералы", callback_data="top_refs"),
+    )
+    kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
+    return kb.as_markup()
+
+async def render_top(board: str = 'top') -> Tuple[str, InlineKeyboardMarkup]:
+    metric, period, title, unit = TOP_BOARDS[board]
+    size = int((await db.config()).get_float('top_size', 10))
+    if metric is None:
+        key = (size, db.sync.leaderboard.version)
+    else:
+        key = (size, stat_buckets()[period])
+    cached = _top_render.get(board)
+    if cached is not None:
+        fresh = time.monotonic() - cached['at'] < TOP_RENDER_TTL
+        if (metric is None and cached['key'] == key) or (fresh and cached['key'][0] == size):
+            return cached['text'], cached['kb']
+    if metric is None:
+        rows = await db.top_users(size)
+    else:
+        rows = await db.get_stat_top(metric, period, size)
+    text = title.format(size=size) + "\n━━━━━━━━━━━━━━━━━━\n"
+    for i, (user_id, value, name) in enumerate(rows, 1):
+        amount = f"{value:.1f}" if unit == "⭐" else f"{int(value)}"
+        text += f"{i}. {name or 'Без имени'} — <b>{amount} {unit}</b>\n"
+    if not rows:
+        text += "<i>Пока пусто — будь первым!</i>\n"
+    kb = get_top_kb()
+    _top_render[board] = {'key': key, 'at': time.monotonic(), 'text': text, 'kb': kb}
+    return text, kb
+
+@callbacks.exact(*TOP_BOARDS)
 async def cb_top(call: CallbackQuery):
     await call.answer()
-    rows = db.execute("SELECT user_id, username, first_name, stars FROM users ORDER BY stars DESC LIMIT 10", fetch=True)
-    text = "🏆 <b>ТОП-10 МАГНАТОВ</b>\n━━━━━━━━━━━━━━━━━━\n"
-    for i, row in enumerate(rows, 1):
-        # Используем username, если есть, иначе first_name
-        name = row['username'] or row['first_name'] or "Без имени"
-        stars = float(row['stars']) if row['stars'] is not None else 0
-        text += f"{i}. {name} — <b>{stars:.1f} ⭐</b>\n"
-    kb = InlineKeyboardBuilder().row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu")).as_markup()
+    text, kb = await render_top(call.data)
     try:
         await call.message.edit_text(text, reply_markup=kb)
     except:
         await call.message.answer(text, reply_markup=kb)
 
 # ========== ВЫВОД СРЕДСТВ ==========
-@dp.callback_query(F.data == "withdraw")
+@callbacks.exact("withdraw")
 async def cb_withdraw_select(call: CallbackQuery):
     uid = call.from_user.id
-    user = db.get_user(uid)
+    user = await db.get_user(uid)
     if not user or user['stars'] < 15:
         return await call.answer("❌ Минимум 15 ⭐", show_alert=True)
-    options = db.get_withdrawal_options()
+    options = await db.get_withdrawal_options()
     kb = InlineKeyboardBuilder()
     for opt in options:
         if user['stars'] >= opt:
@@ -1306,26 +3748,34 @@ async def cb_withdraw_select(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
     await call.message.edit_text("Выбери сумму:", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("wd_run_"))
-async def cb_wd_execute(call: CallbackQuery):
-    amt = float(call.data.split("_")[2])
+@callbacks.prefix("wd_run_", float)
+async def cb_wd_execute(call: CallbackQuery, payload: CallbackPayload):
+    amt, = payload.args
     uid = call.from_user.id
-    user = db.get_user(uid)
-    if not user or user['stars'] < amt:
-        return await call.answer("❌ Недостаточно ⭐", show_alert=True)
-    db.add_stars(uid, -amt)
+    # Сумма приходит из callback_data — принимаем только предложенные варианты
+    if amt not in await db.get_withdrawal_options():
+        return await call.answer("❌ Недопустимая сумма", show_alert=True)
     name = mask_name(call.from_user.username or call.from_user.first_name)
-    await bot.send_message(
-        WITHDRAWAL_CHANNEL_ID,
-        f"📥 <b>НОВАЯ ЗАЯВКА</b>\n\n👤 Юзер: @{name}\n🆔 ID: <code>{uid}</code>\n💎 Сумма: <b>{amt} ⭐</b>",
-        reply_markup=get_admin_decision_kb(uid, amt)
-    )
+    try:
+        async with db.transaction():
+            if await db.try_debit(uid, amt) is None:
+                raise OperationDeclined("❌ Недостаточно ⭐")
+            # Заявка уходит в канал из outbox; ключ — id нажатия, повтор того же апдейта не спишет дважды
+            if not await db.outbox_put(
+                f"wd:{call.id}",
+                WITHDRAWAL_CHANNEL_ID,
+                f"📥 <b>НОВАЯ ЗАЯВКА</b>\n\n👤 Юзер: @{name}\n🆔 ID: <code>{uid}</code>\n💎 Сумма: <b>{amt} ⭐</b>",
+                get_admin_decision_kb(uid, amt)
+            ):
+                raise OperationDeclined("⏳ Заявка уже отправлена")
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.message.edit_text("✅ Заявка отправлена!", reply_markup=get_main_kb(uid))
 
 # ========== МАГАЗИН И ИНВЕНТАРЬ ==========
-@dp.callback_query(F.data == "shop")
+@callbacks.exact("shop")
 async def cb_shop_menu(call: CallbackQuery):
-    gifts = db.get_gifts_prices()
+    gifts = await db.get_gifts_prices()
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="💎 ЭКСКЛЮЗИВНЫЕ ТОВАРЫ", callback_data="special_shop"))
     kb.row(InlineKeyboardButton(text="⚡ Буст рефералов +0.1 (50 ⭐)", callback_data="buy_boost_01"))
@@ -1339,46 +3789,42 @@ async def cb_shop_menu(call: CallbackQuery):
         reply_markup=kb.as_markup()
     )
 
-@dp.callback_query(F.data == "buy_boost_01")
+@callbacks.exact("buy_boost_01")
 async def buy_boost(call: CallbackQuery):
     uid = call.from_user.id
-    user = db.get_user(uid)
-    if not user or user['stars'] < 50:
-        return await call.answer("❌ Нужно 50 ⭐", show_alert=True)
-    db.add_stars(uid, -50)
-    db.execute("UPDATE users SET ref_boost = ref_boost + 0.1 WHERE user_id = ?", (uid,))
+    try:
+        async with db.transaction():
+            if await db.try_debit(uid, 50) is None:
+                raise OperationDeclined("❌ Нужно 50 ⭐")
+            await db.add_ref_boost(uid, 0.1)
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.answer("🚀 Буст куплен! Теперь ты получаешь больше.", show_alert=True)
 
-@dp.callback_query(F.data.startswith("buy_g_"))
-async def process_gift_buy(call: CallbackQuery):
-    item_name = call.data.replace("buy_g_", "")
-    gifts = db.get_gifts_prices()
+@callbacks.prefix("buy_g_", str)
+async def process_gift_buy(call: CallbackQuery, payload: CallbackPayload):
+    item_name, = payload.args
+    gifts = await db.get_gifts_prices()
     price = gifts.get(item_name)
     if not price:
         return await call.answer("❌ Товар не найден", show_alert=True)
     uid = call.from_user.id
-    user = db.get_user(uid)
-    if not user or user['stars'] < price:
-        return await call.answer(f"❌ Недостаточно звёзд! Нужно {price} ⭐", show_alert=True)
-    db.add_stars(uid, -price)
-    # Добавляем в инвентарь
-    existing = db.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-        (uid, item_name), fetchone=True
-    )
-    if existing:
-        db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (uid, item_name))
-    else:
-        db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (uid, item_name))
+    try:
+        async with db.transaction():
+            if await db.try_debit(uid, price) is None:
+                raise OperationDeclined(f"❌ Недостаточно звёзд! Нужно {price} ⭐")
+            await db.add_item(uid, item_name)
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.answer(f"✅ Ты купил {item_name}!", show_alert=True)
 
-@dp.callback_query(F.data.startswith("inventory"))
-async def cb_inventory_logic(call: CallbackQuery):
-    # Обработчик для inventory_0, inventory_1 и т.д.
-    parts = call.data.split("_")
-    page = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+@callbacks.exact("inventory")
+@callbacks.prefix("inventory_", int)
+async def cb_inventory_logic(call: CallbackQuery, payload: CallbackPayload):
+    # inventory и inventory_0, inventory_1 и т.д.
+    page = payload.args[0] if payload.args else 0
     uid = call.from_user.id
-    items = db.execute(
+    items = await db.execute(
         "SELECT item_name, quantity FROM inventory WHERE user_id = ?",
         (uid,), fetch=True
     )
@@ -1406,10 +3852,10 @@ async def cb_inventory_logic(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
     await call.message.edit_text(text, reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("pre_out_"))
-async def cb_pre_out(call: CallbackQuery):
-    item = call.data.replace("pre_out_", "")
-    specials = db.get_special_items()
+@callbacks.prefix("pre_out_", str)
+async def cb_pre_out(call: CallbackQuery, payload: CallbackPayload):
+    item, = payload.args
+    specials = await db.get_special_items()
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="🎁 Получить как подарок", callback_data=f"confirm_out_{item}"))
     # Если это эксклюзивный товар – разрешить продажу на P2P
@@ -1418,52 +3864,44 @@ async def cb_pre_out(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="❌ Отмена", callback_data="inventory_0"))
     await call.message.edit_text(f"Ты выбрал: <b>{item}</b>\nЧто хочешь сделать?", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("confirm_out_"))
-async def cb_final_out(call: CallbackQuery):
-    item = call.data.replace("confirm_out_", "")
+@callbacks.prefix("confirm_out_", str)
+async def cb_final_out(call: CallbackQuery, payload: CallbackPayload):
+    item, = payload.args
     uid = call.from_user.id
     username = call.from_user.username or "User"
     name_masked = mask_name(call.from_user.first_name)
 
-    # Проверяем наличие
-    res = db.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-        (uid, item), fetchone=True
-    )
-    if not res or res['quantity'] <= 0:
-        return await call.answer("❌ Предмет не найден!", show_alert=True)
-
-    # Удаляем 1 шт
-    if res['quantity'] > 1:
-        db.execute("UPDATE inventory SET quantity = quantity - 1 WHERE user_id = ? AND item_name = ?", (uid, item))
-    else:
-        db.execute("DELETE FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item))
-
-    await bot.send_message(
-        WITHDRAWAL_CHANNEL_ID,
-        f"🎁 <b>ЗАЯВКА НА ВЫВОД</b>\n\n"
-        f"👤 Юзер: @{username}\n"
-        f"🆔 ID: <code>{uid}</code>\n"
-        f"📦 Предмет: <b>{item}</b>",
-        reply_markup=get_admin_decision_kb(uid, "GIFT")
-    )
+    try:
+        async with db.transaction():
+            # Забираем 1 шт и ставим заявку в outbox одной транзакцией
+            if not await db.take_item(uid, item):
+                raise OperationDeclined("❌ Предмет не найден!")
+            if not await db.outbox_put(
+                f"gift:{call.id}",
+                WITHDRAWAL_CHANNEL_ID,
+                f"🎁 <b>ЗАЯВКА НА ВЫВОД</b>\n\n"
+                f"👤 Юзер: @{username}\n"
+                f"🆔 ID: <code>{uid}</code>\n"
+                f"📦 Предмет: <b>{item}</b>",
+                get_admin_decision_kb(uid, "GIFT")
+            ):
+                raise OperationDeclined("⏳ Заявка уже отправлена")
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.message.edit_text(
         f"✅ Заявка на вывод <b>{item}</b> отправлена!\nОжидай сообщения от администратора.",
         reply_markup=get_main_kb(uid)
     )
 
 # ========== ЭКСКЛЮЗИВНЫЙ МАГАЗИН ==========
-@dp.callback_query(F.data == "special_shop")
+@callbacks.exact("special_shop")
 async def cb_special_shop(call: CallbackQuery):
-    specials = db.get_special_items()
+    specials = await db.get_special_items()
+    stock = await db.get_special_stock(specials.keys())
     kb = InlineKeyboardBuilder()
     for key, info in specials.items():
-        sold = db.execute(
-            "SELECT SUM(quantity) as total FROM inventory WHERE item_name = ?",
-            (info['full_name'],), fetchone=True
-        )
-        sold_cnt = sold['total'] if sold and sold['total'] else 0
-        left = info['limit'] - sold_cnt
+        entry = stock.get(key)
+        left = entry['limit'] - entry['sold'] if entry else 0
         if left > 0:
             text = f"{info['full_name']} — {info['price']} ⭐ (Осталось: {left})"
             callback = f"buy_t_{key}"
@@ -1478,48 +3916,36 @@ async def cb_special_shop(call: CallbackQuery):
         reply_markup=kb.as_markup()
     )
 
-@dp.callback_query(F.data == "sold_out")
+@callbacks.exact("sold_out")
 async def cb_sold_out(call: CallbackQuery):
     await call.answer("❌ Этот товар закончился в магазине! Ищи его на P2P.", show_alert=True)
 
-@dp.callback_query(F.data.startswith("buy_t_"))
-async def buy_special_item(call: CallbackQuery):
-    item_key = call.data.split("_")[2]
-    specials = db.get_special_items()
+@callbacks.prefix("buy_t_", str)
+async def buy_special_item(call: CallbackQuery, payload: CallbackPayload):
+    item_key, = payload.args
+    specials = await db.get_special_items()
     info = specials.get(item_key)
     if not info:
         return
     uid = call.from_user.id
-    user = db.get_user(uid)
-    if not user or user['stars'] < info['price']:
-        return await call.answer("❌ Недостаточно звёзд!", show_alert=True)
-
-    # Проверка лимита
-    sold = db.execute(
-        "SELECT SUM(quantity) as total FROM inventory WHERE item_name = ?",
-        (info['full_name'],), fetchone=True
-    )
-    sold_cnt = sold['total'] if sold and sold['total'] else 0
-    if sold_cnt >= info['limit']:
-        return await call.answer("❌ Лимит исчерпан!", show_alert=True)
-
-    db.add_stars(uid, -info['price'])
-    # Добавляем в инвентарь
-    existing = db.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-        (uid, info['full_name']), fetchone=True
-    )
-    if existing:
-        db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (uid, info['full_name']))
-    else:
-        db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (uid, info['full_name']))
+
+    try:
+        async with db.transaction():
+            # Лимит проверяется и списывается одним UPDATE; при нехватке звёзд откатится
+            if await db.reserve_special(item_key) is None:
+                raise OperationDeclined("❌ Лимит исчерпан!")
+            if await db.try_debit(uid, info['price']) is None:
+                raise OperationDeclined("❌ Недостаточно звёзд!")
+            await db.add_item(uid, info['full_name'])
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
     await call.answer(f"✅ {info['full_name']} куплен!", show_alert=True)
     await cb_special_shop(call)
 
 # ========== P2P МАРКЕТ ==========
-@dp.callback_query(F.data == "p2p_market")
+@callbacks.exact("p2p_market")
 async def cb_p2p_market(call: CallbackQuery):
-    items = db.execute("SELECT id, seller_id, item_name, price FROM marketplace", fetch=True)
+    items = await db.execute("SELECT id, seller_id, item_name, price FROM marketplace ORDER BY item_name, price", fetch=True)
     text = "🏪 <b>P2P МАРКЕТ</b>\n\nЗдесь можно перекупить эксклюзивы у игроков.\n"
     if not items:
         text += "\n<i>Лотов пока нет.</i>"
@@ -1529,9 +3955,9 @@ async def cb_p2p_market(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="menu"))
     await call.message.edit_text(text, reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("sell_p2p_"))
-async def cb_sell_item_start(call: CallbackQuery, state: FSMContext):
-    item_name = call.data.replace("sell_p2p_", "")
+@callbacks.prefix("sell_p2p_", str)
+async def cb_sell_item_start(call: CallbackQuery, state: FSMContext, payload: CallbackPayload):
+    item_name, = payload.args
     await state.update_data(sell_item=item_name)
     await state.set_state(P2PSaleStates.waiting_for_price)
     await call.message.answer(f"💰 Введи цену в ⭐, за которую хочешь продать <b>{item_name}</b>:")
@@ -1547,62 +3973,50 @@ async def process_p2p_sale_price(message: Message, state: FSMContext):
     if price <= 0:
         return await message.answer("❌ Цена должна быть больше 0!")
 
-    # Проверяем наличие предмета
-    res = db.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-        (uid, item_name), fetchone=True
-    )
-    if not res or res['quantity'] <= 0:
+    try:
+        async with db.transaction():
+            # Забираем предмет: проверка наличия и списание — один условный UPDATE
+            if not await db.take_item(uid, item_name, 1):
+                raise OperationDeclined("❌ У тебя нет этого предмета!")
+
+            # Выставляем на маркет
+            await db.execute("INSERT INTO marketplace (seller_id, item_name, price) VALUES (?, ?, ?)", (uid, item_name, price))
+    except OperationDeclined as e:
         await state.clear()
-        return await message.answer("❌ У тебя нет этого предмета!")
-
-    # Забираем предмет
-    if res['quantity'] > 1:
-        db.execute("UPDATE inventory SET quantity = quantity - 1 WHERE user_id = ? AND item_name = ?", (uid, item_name))
-    else:
-        db.execute("DELETE FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item_name))
-
-    # Выставляем на маркет
-    db.execute("INSERT INTO marketplace (seller_id, item_name, price) VALUES (?, ?, ?)", (uid, item_name, price))
+        return await message.answer(str(e))
     await message.answer(f"✅ Предмет <b>{item_name}</b> выставлен на P2P Маркет за {price} ⭐")
     await state.clear()
 
-@dp.callback_query(F.data.startswith("buy_p2p_"))
-async def cb_buy_p2p(call: CallbackQuery):
-    order_id = int(call.data.split("_")[2])
+@callbacks.prefix("buy_p2p_", int)
+async def cb_buy_p2p(call: CallbackQuery, payload: CallbackPayload):
+    order_id, = payload.args
     buyer_id = call.from_user.id
-    order = db.execute("SELECT * FROM marketplace WHERE id = ?", (order_id,), fetchone=True)
+    order = await db.execute("SELECT * FROM marketplace WHERE id = ?", (order_id,), fetchone=True)
     if not order:
         return await call.answer("❌ Товар уже продан!", show_alert=True)
     if order['seller_id'] == buyer_id:
         return await call.answer("❌ Свой товар купить нельзя!", show_alert=True)
-    buyer = db.get_user(buyer_id)
-    if not buyer or buyer['stars'] < order['price']:
-        return await call.answer("❌ Недостаточно ⭐", show_alert=True)
-
-    # Списать с покупателя, начислить продавцу (комиссия 10%)
-    db.add_stars(buyer_id, -order['price'])
-    seller_income = order['price'] * 0.9
-    db.add_stars(order['seller_id'], seller_income)
-
-    # Добавить предмет покупателю
-    existing = db.execute(
-        "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-        (buyer_id, order['item_name']), fetchone=True
-    )
-    if existing:
-        db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (buyer_id, order['item_name']))
-    else:
-        db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (buyer_id, order['item_name']))
-
-    # Удалить лот
-    db.execute("DELETE FROM marketplace WHERE id = ?", (order_id,))
+    try:
+        async with db.transaction():
+            # Лот достаётся тому, чей DELETE прошёл первым
+            if not await db.execute("DELETE FROM marketplace WHERE id = ? RETURNING id", (order_id,), fetchone=True):
+                raise OperationDeclined("❌ Товар уже продан!")
+            # Списать с покупателя, начислить продавцу (комиссия 10%)
+            if await db.try_debit(buyer_id, order['price']) is None:
+                raise OperationDeclined("❌ Недостаточно ⭐")
+            seller_income = order['price'] * 0.9
+            await db.add_stars(order['seller_id'], seller_income)
+
+            # Добавить предмет покупателю
+            await db.add_item(buyer_id, order['item_name'])
+    except OperationDeclined as e:
+        return await call.answer(str(e), show_alert=True)
 
     await call.answer(f"✅ Успешно куплен {order['item_name']}!", show_alert=True)
     await cb_p2p_market(call)
 
 # ========== ПРОМОКОДЫ ==========
-@dp.callback_query(F.data == "use_promo")
+@callbacks.exact("use_promo")
 async def promo_start(call: CallbackQuery, state: FSMContext):
     await state.set_state(PromoStates.waiting_for_code)
     await call.message.answer("⌨️ Введи промокод:")
@@ -1612,7 +4026,7 @@ async def promo_process(message: Message, state: FSMContext):
     code = message.text.strip()
     uid = message.from_user.id
 
-    already = db.execute(
+    already = await db.execute(
         "SELECT 1 FROM promo_history WHERE user_id = ? AND code = ?",
         (uid, code), fetchone=True
     )
@@ -1620,37 +4034,37 @@ async def promo_process(message: Message, state: FSMContext):
         await state.clear()
         return await message.answer("❌ Ты уже активировал этот промокод!")
 
-    promo = db.execute(
-        "SELECT * FROM promo WHERE code = ? AND uses > 0",
-        (code,), fetchone=True
-    )
-    if not promo:
+    try:
+        async with db.transaction():
+            # Проверка и уменьшение лимита одним условным UPDATE: активаций не уйдёт больше, чем uses
+            promo = await db.execute(
+                "UPDATE promo SET uses = uses - 1 WHERE code = ? AND uses > 0 RETURNING reward_type, reward_value",
+                (code,), fetchone=True
+            )
+            if not promo:
+                raise OperationDeclined("❌ Код неверный или закончились активации.")
+            if not await db.execute(
+                "INSERT INTO promo_history (user_id, code) VALUES (?, ?) ON CONFLICT DO NOTHING RETURNING code",
+                (uid, code), fetchone=True
+            ):
+                raise OperationDeclined("❌ Ты уже активировал этот промокод!")
+            if promo['reward_type'] == 'stars':
+                await db.add_stars(uid, float(promo['reward_value']))
+            else:
+                await db.add_item(uid, promo['reward_value'])
+    except OperationDeclined as e:
         await state.clear()
-        return await message.answer("❌ Код неверный или закончились активации.")
-
-    # Уменьшаем лимит использований
-    db.execute("UPDATE promo SET uses = uses - 1 WHERE code = ?", (code,))
-    db.execute("INSERT INTO promo_history (user_id, code) VALUES (?, ?)", (uid, code))
+        return await message.answer(str(e))
 
     if promo['reward_type'] == 'stars':
-        db.add_stars(uid, float(promo['reward_value']))
         await message.answer(f"✅ Активировано! +{promo['reward_value']} ⭐")
     else:
-        item = promo['reward_value']
-        existing = db.execute(
-            "SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?",
-            (uid, item), fetchone=True
-        )
-        if existing:
-            db.execute("UPDATE inventory SET quantity = quantity + 1 WHERE user_id = ? AND item_name = ?", (uid, item))
-        else:
-            db.execute("INSERT INTO inventory (user_id, item_name, quantity) VALUES (?, ?, 1)", (uid, item))
-        await message.answer(f"✅ Активировано! Получен предмет: {item}")
+        await message.answer(f"✅ Активировано! Получен предмет: {promo['reward_value']}")
     await state.clear()
 
 # =============== ЧЕКИ (ИСПРАВЛЕНО) ===============
 
-@dp.callback_query(F.data == "create_check")
+@callbacks.exact("create_check")
 async def create_check_start(call: CallbackQuery, state: FSMContext):
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="⭐ Звёзды", callback_data="check_type_stars"))
@@ -1659,16 +4073,16 @@ async def create_check_start(call: CallbackQuery, state: FSMContext):
     await call.message.edit_text("Выбери тип чека:", reply_markup=kb.as_markup())
     await state.set_state(CreateCheckStates.waiting_for_type)
 
-@dp.callback_query(CreateCheckStates.waiting_for_type, F.data.startswith("check_type_"))
-async def create_check_type(call: CallbackQuery, state: FSMContext):
-    ctype = call.data.split("_")[2]  # stars или item
+@callbacks.prefix("check_type_", str, state=CreateCheckStates.waiting_for_type)
+async def create_check_type(call: CallbackQuery, state: FSMContext, payload: CallbackPayload):
+    ctype, = payload.args  # stars или item
     await state.update_data(ctype=ctype)
     if ctype == "stars":
         await call.message.answer("Введи количество звёзд (например: 50):")
     else:
         # Показываем список предметов из инвентаря
         uid = call.from_user.id
-        items = db.execute("SELECT item_name, quantity FROM inventory WHERE user_id = ?", (uid,), fetch=True)
+        items = await db.execute("SELECT item_name, quantity FROM inventory WHERE user_id = ?", (uid,), fetch=True)
         if not items:
             await state.clear()
             return await call.answer("У тебя нет предметов для создания чека!", show_alert=True)
@@ -1687,9 +4101,9 @@ async def create_check_value(message: Message, state: FSMContext):
     if ctype == 'stars':
         try:
             amount = float(value)
-            if amount <= 0:
+            if not math.isfinite(amount) or amount <= 0:
                 raise ValueError
-            user = db.get_user_safe(uid)
+            user = await db.get_user_safe(uid)
             if user['stars'] < amount:
                 await message.answer("❌ Недостаточно звёзд!")
                 return
@@ -1698,7 +4112,7 @@ async def create_check_value(message: Message, state: FSMContext):
             return
     else:
         item = value
-        res = db.execute("SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item), fetchone=True)
+        res = await db.execute("SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item), fetchone=True)
         if not res or res['quantity'] <= 0:
             await message.answer("❌ У тебя нет такого предмета!")
             return
@@ -1734,36 +4148,32 @@ async def create_check_max_uses(message: Message, state: FSMContext):
 
     if ctype == 'stars':
         total_amount = float(value)
-        user = db.get_user_safe(uid)
-        if user['stars'] < total_amount:
-            await message.answer("❌ Недостаточно звёзд!")
-            await state.clear()
-            return
-        db.add_stars(uid, -total_amount)
         stored_value = str(total_amount)
     else:  # предмет
         item = value
-        res = db.execute("SELECT quantity FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item), fetchone=True)
-        if not res or res['quantity'] < max_uses:
-            await message.answer(f"❌ У тебя недостаточно предметов! Нужно {max_uses} шт.")
-            await state.clear()
-            return
-        if res['quantity'] > max_uses:
-            db.execute("UPDATE inventory SET quantity = quantity - ? WHERE user_id = ? AND item_name = ?", (max_uses, uid, item))
-        else:
-            db.execute("DELETE FROM inventory WHERE user_id = ? AND item_name = ?", (uid, item))
         stored_value = item
 
     # Генерируем ID чека
     check_id = ''.join(random.choices(string.ascii_uppercase + string.digits, k=8))
-    db.execute(
-        "INSERT INTO checks (id, creator_id, type, value, password, max_uses) VALUES (?, ?, ?, ?, ?, ?)",
-        (check_id, uid, ctype, stored_value, password, max_uses)
-    )
+    # Списание и создание чека — одна транзакция
+    try:
+        async with db.transaction():
+            if ctype == 'stars':
+                if await db.try_debit(uid, total_amount) is None:
+                    raise OperationDeclined("❌ Недостаточно звёзд!")
+            elif not await db.take_item(uid, item, max_uses):
+                raise OperationDeclined(f"❌ У тебя недостаточно предметов! Нужно {max_uses} шт.")
+            await db.execute(
+                "INSERT INTO checks (id, creator_id, type, value, password, max_uses) VALUES (?, ?, ?, ?, ?, ?)",
+                (check_id, uid, ctype, stored_value, password, max_uses)
+            )
+    except OperationDeclined as e:
+        await message.answer(str(e))
+        await state.clear()
+        return
 
     # Создаём глубокую ссылку
-    bot_username = (await bot.get_me()).username
-    deep_link = f"https://t.me/{bot_username}?start=check_{check_id}"
+    deep_link = await identity.check_link(check_id)
 
     # Формируем текст
     if ctype == 'stars':
@@ -1784,7 +4194,7 @@ async def create_check_max_uses(message: Message, state: FSMContext):
     await state.clear()
     
 # ========== АДМИН ПАНЕЛЬ ==========
-@dp.callback_query(F.data == "admin_panel")
+@callbacks.exact("admin_panel")
 async def cb_admin_panel(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return await call.answer("❌ Нет доступа!", show_alert=True)
@@ -1814,7 +4224,7 @@ async def cb_admin_panel(call: CallbackQuery):
     await call.message.edit_text("👑 <b>АДМИН-МЕНЮ</b>", reply_markup=kb.as_markup())
 
 
-@dp.callback_query(F.data == "a_quests")
+@callbacks.exact("a_quests")
 async def a_quests_menu(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -1826,7 +4236,7 @@ async def a_quests_menu(call: CallbackQuery):
     
 
 # --- Рассылка ---
-@dp.callback_query(F.data == "a_broadcast")
+@callbacks.exact("a_broadcast")
 async def adm_broadcast_start(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -1837,47 +4247,83 @@ async def adm_broadcast_start(call: CallbackQuery, state: FSMContext):
         reply_markup=InlineKeyboardBuilder().row(InlineKeyboardButton(text="❌ Отмена", callback_data="admin_panel")).as_markup()
     )
 
-@dp.message(AdminStates.waiting_broadcast_msg)
-async def adm_broadcast_confirm(message: Message, state: FSMContext):
-    await state.update_data(broadcast_msg_id=message.message_id, broadcast_chat_id=message.chat.id)
+def get_broadcast_confirm_kb() -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     kb.row(InlineKeyboardButton(text="🚀 НАЧАТЬ", callback_data="confirm_broadcast_send"))
+    kb.row(InlineKeyboardButton(text="🎯 Выбрать сегмент", callback_data="broadcast_segment"))
     kb.row(InlineKeyboardButton(text="❌ Отмена", callback_data="admin_panel"))
-    await message.answer("👆 <b>Это превью сообщения.</b>\nНачать рассылку для всех пользователей?",
-                         reply_markup=kb.as_markup())
+    return kb.as_markup()
+
+@dp.message(AdminStates.waiting_broadcast_msg)
+async def adm_broadcast_confirm(message: Message, state: FSMContext):
+    await state.update_data(broadcast_msg_id=message.message_id, broadcast_chat_id=message.chat.id, broadcast_segment='')
+    total = await db.count_segment()
+    await message.answer(f"👆 <b>Это превью сообщения.</b>\nНачать рассылку для всех пользователей ({total} чел.)?",
+                         reply_markup=get_broadcast_confirm_kb())
 
-@dp.callback_query(F.data == "confirm_broadcast_send")
+@callbacks.exact("broadcast_segment")
+async def adm_broadcast_segment_start(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        return
+    await state.set_state(AdminStates.waiting_broadcast_segment)
+    await call.message.answer(
+        "🎯 <b>Сегмент рассылки</b>\n\n"
+        "Введи условия через пробел (или «все»):\n"
+        "<code>active=1</code> — активные, <code>premium=1</code> — премиум-режим казино\n"
+        "<code>ref=1</code> — пришли по реферальной ссылке\n"
+        "<code>stars>=10</code>, <code>stars<=100</code> — баланс\n"
+        "<code>earned>=50</code> — всего заработано\n"
+        "<code>days<=7</code> — заходили за последние 7 дней\n\n"
+        "Пример: <code>active=1 days<=3 stars>=5</code>"
+    )
+
+@dp.message(AdminStates.waiting_broadcast_segment)
+async def adm_broadcast_segment_set(message: Message, state: FSMContext):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    try:
+        segment = Segment.parse(message.text)
+    except ValueError as e:
+        return await message.answer(f"❌ {e}")
+    total = await db.count_segment(segment.dumps())
+    await state.update_data(broadcast_segment=segment.dumps())
+    await state.set_state(None)
+    await message.answer(f"🎯 Сегмент: <b>{segment.describe()}</b>\n👥 Получателей: <b>{total}</b>\n\nНачать рассылку?",
+                         reply_markup=get_broadcast_confirm_kb())
+
+@callbacks.exact("confirm_broadcast_send")
 async def adm_broadcast_run(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        return
     data = await state.get_data()
     msg_id = data.get("broadcast_msg_id")
     from_chat = data.get("broadcast_chat_id")
     await state.clear()
-
-    # Получаем всех пользователей
-    rows = db.execute("SELECT user_id FROM users", fetch=True)
-    users = [row['user_id'] for row in rows]
-    if not users:
+    if not msg_id:
+        return await call.answer("❌ Сообщение для рассылки не найдено", show_alert=True)
+
+    job_id = await db.create_broadcast(call.from_user.id, from_chat, msg_id,
+                                       call.message.chat.id, call.message.message_id,
+                                       data.get("broadcast_segment", ""))
+    job = await db.get_broadcast(job_id)
+    if not job['total']:
+        await db.finish_broadcast(job_id, 'done')
         return await call.message.answer("❌ Нет пользователей для рассылки.")
+    await call.message.edit_text(f"⏳ Рассылка #{job_id} запущена для {job['total']} чел...")
+    # Рассылка идёт в фоне, обработчик сразу освобождается
+    broadcasts.start(job_id)
 
-    await call.message.edit_text(f"⏳ Рассылка запущена для {len(users)} чел...")
-    count = 0
-    err = 0
-    for uid in users:
-        try:
-            await bot.copy_message(chat_id=uid, from_chat_id=from_chat, message_id=msg_id)
-            count += 1
-            await asyncio.sleep(0.05)
-        except Exception:
-            err += 1
-    await call.message.answer(
-        f"✅ <b>Рассылка завершена!</b>\n\n"
-        f"📊 Успешно: {count}\n"
-        f"🚫 Ошибок: {err}"
-    )
-    db.log_admin(call.from_user.id, "broadcast", f"Успешно: {count}, ошибок: {err}")
+@callbacks.prefix("bc_cancel_", int)
+async def adm_broadcast_cancel(call: CallbackQuery, payload: CallbackPayload):
+    if call.from_user.id not in ADMIN_IDS:
+        return
+    if broadcasts.cancel(payload.args[0]):
+        await call.answer("⛔ Рассылка будет остановлена", show_alert=True)
+    else:
+        await call.answer("Рассылка уже завершена", show_alert=True)
 
 # --- Выдача звёзд ---
-@dp.callback_query(F.data == "a_give_stars")
+@callbacks.exact("a_give_stars")
 async def adm_give_stars_start(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -1899,27 +4345,24 @@ async def adm_give_stars_process(message: Message, state: FSMContext):
             return await message.answer("❌ Введи два числа: ID и сумму.")
         target_id = int(data[0])
         amount = float(data[1])
-        user = db.get_user(target_id)
+        user = await db.get_user(target_id)
         if not user:
             return await message.answer(f"❌ Пользователь с ID <code>{target_id}</code> не найден!")
-        db.add_stars(target_id, amount)
+        await db.add_stars(target_id, amount)
         await message.answer(
             f"✅ <b>УСПЕШНО!</b>\n\n"
             f"Пользователю: <b>{user['first_name']}</b> (<code>{target_id}</code>)\n"
             f"Начислено: <b>{amount} ⭐</b>",
             reply_markup=InlineKeyboardBuilder().row(InlineKeyboardButton(text="🔙 В админку", callback_data="admin_panel")).as_markup()
         )
-        try:
-            await bot.send_message(target_id, f"🎁 Администратор начислил тебе <b>{amount} ⭐</b>!")
-        except:
-            pass
-        db.log_admin(message.from_user.id, "give_stars", f"Пользователю {target_id} сумма {amount}")
+        await notify_user(target_id, f"🎁 Администратор начислил тебе <b>{amount} ⭐</b>!")
+        await db.log_admin(message.from_user.id, "give_stars", f"Пользователю {target_id} сумма {amount}")
         await state.clear()
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
 
 # --- Создание промокода ---
-@dp.callback_query(F.data == "a_create_promo")
+@callbacks.exact("a_create_promo")
 async def adm_promo_start(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -1937,15 +4380,15 @@ async def adm_promo_save(message: Message, state: FSMContext):
     try:
         code, r_type, val, uses = message.text.split()
         uses = int(uses)
-        db.execute("INSERT INTO promo VALUES (?, ?, ?, ?)", (code, r_type, val, uses))
+        await db.execute("INSERT INTO promo VALUES (?, ?, ?, ?)", (code, r_type, val, uses))
         await message.answer(f"✅ Промокод <code>{code}</code> создан на {uses} использований!")
-        db.log_admin(message.from_user.id, "create_promo", f"Код {code}, тип {r_type}, значение {val}, лимит {uses}")
+        await db.log_admin(message.from_user.id, "create_promo", f"Код {code}, тип {r_type}, значение {val}, лимит {uses}")
         await state.clear()
     except Exception as e:
         await message.answer("❌ Ошибка! Формат: <code>КОД ТИП ЗНАЧЕНИЕ КОЛИЧЕСТВО</code>")
 
 # --- Пост в канал ---
-@dp.callback_query(F.data == "a_post_chan")
+@callbacks.exact("a_post_chan")
 async def adm_post_start(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -1958,40 +4401,43 @@ async def adm_post_start(call: CallbackQuery, state: FSMContext):
 @dp.message(AdminStates.waiting_channel_post)
 async def adm_post_end(message: Message, state: FSMContext):
     pid = f"v_{random.randint(100, 999)}"
-    view_reward = float(db.get_config('view_reward', 0.3))
+    view_reward = await db.get_config_float('view_reward', 0.3)
     kb = InlineKeyboardBuilder().row(
         InlineKeyboardButton(text=f"💰 Забрать {view_reward} ⭐", callback_data=f"claim_{pid}")
     ).as_markup()
-    await bot.send_message(CHANNEL_ID, message.text, reply_markup=kb)
+    try:
+        await outbound.send_message(CHANNEL_ID, message.text, OutboundQueue.ADMIN, reply_markup=kb)
+    except Exception as e:
+        return await message.answer(f"❌ Не удалось опубликовать: {e}")
     await message.answer("✅ Опубликовано!")
-    db.log_admin(message.from_user.id, "channel_post", f"Пост с id {pid}")
+    await db.log_admin(message.from_user.id, "channel_post", f"Пост с id {pid}")
     await state.clear()
 
-@dp.callback_query(F.data.startswith("claim_"))
-async def cb_claim(call: CallbackQuery):
-    pid = call.data.split("_")[1]
+@callbacks.prefix("claim_", str)
+async def cb_claim(call: CallbackQuery, payload: CallbackPayload):
+    pid = payload.args[0].split("_")[0]
     uid = call.from_user.id
-    user = db.get_user(uid)
+    user = await db.get_user(uid)
     if not user:
         return await call.answer("❌ Запусти бота командой /start", show_alert=True)
     # Проверка, забирал ли уже
-    check = db.execute(
+    check = await db.execute(
         "SELECT 1 FROM task_claims WHERE user_id = ? AND task_id = ?",
         (uid, f"post_{pid}"), fetchone=True
     )
     if check:
         return await call.answer("❌ Ты уже забрал награду!", show_alert=True)
-    view_reward = float(db.get_config('view_reward', 0.3))
-    db.add_stars(uid, view_reward)
-    db.execute("INSERT INTO task_claims (user_id, task_id) VALUES (?, ?)", (uid, f"post_{pid}"))
+    view_reward = await db.get_config_float('view_reward', 0.3)
+    await db.add_stars(uid, view_reward)
+    await db.execute("INSERT INTO task_claims (user_id, task_id) VALUES (?, ?)", (uid, f"post_{pid}"))
     await call.answer(f"✅ +{view_reward} ⭐", show_alert=True)
 
 # --- Фейк заявка ---
-@dp.callback_query(F.data == "a_fake_gen")
+@callbacks.exact("a_fake_gen")
 async def adm_fake(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return
-    gifts = db.get_gifts_prices()
+    gifts = await db.get_gifts_prices()
     fake_item = random.choice(list(gifts.keys())) if gifts else "Подарок"
     fake_names = ["Dmitry_ST", "Sasha_Official", "Rich_Boy", "CryptoKing", "Masha_Stars", "Legenda_77"]
     name = random.choice(fake_names)
@@ -2002,29 +4448,25 @@ async def adm_fake(call: CallbackQuery):
         f"🆔 ID: <code>{fid}</code>\n"
         f"📦 Предмет: <b>{fake_item}</b>"
     )
-    await bot.send_message(WITHDRAWAL_CHANNEL_ID, text, reply_markup=get_admin_decision_kb(0, "GIFT"))
+    outbound.enqueue_message(WITHDRAWAL_CHANNEL_ID, text, OutboundQueue.ADMIN, reply_markup=get_admin_decision_kb(0, "GIFT"))
     await call.answer("✅ Реалистичный фейк отправлен!")
-    db.log_admin(call.from_user.id, "fake_withdraw", f"Фейк предмет {fake_item}")
+    await db.log_admin(call.from_user.id, "fake_withdraw", f"Фейк предмет {fake_item}")
 
 # --- Запуск лотереи ---
-@dp.callback_query(F.data == "a_run_lottery")
+@callbacks.exact("a_run_lottery")
 async def adm_run_lottery(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return
-    data = db.execute("SELECT pool, participants FROM lottery WHERE id = 1", fetchone=True)
-    if not data or not data['participants']:
+    result = await db.draw_lottery()
+    if not result:
         return await call.answer("❌ Нет участников!", show_alert=True)
-    participants = [p for p in data['participants'].split(',') if p]
-    winner_id = int(random.choice(participants))
-    win_amount = data['pool'] * 0.8
-    db.execute("UPDATE lottery SET pool = 0, participants = '' WHERE id = 1")
-    db.add_stars(winner_id, win_amount)
-    await bot.send_message(winner_id, f"🥳 <b>ПОЗДРАВЛЯЕМ!</b>\nТы выиграл в лотерее: <b>{win_amount:.2f} ⭐</b>")
+    winner_id, win_amount = result
+    await notify_user(winner_id, f"🥳 <b>ПОЗДРАВЛЯЕМ!</b>\nТы выиграл в лотерее: <b>{win_amount:.2f} ⭐</b>")
     await call.message.answer(f"✅ Лотерея завершена! Победитель: {winner_id}, сумма: {win_amount:.2f}")
-    db.log_admin(call.from_user.id, "run_lottery", f"Победитель {winner_id}, сумма {win_amount}")
+    await db.log_admin(call.from_user.id, "run_lottery", f"Победитель {winner_id}, сумма {win_amount}")
 
 # --- Меню настроек бота ---
-@dp.callback_query(F.data == "a_config_menu")
+@callbacks.exact("a_config_menu")
 async def adm_config_menu(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -2034,34 +4476,35 @@ async def adm_config_menu(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="📅 Ежедневный мин/макс", callback_data="edit_config_daily"))
     kb.row(InlineKeyboardButton(text="🎰 Удача мин/макс/кулдаун", callback_data="edit_config_luck"))
     kb.row(InlineKeyboardButton(text="💎 Суммы вывода", callback_data="edit_config_withdraw"))
+    kb.row(InlineKeyboardButton(text="🏆 Размер топа", callback_data="edit_config_top_size"))
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel"))
     await call.message.edit_text("⚙️ <b>Настройки бота</b>\nВыбери параметр для изменения:", reply_markup=kb.as_markup())
 
 # Редактирование реферальной награды
-@dp.callback_query(F.data == "edit_config_ref_reward")
+@callbacks.exact("edit_config_ref_reward")
 async def edit_ref_reward(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    current = db.get_config('ref_reward', '5.0')
+    current = await db.get_config('ref_reward', '5.0')
     await state.set_state(AdminStates.waiting_config_value)
     await state.update_data(config_key='ref_reward')
     await call.message.answer(f"Текущее значение: <b>{current}</b>\nВведи новую награду за реферала (число):")
 
-@dp.callback_query(F.data == "edit_config_view_reward")
+@callbacks.exact("edit_config_view_reward")
 async def edit_view_reward(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    current = db.get_config('view_reward', '0.3')
+    current = await db.get_config('view_reward', '0.3')
     await state.set_state(AdminStates.waiting_config_value)
     await state.update_data(config_key='view_reward')
     await call.message.answer(f"Текущее значение: <b>{current}</b>\nВведи новую награду за просмотр поста (число):")
 
-@dp.callback_query(F.data == "edit_config_daily")
+@callbacks.exact("edit_config_daily")
 async def edit_daily(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    current_min = db.get_config('daily_min', '1')
-    current_max = db.get_config('daily_max', '3')
+    current_min = await db.get_config('daily_min', '1')
+    current_max = await db.get_config('daily_max', '3')
     await state.set_state(AdminStates.waiting_config_value)
     await state.update_data(config_key='daily')
     await call.message.answer(
@@ -2069,13 +4512,13 @@ async def edit_daily(call: CallbackQuery, state: FSMContext):
         "Введи новые минимум и максимум через пробел (например: 2 5):"
     )
 
-@dp.callback_query(F.data == "edit_config_luck")
+@callbacks.exact("edit_config_luck")
 async def edit_luck(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    current_min = db.get_config('luck_min', '0')
-    current_max = db.get_config('luck_max', '5')
-    current_cd = db.get_config('luck_cooldown', '21600')
+    current_min = await db.get_config('luck_min', '0')
+    current_max = await db.get_config('luck_max', '5')
+    current_cd = await db.get_config('luck_cooldown', '21600')
     await state.set_state(AdminStates.waiting_config_value)
     await state.update_data(config_key='luck')
     await call.message.answer(
@@ -2083,11 +4526,11 @@ async def edit_luck(call: CallbackQuery, state: FSMContext):
         "Введи новые минимум, максимум и кулдаун через пробел (например: 1 10 3600):"
     )
 
-@dp.callback_query(F.data == "edit_config_withdraw")
+@callbacks.exact("edit_config_withdraw")
 async def edit_withdraw(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    current = db.get_config('withdrawal_options', '15,25,50,100')
+    current = await db.get_config('withdrawal_options', '15,25,50,100')
     await state.set_state(AdminStates.waiting_config_value)
     await state.update_data(config_key='withdrawal_options')
     await call.message.answer(
@@ -2095,6 +4538,15 @@ async def edit_withdraw(call: CallbackQuery, state: FSMContext):
         "Введи новые суммы через запятую (например: 10,20,30,50,100):"
     )
 
+@callbacks.exact("edit_config_top_size")
+async def edit_top_size(call: CallbackQuery, state: FSMContext):
+    if call.from_user.id not in ADMIN_IDS:
+        return
+    current = await db.get_config('top_size', '10')
+    await state.set_state(AdminStates.waiting_config_value)
+    await state.update_data(config_key='top_size')
+    await call.message.answer(f"Текущий размер топа: <b>{current}</b>\nВведи новый (от 3 до {Leaderboard.MAX_SIZE}):")
+
 @dp.message(AdminStates.waiting_config_value)
 async def set_config_value(message: Message, state: FSMContext):
     data = await state.get_data()
@@ -2103,7 +4555,7 @@ async def set_config_value(message: Message, state: FSMContext):
     try:
         if key in ('ref_reward', 'view_reward'):
             new_val = float(text)
-            db.set_config(key, str(new_val))
+            await db.set_config(key, str(new_val))
             await message.answer(f"✅ Параметр <b>{key}</b> изменён на {new_val}")
         elif key == 'daily':
             parts = text.split()
@@ -2111,8 +4563,8 @@ async def set_config_value(message: Message, state: FSMContext):
                 raise ValueError
             min_val = float(parts[0])
             max_val = float(parts[1])
-            db.set_config('daily_min', str(min_val))
-            db.set_config('daily_max', str(max_val))
+            await db.set_config('daily_min', str(min_val))
+            await db.set_config('daily_max', str(max_val))
             await message.answer(f"✅ Ежедневный бонус изменён: мин {min_val}, макс {max_val}")
         elif key == 'luck':
             parts = text.split()
@@ -2121,22 +4573,28 @@ async def set_config_value(message: Message, state: FSMContext):
             min_val = float(parts[0])
             max_val = float(parts[1])
             cd = int(parts[2])
-            db.set_config('luck_min', str(min_val))
-            db.set_config('luck_max', str(max_val))
-            db.set_config('luck_cooldown', str(cd))
+            await db.set_config('luck_min', str(min_val))
+            await db.set_config('luck_max', str(max_val))
+            await db.set_config('luck_cooldown', str(cd))
             await message.answer(f"✅ Удача изменена: мин {min_val}, макс {max_val}, кулдаун {cd} сек")
         elif key == 'withdrawal_options':
             # проверяем, что это числа через запятую
             options = [int(x.strip()) for x in text.split(',') if x.strip()]
             if not options:
                 raise ValueError
-            db.set_config('withdrawal_options', ','.join(str(x) for x in options))
+            await db.set_config('withdrawal_options', ','.join(str(x) for x in options))
             await message.answer(f"✅ Суммы вывода изменены: {', '.join(str(x) for x in options)}")
+        elif key == 'top_size':
+            size = int(text)
+            if not 3 <= size <= Leaderboard.MAX_SIZE:
+                raise ValueError
+            await db.set_config('top_size', str(size))
+            await message.answer(f"✅ Размер топа изменён: {size}")
         else:
             await message.answer("❌ Неизвестный параметр")
             await state.clear()
             return
-        db.log_admin(message.from_user.id, "change_config", f"{key} = {text}")
+        await db.log_admin(message.from_user.id, "change_config", f"{key} = {text}")
     except Exception:
         await message.answer("❌ Ошибка ввода! Проверь формат.")
         return
@@ -2144,7 +4602,7 @@ async def set_config_value(message: Message, state: FSMContext):
     await adm_config_menu(await message.answer("⚙️ Настройки", reply_markup=InlineKeyboardBuilder().row(InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")).as_markup()))
 
 # --- Глобальные бусты ---
-@dp.callback_query(F.data == "a_global_boost_menu")
+@callbacks.exact("a_global_boost_menu")
 async def adm_global_boost_menu(call: CallbackQuery):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -2157,36 +4615,33 @@ async def adm_global_boost_menu(call: CallbackQuery):
     kb.row(InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel"))
     await call.message.edit_text("📈 <b>Глобальные бусты</b>\nВыбери действие:", reply_markup=kb.as_markup())
 
-@dp.callback_query(F.data.startswith("set_boost_"))
-async def set_boost_handler(call: CallbackQuery):
+@callbacks.prefix("set_boost_", str, float, optional=(int,))
+async def set_boost_handler(call: CallbackQuery, payload: CallbackPayload):
     if call.from_user.id not in ADMIN_IDS:
         return
-    parts = call.data.split("_")
     # Формат: set_boost_{type}_{mult}_{duration} или set_boost_{type}_{mult}
-    boost_type = parts[2]  # ref или game
-    mult = float(parts[3])
-    duration = int(parts[4]) if len(parts) > 4 else None
-    db.set_global_boost(boost_type, mult, duration)
+    boost_type, mult, duration = payload.args  # ref или game; без длительности — None
+    await db.set_global_boost(boost_type, mult, duration)
     await call.answer(f"✅ Буст {boost_type} x{mult} активирован!", show_alert=True)
-    db.log_admin(call.from_user.id, "global_boost", f"{boost_type} x{mult} на {duration} сек")
+    await db.log_admin(call.from_user.id, "global_boost", f"{boost_type} x{mult} на {duration} сек")
     await adm_global_boost_menu(call)
 
-@dp.callback_query(F.data.startswith("disable_boost_"))
-async def disable_boost_handler(call: CallbackQuery):
+@callbacks.prefix("disable_boost_", str)
+async def disable_boost_handler(call: CallbackQuery, payload: CallbackPayload):
     if call.from_user.id not in ADMIN_IDS:
         return
-    boost_type = call.data.replace("disable_boost_", "")
-    db.disable_global_boost(boost_type)
+    boost_type, = payload.args
+    await db.disable_global_boost(boost_type)
     await call.answer(f"✅ Буст {boost_type} выключен!", show_alert=True)
-    db.log_admin(call.from_user.id, "global_boost", f"Выключен {boost_type}")
+    await db.log_admin(call.from_user.id, "global_boost", f"Выключен {boost_type}")
     await adm_global_boost_menu(call)
 
 # --- Редактирование цен подарков ---
-@dp.callback_query(F.data == "a_edit_gifts")
+@callbacks.exact("a_edit_gifts")
 async def adm_edit_gifts(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    gifts = db.get_gifts_prices()
+    gifts = await db.get_gifts_prices()
     text = "🛍 <b>Текущие цены подарков:</b>\n"
     for name, price in gifts.items():
         text += f"{name}: {price} ⭐\n"
@@ -2204,24 +4659,24 @@ async def set_gift_price(message: Message, state: FSMContext):
             return await message.answer("❌ Формат: название цена")
         item_name = parts[0].strip()
         price = float(parts[1])
-        gifts = db.get_gifts_prices()
+        gifts = dict(await db.get_gifts_prices())
         if item_name not in gifts:
             return await message.answer("❌ Товар не найден в списке!")
         gifts[item_name] = price
-        db.set_config('gifts_prices', json.dumps(gifts, ensure_ascii=False))
+        await db.set_config('gifts_prices', json.dumps(gifts, ensure_ascii=False))
         await message.answer(f"✅ Цена для <b>{item_name}</b> изменена на {price} ⭐")
-        db.log_admin(message.from_user.id, "edit_gift_price", f"{item_name} = {price}")
+        await db.log_admin(message.from_user.id, "edit_gift_price", f"{item_name} = {price}")
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
     await state.clear()
     await adm_config_menu(await message.answer("⚙️ Настройки", reply_markup=InlineKeyboardBuilder().row(InlineKeyboardButton(text="🔙 Назад", callback_data="admin_panel")).as_markup()))
 
 # --- Редактирование эксклюзивных товаров ---
-@dp.callback_query(F.data == "a_edit_specials")
+@callbacks.exact("a_edit_specials")
 async def adm_edit_specials(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
-    specials = db.get_special_items()
+    specials = await db.get_special_items()
     text = "📦 <b>Эксклюзивные товары (текущие лимиты и цены):</b>\n"
     for key, info in specials.items():
         text += f"{info['full_name']}: цена {info['price']} ⭐, лимит {info['limit']}\n"
@@ -2241,14 +4696,16 @@ async def set_special_item(message: Message, state: FSMContext):
         key = parts[0].strip()
         price = float(parts[1])
         limit = int(parts[2])
-        specials = db.get_special_items()
+        specials = copy.deepcopy(await db.get_special_items())
         if key not in specials:
             return await message.answer("❌ Ключ не найден! Доступны: Ramen, Candle, Calendar")
         specials[key]['price'] = price
         specials[key]['limit'] = limit
-        db.set_config('special_items', json.dumps(specials, ensure_ascii=False))
+        async with db.transaction():
+            await db.set_config('special_items', json.dumps(specials, ensure_ascii=False))
+            await db.set_special_limit(key, limit)
         await message.answer(f"✅ Товар <b>{specials[key]['full_name']}</b> обновлён: цена {price}, лимит {limit}")
-        db.log_admin(message.from_user.id, "edit_special", f"{key} price={price} limit={limit}")
+        await db.log_admin(message.from_user.id, "edit_special", f"{key} price={price} limit={limit}")
     except Exception as e:
         await message.answer(f"❌ Ошибка: {e}")
     await state.clear()
@@ -2256,7 +4713,7 @@ async def set_special_item(message: Message, state: FSMContext):
 
 # ========== АДМИНКА: СОЗДАНИЕ КВЕСТА (ИСПРАВЛЕНО) ==========
 
-@dp.callback_query(F.data == "a_quest_create")
+@callbacks.exact("a_quest_create")
 async def a_quest_create_start(call: CallbackQuery, state: FSMContext):
     if call.from_user.id not in ADMIN_IDS:
         return
@@ -2279,9 +4736,9 @@ async def a_quest_create_desc(message: Message, state: FSMContext):
     await message.answer("Выбери тип квеста:", reply_markup=kb.as_markup())
     await state.set_state(AdminQuestCreation.waiting_for_type)
 
-@dp.callback_query(AdminQuestCreation.waiting_for_type, F.data.startswith("quest_type_"))
-async def a_quest_create_type(call: CallbackQuery, state: FSMContext):
-    qtype = call.data.split("_")[2]  # sub, forward, view
+@callbacks.prefix("quest_type_", str, state=AdminQuestCreation.waiting_for_type)
+async def a_quest_create_type(call: CallbackQuery, state: FSMContext, payload: CallbackPayload):
+    qtype, = payload.args  # sub, forward, view
     await state.update_data(type=qtype)
     if qtype == 'sub':
         await call.message.answer("Введи ID канала (например: -100123456789):")
@@ -2321,7 +4778,7 @@ async def a_quest_create_next(message: Message, state: FSMContext):
         await message.answer("❌ Введи число или 0")
         return
     data = await state.get_data()
-    db.execute(
+    await db.execute(
         "INSERT INTO quests (name, description, type, target, reward, next_quest_id) VALUES (?, ?, ?, ?, ?, ?)",
         (data['name'], data['description'], data['type'], data.get('target', ''), data['reward'], next_id)
     )
@@ -2329,14 +4786,13 @@ async def a_quest_create_next(message: Message, state: FSMContext):
     await state.clear()
 
 # ========== ОБРАБОТКА АДМИН-РЕШЕНИЙ ПО ЗАЯВКАМ ==========
-@dp.callback_query(F.data.startswith("adm_app_") | F.data.startswith("adm_rej_"))
-async def cb_adm_action(call: CallbackQuery):
+@callbacks.prefix("adm_app_", int, str)
+@callbacks.prefix("adm_rej_", int, str)
+async def cb_adm_action(call: CallbackQuery, payload: CallbackPayload):
     if call.from_user.id not in ADMIN_IDS:
         return await call.answer("❌ Ты не администратор!", show_alert=True)
-    parts = call.data.split("_")
-    action = parts[1]  # app или rej
-    target_uid = int(parts[2])
-    value = parts[3]   # сумма или GIFT
+    action = "app" if payload.action == "adm_app_" else "rej"
+    target_uid, value = payload.args  # value — сумма или GIFT
 
     # Фейк
     if target_uid == 0:
@@ -2348,18 +4804,20 @@ async def cb_adm_action(call: CallbackQuery):
     try:
         if action == "app":
             reward_text = "подарка" if value == "GIFT" else f"{value} ⭐"
-            await bot.send_message(target_uid, f"🎉 <b>Твоя заявка на вывод {reward_text} одобрена!</b>")
+            delivered = await notify_user(target_uid, f"🎉 <b>Твоя заявка на вывод {reward_text} одобрена!</b>")
             status_text = "✅ ПРИНЯТО"
-            db.log_admin(call.from_user.id, "withdraw_approve", f"Пользователь {target_uid}, сумма {value}")
+            await db.log_admin(call.from_user.id, "withdraw_approve", f"Пользователь {target_uid}, сумма {value}")
         else:
             if value == "GIFT":
-                await bot.send_message(target_uid, "❌ <b>Заявка на вывод подарка отклонена.</b>\nСвяжись с поддержкой.")
+                delivered = await notify_user(target_uid, "❌ <b>Заявка на вывод подарка отклонена.</b>\nСвяжись с поддержкой.")
             else:
-                db.add_stars(target_uid, float(value))
-                await bot.send_message(target_uid, f"❌ <b>Выплата {value} ⭐ отклонена.</b>\nЗвёзды возвращены на твой баланс.")
+                await db.credit(target_uid, float(value), "withdraw_reject")
+                delivered = await notify_user(target_uid, f"❌ <b>Выплата {value} ⭐ отклонена.</b>\nЗвёзды возвращены на твой баланс.")
             status_text = "❌ ОТКЛОНЕНО"
-            db.log_admin(call.from_user.id, "withdraw_reject", f"Пользователь {target_uid}, сумма {value}")
+            await db.log_admin(call.from_user.id, "withdraw_reject", f"Пользователь {target_uid}, сумма {value}")
 
+        if not delivered:
+            status_text += " ⚠️ юзер недоступен, уведомление не отправлено"
         await call.message.edit_text(
             f"{call.message.text}\n\n<b>Итог: {status_text}</b> (Админ: @{call.from_user.username or call.from_user.id})"
         )
@@ -2368,30 +4826,123 @@ async def cb_adm_action(call: CallbackQuery):
         logging.error(f"Ошибка в админ-действии: {e}")
         await call.answer("❌ Ошибка (возможно, юзер заблокировал бота)", show_alert=True)
 
-@dp.callback_query(F.data.startswith("adm_chat_"))
-async def cb_adm_chat(call: CallbackQuery):
+@callbacks.prefix("adm_chat_", int)
+async def cb_adm_chat(call: CallbackQuery, payload: CallbackPayload):
     if call.from_user.id not in ADMIN_IDS:
         return
-    uid = call.data.split("_")[2]
-    if uid == "0":
+    uid, = payload.args
+    if uid == 0:
         return await call.answer("❌ Это фейк!", show_alert=True)
     await call.message.answer(f"🔗 Связь с юзером: tg://user?id={uid}")
     await call.answer()
 
 # ========== ЗАПУСК ==========
+class BoundedWebhookHandler(SimpleRequestHandler):
+    """Приём апдейтов вебхуком.
+
+    Секрет из заголовка X-Telegram-Bot-Api-Secret-Token сверяет SimpleRequestHandler.
+    Telegram сразу получает пустой 200, апдейт обрабатывается в фоне. Одновременно
+    в обработке не больше max_inflight апдейтов: сверх лимита запрос ждёт
+    свободного места, не отвечая, и Telegram сам притормаживает доставку.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, bot: Bot, secret_token: str, max_inflight: int):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self.max_inflight = max_inflight
+        self._slots = asyncio.Semaphore(max_inflight)
+        self.handled = 0
+        self.errors = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        await self._slots.acquire()
+        try:
+            update = await request.json(loads=bot.session.json_loads)
+        except Exception:
+            self._slots.release()
+            raise
+        task = asyncio.create_task(self._background_feed_update(bot=bot, update=update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._update_done)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    def _update_done(self, task: asyncio.Task):
+        self._background_feed_update_tasks.discard(task)
+        self._slots.release()
+        self.handled += 1
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            logging.error(f"Ошибка обработки апдейта: {task.exception()}")
+
+    def stats(self) -> dict:
+        return {
+            'inflight': len(self._background_feed_update_tasks),
+            'max_inflight': self.max_inflight,
+            'handled': self.handled,
+            'errors': self.errors,
+        }
+
+
+webhook = BoundedWebhookHandler(dp, bot, WEBHOOK_SECRET, WEBHOOK_MAX_INFLIGHT) if WEBHOOK_URL else None
+
+
 async def web_handle(request):
     return web.Response(text="Bot Active")
 
+async def stats_handle(request):
+    """Метрики для мониторинга (пул соединений и т.п.)"""
+    return web.json_response({
+        'db': db.stats(),
+        'outbound': outbound.stats(),
+        'outbox': outbox.stats(),
+        'webhook': webhook.stats() if webhook else None,
+        'callback_dedup': callback_dedup.stats(),
+        'throttling': throttling.stats(),
+        'callbacks': callbacks.stats(),
+        'user_locks': user_serial.locks.stats(),
+        'fsm': fsm_storage.stats() if isinstance(fsm_storage, DatabaseStorage) else {'backend': 'redis'},
+    })
+
 async def main():
+    db.start()
+    await identity.refresh()
+    outbound.start()
+    outbox.start()
+    if isinstance(fsm_storage, DatabaseStorage):
+        fsm_storage.start()
+    await broadcasts.resume()
+
     # Настройка веб-сервера для Render (необязательно, но для health check)
     app = web.Application()
     app.router.add_get("/", web_handle)
+    app.router.add_get("/stats", stats_handle)
+    if webhook:
+        webhook.register(app, path=WEBHOOK_PATH)
     runner = web.AppRunner(app)
     await runner.setup()
     await web.TCPSite(runner, "0.0.0.0", PORT).start()
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    if webhook:
+        await dp.emit_startup(bot=bot)
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=min(WEBHOOK_MAX_INFLIGHT, 100),
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        logging.info(f"Вебхук: {WEBHOOK_URL}{WEBHOOK_PATH}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await dp.emit_shutdown(bot=bot)
+            await runner.cleanup()
+            await fsm_storage.close()
+    else:
+        await bot.delete_webhook(drop_pending_updates=True)
+        try:
+            # Апдейты обрабатываются параллельно; порядок для одного юзера держит UserSerialMiddleware
+            await dp.start_polling(bot, handle_as_tasks=True)
+        finally:
+            await fsm_storage.close()
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
@@ -0,0 +1,43 @@
+"""Общие фикстуры тестов.
+
+bot.py — монолит: при импорте он создаёт bot_data.db в текущем каталоге и
+объект Bot, которому нужен токен правильного вида. Поэтому модуль импортируется
+один раз из временного каталога с фиктивным токеном, а каждый тест получает
+свою чистую SQLite-базу в tmp_path.
+"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ["BOT_TOKEN"] = "123456:TEST-token"
+for name in ("DATABASE_URL", "WEBHOOK_URL", "REDIS_URL"):
+    os.environ.pop(name, None)
+
+_cwd = os.getcwd()
+os.chdir(tempfile.mkdtemp(prefix="bot-tests-"))
+try:
+    import bot  # noqa: E402
+finally:
+    os.chdir(_cwd)
+
+
+@pytest.fixture
+def sync_db(tmp_path, monkeypatch):
+    """Свежая база (все миграции применены) в отдельном каталоге"""
+    monkeypatch.chdir(tmp_path)
+    database = bot.Database()
+    yield database
+    database.conn.close()
+
+
+@pytest.fixture
+def adb(sync_db):
+    """AsyncDatabase поверх sync_db; методы вызываются внутри asyncio.run"""
+    database = bot.AsyncDatabase(sync_db)
+    yield database
+    database.close()
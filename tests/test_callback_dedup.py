@@ -0,0 +1,87 @@
+"""CallbackDedupMiddleware: повтор того же нажатия в окне не доходит до хендлера"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import bot
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(bot.time, 'monotonic', fake)
+    return fake
+
+
+def update(data='buy_g_1', user_id=1, message_id=5, inline_message_id=None):
+    message = SimpleNamespace(message_id=message_id) if message_id is not None else None
+    call = SimpleNamespace(
+        from_user=SimpleNamespace(id=user_id), data=data, message=message,
+        inline_message_id=inline_message_id, answer=AsyncMock()
+    )
+    return SimpleNamespace(callback_query=call)
+
+
+def feed(middleware, *events):
+    handled = []
+
+    async def handler(event, data):
+        handled.append(event)
+
+    async def main():
+        for event in events:
+            await middleware(handler, event, {})
+
+    asyncio.run(main())
+    return handled
+
+
+def test_repeat_is_dropped_and_answered(clock):
+    middleware = bot.CallbackDedupMiddleware(window=1.0)
+    first, repeat = update(), update()
+    assert feed(middleware, first, repeat) == [first]
+    repeat.callback_query.answer.assert_awaited_once_with()
+    assert middleware.stats()['dropped'] == 1
+
+
+def test_key_includes_user_data_and_message(clock):
+    middleware = bot.CallbackDedupMiddleware(window=1.0)
+    events = [
+        update(), update(user_id=2), update(data='buy_g_2'), update(message_id=6),
+        update(message_id=None, inline_message_id='abc'),
+    ]
+    assert feed(middleware, *events) == events
+
+
+def test_non_callback_updates_pass(clock):
+    middleware = bot.CallbackDedupMiddleware(window=1.0)
+    message = SimpleNamespace(callback_query=None)
+    assert feed(middleware, message, message) == [message, message]
+
+
+def test_key_expires_after_two_windows(clock):
+    middleware = bot.CallbackDedupMiddleware(window=1.0)
+    assert len(feed(middleware, update())) == 1
+    clock.now += 1.5
+    # Одно окно спустя ключ ещё в предыдущей корзине
+    assert feed(middleware, update()) == []
+    clock.now += 1.0
+    assert len(feed(middleware, update())) == 1
+    clock.now += 5
+    assert len(feed(middleware, update())) == 1
+
+
+def test_memory_is_bounded(clock):
+    middleware = bot.CallbackDedupMiddleware(window=60, maxsize=10)
+    feed(middleware, *(update(data=f'x{n}') for n in range(100)))
+    assert middleware.stats()['tracked'] <= 20
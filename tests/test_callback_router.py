@@ -0,0 +1,160 @@
+"""CallbackRouter: точные значения, самый длинный префикс, типизированный payload"""
+import asyncio
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+import bot
+
+
+class FakeState:
+    def __init__(self, state=None):
+        self.state = state
+
+    async def get_state(self):
+        return self.state
+
+
+def press(router, data, state=None):
+    call = SimpleNamespace(data=data, answer=AsyncMock())
+    result = asyncio.run(router.dispatch(call, FakeState(state)))
+    return call, result
+
+
+def test_exact_route_gets_only_call():
+    router = bot.CallbackRouter()
+
+    @router.exact("menu", "back")
+    async def menu(call):
+        return ('menu', call.data)
+
+    assert press(router, "menu")[1] == ('menu', 'menu')
+    assert press(router, "back")[1] == ('menu', 'back')
+    assert router.stats() == {'exact': 2, 'routed': 2, 'unmatched': 0}
+
+
+def test_typed_payload_and_greedy_last_arg():
+    router = bot.CallbackRouter()
+
+    @router.prefix("set_boost_", str, float, optional=(int,))
+    async def set_boost(call, payload: bot.CallbackPayload):
+        return payload
+
+    @router.prefix("confirm_out_", str)
+    async def confirm(call, payload: bot.CallbackPayload):
+        return payload.args
+
+    assert press(router, "set_boost_game_1.5_3600")[1] == bot.CallbackPayload("set_boost_", ("game", 1.5, 3600))
+    # Необязательный хвостовой аргумент без значения — None, длина args та же
+    assert press(router, "set_boost_ref_2")[1].args == ("ref", 2.0, None)
+    assert press(router, "confirm_out_🧸 Мишка_big")[1] == ("🧸 Мишка_big",)
+
+
+def test_longest_prefix_wins_and_bad_args_fall_back():
+    router = bot.CallbackRouter()
+
+    @router.prefix("buy_", str)
+    async def buy(call, payload: bot.CallbackPayload):
+        return ('buy', payload.args)
+
+    @router.prefix("buy_p2p_", int)
+    async def buy_p2p(call, payload: bot.CallbackPayload):
+        return ('buy_p2p', payload.args)
+
+    assert press(router, "buy_p2p_7")[1] == ('buy_p2p', (7,))
+    # Хвост не разобрался как int — пробуется более короткий префикс
+    assert press(router, "buy_p2p_x")[1] == ('buy', ('p2p_x',))
+    assert press(router, "buy_t_gem")[1] == ('buy', ('t_gem',))
+
+
+def test_exact_beats_prefix():
+    router = bot.CallbackRouter()
+
+    @router.exact("inventory")
+    @router.prefix("inventory_", int)
+    async def inventory(call, payload: bot.CallbackPayload):
+        return payload.args[0] if payload.args else 0
+
+    assert press(router, "inventory")[1] == 0
+    assert press(router, "inventory_3")[1] == 3
+
+
+def test_unmatched_is_answered():
+    router = bot.CallbackRouter()
+
+    @router.prefix("quest_info_", int)
+    async def quest(call, payload: bot.CallbackPayload):
+        return payload
+
+    for data in ("nope", "quest_info_", "quest_info_abc", ""):
+        call, result = press(router, data)
+        assert result is None
+        call.answer.assert_awaited_once_with()
+    assert router.stats()['unmatched'] == 4
+
+
+def test_too_few_arguments_do_not_match():
+    router = bot.CallbackRouter()
+    handled = []
+
+    @router.prefix("adm_app_", int, str)
+    async def adm_action(call, payload: bot.CallbackPayload):
+        target_uid, value = payload.args
+        handled.append((target_uid, value))
+
+    # Раньше короткий хвост доходил до хендлера с args == (123,) и падал на распаковке
+    for data in ("adm_app_123", "adm_app_"):
+        call, _ = press(router, data)
+        call.answer.assert_awaited_once_with()
+    assert handled == [] and router.stats()['unmatched'] == 2
+    press(router, "adm_app_123_100.0")
+    assert handled == [(123, '100.0')]
+
+
+def test_too_few_arguments_fall_back_to_shorter_prefix():
+    router = bot.CallbackRouter()
+
+    @router.prefix("a_", str)
+    async def short(call, payload: bot.CallbackPayload):
+        return ('short', payload.args)
+
+    @router.prefix("a_b_", int, int)
+    async def long(call, payload: bot.CallbackPayload):
+        return ('long', payload.args)
+
+    assert press(router, "a_b_1_2")[1] == ('long', (1, 2))
+    assert press(router, "a_b_1")[1] == ('short', ('b_1',))
+
+
+def test_bot_routes_declare_their_arity():
+    route, tail = next(bot.callbacks._candidates("set_boost_ref_3"))
+    assert route.parse(tail) == ("ref", 3.0, None)
+    assert route.parse("game_2_3600") == ("game", 2.0, 3600)
+    route, tail = next(bot.callbacks._candidates("adm_app_5"))
+    assert route.handler.__name__ == 'cb_adm_action'
+    with pytest.raises(ValueError):
+        route.parse(tail)
+
+
+def test_state_bound_route():
+    router = bot.CallbackRouter()
+    waiting = bot.CreateCheckStates.waiting_for_type
+
+    @router.prefix("check_type_", str, state=waiting)
+    async def check_type(call, state, payload: bot.CallbackPayload):
+        return (await state.get_state(), payload.args)
+
+    call, result = press(router, "check_type_stars")
+    assert result is None
+    call.answer.assert_awaited_once_with()
+    assert press(router, "check_type_stars", state=waiting.state)[1] == (waiting.state, ("stars",))
+    assert press(router, "check_type_stars", state="Other:state")[1] is None
+
+
+def test_bot_routes_are_registered():
+    assert bot.callbacks.stats()['exact'] > 0
+    route_names = {
+        route.handler.__name__ for route, _ in bot.callbacks._candidates("buy_p2p_1")
+    }
+    assert route_names == {'cb_buy_p2p'}
@@ -0,0 +1,70 @@
+"""KeyedLock: один ключ — по очереди, разные ключи — параллельно"""
+import asyncio
+
+import bot
+
+
+def test_same_key_is_serialized():
+    async def main():
+        locks = bot.KeyedLock()
+        order = []
+
+        async def work(name):
+            async with locks(1):
+                order.append(f"{name}+")
+                await asyncio.sleep(0.01)
+                order.append(f"{name}-")
+
+        await asyncio.gather(work('a'), work('b'), work('c'))
+        return order, locks
+
+    order, locks = asyncio.run(main())
+    assert order == ['a+', 'a-', 'b+', 'b-', 'c+', 'c-']
+    assert locks.stats() == {'active': 0, 'acquired': 3, 'contended': 2}
+
+
+def test_different_keys_run_in_parallel():
+    async def main():
+        locks = bot.KeyedLock()
+        inside = set()
+        peak = 0
+
+        async def work(key):
+            nonlocal peak
+            async with locks(key):
+                inside.add(key)
+                peak = max(peak, len(inside))
+                await asyncio.sleep(0.01)
+                inside.discard(key)
+
+        await asyncio.gather(*(work(key) for key in range(5)))
+        return peak, locks.stats()
+
+    peak, stats = asyncio.run(main())
+    assert peak == 5
+    assert stats['contended'] == 0
+
+
+def test_entry_is_released_after_error_and_cancel():
+    async def main():
+        locks = bot.KeyedLock()
+        try:
+            async with locks('k'):
+                raise RuntimeError
+        except RuntimeError:
+            pass
+
+        async def hold():
+            async with locks('k'):
+                await asyncio.sleep(10)
+
+        holder = asyncio.create_task(hold())
+        waiter = asyncio.create_task(hold())
+        await asyncio.sleep(0.01)
+        assert locks.stats()['active'] == 1
+        holder.cancel()
+        waiter.cancel()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+        return locks.stats()['active']
+
+    assert asyncio.run(main()) == 0
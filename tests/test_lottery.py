@@ -0,0 +1,62 @@
+"""Лотерея: билеты в lottery_tickets и взвешенный розыгрыш в SQL"""
+import random
+from collections import Counter
+
+import bot
+
+
+def make_users(sync_db, *user_ids):
+    for user_id in user_ids:
+        sync_db.create_user(user_id, f'u{user_id}', 'User')
+
+
+def test_tickets_are_counted_per_round(sync_db):
+    make_users(sync_db, 1, 2)
+    sync_db.buy_lottery_ticket(1, 2.0)
+    sync_db.buy_lottery_ticket(2, 2.0)
+    sync_db.buy_lottery_ticket(2, 2.0)
+    assert sync_db.get_lottery() == {'round_id': 1, 'pool': 6.0, 'tickets': 3, 'players': 2}
+    rows = sync_db.execute("SELECT user_id, tickets FROM lottery_tickets ORDER BY user_id", fetch=True)
+    assert [tuple(row) for row in rows] == [(1, 1), (2, 2)]
+
+
+def test_draw_without_tickets_returns_none(sync_db):
+    assert sync_db.draw_lottery() is None
+    assert sync_db.get_lottery()['round_id'] == 1
+
+
+def test_draw_pays_winner_and_starts_new_round(sync_db):
+    make_users(sync_db, 1)
+    for _ in range(5):
+        sync_db.buy_lottery_ticket(1, 2.0)
+    assert sync_db.draw_lottery(0.8) == (1, 8.0)
+    assert sync_db.get_user(1)['stars'] == 8.0
+    assert sync_db.get_lottery() == {'round_id': 2, 'pool': 0.0, 'tickets': 0, 'players': 0}
+    assert sync_db.execute("SELECT COUNT(*) AS cnt FROM lottery_tickets", fetchone=True)['cnt'] == 0
+
+
+def test_winner_is_picked_by_ticket_weight(sync_db, monkeypatch):
+    make_users(sync_db, 1, 2, 3)
+    tickets = {1: 1, 2: 3, 3: 2}
+    # Номер билета 0..5 по нарастающей сумме: [0] -> 1, [1..3] -> 2, [4..5] -> 3
+    wins = Counter()
+    for ticket_no in range(sum(tickets.values())):
+        for user_id, count in tickets.items():
+            for _ in range(count):
+                sync_db.buy_lottery_ticket(user_id, 1.0)
+        monkeypatch.setattr(bot.random, 'randrange', lambda n, ticket_no=ticket_no: ticket_no)
+        winner, _ = sync_db.draw_lottery()
+        wins[winner] += 1
+    assert wins == Counter(tickets)
+
+
+def test_draw_distribution_follows_weights(sync_db):
+    make_users(sync_db, 1, 2)
+    random.seed(7)
+    wins = Counter()
+    for _ in range(400):
+        sync_db.buy_lottery_ticket(1, 1.0)
+        for _ in range(3):
+            sync_db.buy_lottery_ticket(2, 1.0)
+        wins[sync_db.draw_lottery()[0]] += 1
+    assert 60 <= wins[1] <= 140
@@ -0,0 +1,68 @@
+"""Версионные миграции схемы и самопроверка индексов"""
+import sqlite3
+
+import bot
+
+
+LATEST = bot.MIGRATIONS[-1].version
+
+
+def applied(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT version, applied_at FROM schema_version ORDER BY version").fetchall()
+    finally:
+        conn.close()
+
+
+def test_versions_are_unique_and_increasing():
+    versions = [m.version for m in bot.MIGRATIONS]
+    assert versions == sorted(set(versions))
+    assert versions[0] == 1
+
+
+def test_fresh_database_reaches_latest_version(sync_db, tmp_path):
+    assert sync_db.schema_version == LATEST
+    assert sync_db.missing_indexes == []
+    assert [version for version, _ in applied(tmp_path / "bot_data.db")] == list(range(1, LATEST + 1))
+
+
+def test_restart_applies_nothing(sync_db, tmp_path):
+    before = applied(tmp_path / "bot_data.db")
+    again = bot.Database()
+    try:
+        assert again.schema_version == LATEST
+        assert applied(tmp_path / "bot_data.db") == before
+    finally:
+        again.conn.close()
+
+
+def test_only_pending_versions_are_applied(sync_db, tmp_path):
+    # База «отстала» на последнюю миграцию: её таблицы и записи о версии нет
+    sync_db.conn.execute("DROP TABLE fsm_states")
+    sync_db.conn.execute("DELETE FROM schema_version WHERE version = ?", (LATEST,))
+    sync_db.conn.commit()
+    kept = applied(tmp_path / "bot_data.db")
+
+    again = bot.Database()
+    try:
+        assert again.schema_version == LATEST
+        assert applied(tmp_path / "bot_data.db")[:-1] == kept
+        assert again.execute("SELECT COUNT(*) AS cnt FROM fsm_states", fetchone=True)['cnt'] == 0
+    finally:
+        again.conn.close()
+
+
+def test_missing_index_is_reported(sync_db):
+    sync_db.conn.execute("DROP INDEX idx_users_stars")
+    sync_db.conn.commit()
+    assert sync_db.check_indexes(sync_db.conn) == ['idx_users_stars']
+
+
+def test_add_column_is_idempotent(sync_db):
+    step = bot.AddColumn('users', 'test_flag', 'INTEGER DEFAULT 0')
+    cur = sync_db.conn.cursor()
+    step(cur, 'sqlite')
+    step(cur, 'sqlite')
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(users)")]
+    assert columns.count('test_flag') == 1
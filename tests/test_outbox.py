@@ -0,0 +1,53 @@
+"""Outbox: идемпотентная запись в транзакции и аренда пачек диспетчером"""
+import bot
+
+
+def test_put_is_idempotent_and_commits_with_transaction(sync_db):
+    woken = []
+    sync_db.on_outbox = lambda: woken.append(True)
+    with sync_db.transaction():
+        assert sync_db.outbox_put('wd:1', -100, 'заявка')
+        assert not sync_db.outbox_put('wd:1', -100, 'заявка')
+        assert woken == []
+    assert woken == [True]
+    assert sync_db.execute("SELECT COUNT(*) AS cnt FROM outbox", fetchone=True)['cnt'] == 1
+
+
+def test_rollback_drops_the_message(sync_db):
+    try:
+        with sync_db.transaction():
+            sync_db.outbox_put('gift:1', -100, 'подарок')
+            raise bot.OperationDeclined("нет предмета")
+    except bot.OperationDeclined:
+        pass
+    assert sync_db.claim_outbox(10, 60) == []
+
+
+def test_claim_leases_rows(sync_db):
+    for n in range(3):
+        sync_db.outbox_put(f'k{n}', -100, f'msg {n}')
+    first = sync_db.claim_outbox(2, 60)
+    assert [row['idem_key'] for row in first] == ['k0', 'k1']
+    assert all(row['attempts'] == 1 for row in first)
+    # Взятые в аренду не выдаются повторно, пока не истёк lease
+    assert [row['idem_key'] for row in sync_db.claim_outbox(10, 60)] == ['k2']
+    assert sync_db.claim_outbox(10, 60) == []
+
+
+def test_expired_lease_and_retry(sync_db):
+    sync_db.outbox_put('k', -100, 'msg')
+    row, = sync_db.claim_outbox(1, -1)
+    # Отправитель упал: lease истёк, запись снова доступна
+    again, = sync_db.claim_outbox(1, 60)
+    assert again['id'] == row['id'] and again['attempts'] == 2
+    sync_db.outbox_failed(row['id'], 'timeout', 0)
+    assert sync_db.claim_outbox(1, 60)[0]['attempts'] == 3
+    sync_db.outbox_failed(row['id'], 'forbidden', None)
+    assert sync_db.claim_outbox(1, 60) == []
+
+
+def test_sent_rows_are_not_claimed(sync_db):
+    sync_db.outbox_put('k', -100, 'msg')
+    row, = sync_db.claim_outbox(1, -1)
+    sync_db.outbox_sent([row['id']])
+    assert sync_db.claim_outbox(1, 60) == []
@@ -0,0 +1,74 @@
+"""Сегменты рассылки: разбор условий админа, COUNT по ним и отметка last_seen"""
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+
+
+@pytest.mark.parametrize('text', ['', '  ', 'все', 'ALL'])
+def test_everyone(text):
+    segment = bot.Segment.parse(text)
+    assert segment.to_sql() == ('', ())
+    assert segment.describe() == "все пользователи"
+
+
+def test_conditions_to_sql():
+    segment = bot.Segment.parse("active=1 Stars>=10 earned<=2.5 ref=0")
+    assert segment.dumps() == "active=1 stars>=10 earned<=2.5 ref=0"
+    where, params = segment.to_sql()
+    assert where == " AND is_active = ? AND stars >= ? AND total_earned <= ? AND referred_by IS NULL"
+    assert params == (1.0, 10.0, 2.5)
+
+
+def test_days_becomes_since_timestamp():
+    where, (since,) = bot.Segment.parse("days<=7").to_sql()
+    assert where == " AND last_seen >= ?"
+    expected = datetime.utcnow() - timedelta(days=7)
+    assert abs(datetime.strptime(since, '%Y-%m-%d %H:%M:%S') - expected) < timedelta(seconds=5)
+
+
+@pytest.mark.parametrize('text', [
+    'active', 'foo=1', 'stars=5', 'days>=3', 'active=abc', 'stars>=nan', 'stars<=inf',
+    'active=2', 'premium=-1', 'days<=0', 'days<=-3', 'earned>=-5',
+])
+def test_invalid_conditions(text):
+    with pytest.raises(ValueError):
+        bot.Segment.parse(text)
+
+
+def test_count_segment(sync_db):
+    for user_id, stars in ((1, 0), (2, 5), (3, 20)):
+        sync_db.create_user(user_id, f'u{user_id}', 'User')
+        if stars:
+            sync_db.credit(user_id, stars)
+    sync_db.set_reachable(3, False)
+    assert sync_db.count_segment('') == 2
+    assert sync_db.count_segment('stars>=5') == 1
+    sync_db.touch_user(1)
+    assert sync_db.count_segment('days<=1') == 1
+
+
+def test_last_seen_waits_for_the_user_row(adb, monkeypatch):
+    monkeypatch.setattr(bot, 'db', adb)
+    user = SimpleNamespace(id=42)
+
+    async def handler(event, data):
+        return 'ok'
+
+    async def main():
+        middleware = bot.LastSeenMiddleware(600)
+        # До /start строки нет: отметка не запоминается
+        assert await middleware(handler, None, {'event_from_user': user}) == 'ok'
+        await asyncio.gather(*middleware._pending)
+        first = middleware._recent.get(user.id)
+        await adb.create_user(user.id, 'new', 'New')
+        await middleware(handler, None, {'event_from_user': user})
+        await asyncio.gather(*middleware._pending)
+        return first, (await adb.get_user(user.id))['last_seen']
+
+    first, last_seen = asyncio.run(main())
+    assert first is None
+    assert last_seen is not None
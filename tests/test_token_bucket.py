@@ -0,0 +1,62 @@
+"""TokenBucket: всплеск до capacity, дальше rate в секунду, пауза после 429"""
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = Clock()
+    monkeypatch.setattr(bot.time, 'monotonic', fake)
+    return fake
+
+
+def test_burst_then_rate(clock):
+    bucket = bot.TokenBucket(rate=2, capacity=3)
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.try_acquire() == 0
+    # Простой не копит больше capacity
+    clock.now += 60
+    assert [bucket.try_acquire() for _ in range(3)] == [0, 0, 0]
+    assert bucket.try_acquire() > 0
+
+
+def test_pause_blocks_and_then_allows_one(clock):
+    bucket = bot.TokenBucket(rate=1, capacity=5)
+    bucket.pause(10)
+    assert bucket.try_acquire() == pytest.approx(10)
+    clock.now += 10
+    assert bucket.try_acquire() == 0
+    assert bucket.try_acquire() == pytest.approx(1)
+
+
+def test_pause_never_shortens():
+    bucket = bot.TokenBucket(rate=1)
+    bucket.pause(10)
+    bucket.pause(1)
+    assert bucket.try_acquire() > 5
+
+
+def test_acquire_waits_for_rate():
+    async def main():
+        bucket = bot.TokenBucket(rate=20, capacity=1)
+        started = time.monotonic()
+        for _ in range(4):
+            await bucket.acquire()
+        return time.monotonic() - started
+
+    # Первый токен сразу, ещё три — по 1/20 секунды
+    assert 0.13 <= asyncio.run(main()) < 1.0
@@ -0,0 +1,72 @@
+"""Кэш строк users: сквозная запись и гонка чтения с чужой записью"""
+import threading
+
+import bot
+
+
+def db_stars(sync_db, user_id):
+    return sync_db.execute("SELECT stars FROM users WHERE user_id = ?", (user_id,), fetchone=True)['stars']
+
+
+def test_write_through_updates_cached_row(sync_db):
+    sync_db.create_user(1, 'user', 'User')
+    assert sync_db.get_user(1)['stars'] == 0
+    sync_db.credit(1, 5)
+    assert sync_db.user_cache.peek(1).stars == 5.0
+    assert sync_db.get_user(1)['stars'] == 5.0
+
+
+def test_load_racing_with_write_does_not_cache_stale_row(sync_db):
+    sync_db.create_user(1, 'user', 'User')
+    sync_db.user_cache.pop(1)
+
+    selected, resume = threading.Event(), threading.Event()
+    execute = sync_db.execute
+
+    def paused_execute(query, *args, **kwargs):
+        result = execute(query, *args, **kwargs)
+        if query.startswith("SELECT * FROM users") and threading.current_thread().name == 'reader':
+            # Строка уже прочитана, но ещё не положена в кэш
+            selected.set()
+            resume.wait(5)
+        return result
+
+    sync_db.execute = paused_execute
+    loaded = {}
+    reader = threading.Thread(target=lambda: loaded.update(sync_db.load_user(1)), name='reader')
+    reader.start()
+    assert selected.wait(5)
+    writer = threading.Thread(target=sync_db.add_stars, args=(1, 3.0), name='writer')
+    writer.start()
+    writer.join(5)
+    resume.set()
+    reader.join(5)
+    del sync_db.execute
+
+    # Читатель вернул то, что прочитал, но в кэше — строка после записи
+    assert loaded['stars'] == 0
+    assert sync_db.get_user(1)['stars'] == db_stars(sync_db, 1) > 0
+
+
+def test_invalidate_during_load_drops_result():
+    cache = bot.LRUCache(10, 60)
+    ticket = cache.begin_load('k')
+    cache.pop('k')
+    cache.end_load('k', ticket, 'old')
+    assert cache.get('k') is None
+    # Чтение, начатое после изменения, кладётся как обычно
+    ticket = cache.begin_load('k')
+    cache.end_load('k', ticket, 'new')
+    assert cache.get('k') == 'new'
+
+
+def test_overlapping_loads_and_cleanup():
+    cache = bot.LRUCache(10, 60)
+    first = cache.begin_load('k')
+    cache.changed('k')
+    second = cache.begin_load('k')
+    cache.end_load('k', first, 'stale')
+    cache.end_load('k', second, 'fresh')
+    assert cache.get('k') == 'fresh'
+    cache.end_load('k', cache.begin_load('k'))
+    assert cache._loading == {}
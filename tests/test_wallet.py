@@ -0,0 +1,93 @@
+"""Кошелёк и инвентарь: атомарные try_debit / credit / take_item"""
+import asyncio
+import math
+
+import pytest
+
+import bot
+
+
+def balance(sync_db, user_id):
+    return sync_db.execute("SELECT stars FROM users WHERE user_id = ?", (user_id,), fetchone=True)['stars']
+
+
+@pytest.fixture
+def user(sync_db):
+    sync_db.create_user(1, 'user', 'User')
+    sync_db.credit(1, 10)
+    return 1
+
+
+def test_try_debit_takes_only_what_is_there(sync_db, user):
+    assert sync_db.try_debit(user, 4) == 6.0
+    assert sync_db.try_debit(user, 7) is None
+    assert balance(sync_db, user) == 6.0
+    assert sync_db.try_debit(user, 6) == 0.0
+
+
+def test_try_debit_and_credit_unknown_user(sync_db):
+    assert sync_db.try_debit(404, 1) is None
+    assert sync_db.credit(404, 1, 'test') is None
+
+
+def test_credit_returns_new_balance_and_updates_cache(sync_db, user):
+    assert sync_db.get_user(user)['stars'] == 10.0
+    assert sync_db.credit(user, 2.5, 'test') == 12.5
+    assert sync_db.get_user(user)['stars'] == 12.5
+
+
+@pytest.mark.parametrize('amount', [0, -5, math.nan, math.inf, -math.inf])
+def test_bad_amounts_are_rejected(sync_db, user, amount):
+    with pytest.raises(ValueError):
+        sync_db.try_debit(user, amount)
+    with pytest.raises(ValueError):
+        sync_db.credit(user, amount)
+    assert balance(sync_db, user) == 10.0
+
+
+def test_rollback_restores_balance_and_cache(sync_db, user):
+    with pytest.raises(bot.OperationDeclined):
+        with sync_db.transaction():
+            assert sync_db.try_debit(user, 8) == 2.0
+            raise bot.OperationDeclined("отмена")
+    assert balance(sync_db, user) == 10.0
+    assert sync_db.get_user(user)['stars'] == 10.0
+
+
+def test_concurrent_debits_never_overdraw(adb, user):
+    async def main():
+        results = await asyncio.gather(*(adb.try_debit(user, 3) for _ in range(5)))
+        return results, (await adb.get_user(user))['stars']
+
+    results, stars = asyncio.run(main())
+    assert sorted(r for r in results if r is not None) == [1.0, 4.0, 7.0]
+    assert results.count(None) == 2
+    assert stars == 1.0
+
+
+def test_transaction_declined_keeps_balance(adb, user):
+    async def main():
+        with pytest.raises(bot.OperationDeclined):
+            async with adb.transaction():
+                await adb.try_debit(user, 5)
+                await adb.credit(2, 5, 'test')
+                raise bot.OperationDeclined("нет получателя")
+        return (await adb.get_user(user))['stars']
+
+    assert asyncio.run(main()) == 10.0
+
+
+def inventory(sync_db, user_id):
+    rows = sync_db.execute("SELECT item_name, quantity FROM inventory WHERE user_id = ?", (user_id,), fetch=True)
+    return {row['item_name']: row['quantity'] for row in rows}
+
+
+def test_take_item_only_when_enough(sync_db, user):
+    sync_db.add_item(user, 'Мишка', 3)
+    assert sync_db.take_item(user, 'Мишка', 2)
+    assert not sync_db.take_item(user, 'Мишка', 2)
+    assert inventory(sync_db, user) == {'Мишка': 1}
+    # Последний экземпляр — строка удаляется
+    assert sync_db.take_item(user, 'Мишка')
+    assert inventory(sync_db, user) == {}
+    assert not sync_db.take_item(user, 'Мишка')